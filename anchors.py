@@ -0,0 +1,90 @@
+import os
+from collections import OrderedDict
+
+from result_store import ResultStore, input_hash
+
+ANCHOR_KEYS = ["min_mean_deviation", "max_mean_deviation", "min_income", "max_income"]
+
+
+def valid_anchors(anchors):
+    """
+    The weighted objective divides by the spans between the anchors, so they must not be empty
+    """
+    return (
+        all(anchors.get(key) is not None for key in ANCHOR_KEYS)
+        and anchors["max_mean_deviation"] > anchors["min_mean_deviation"]
+        and anchors["max_income"] > anchors["min_income"]
+    )
+
+
+def anchor_key(values, timeframe, step_length):
+    """
+    The anchors depend on the systemvalues and the horizon
+    """
+    return f"{input_hash(values)}:{timeframe}:{step_length}"
+
+
+class AnchorCache:
+    """
+    Remembers the normalization anchors of previous runs, in memory and, with a path,
+    in the anchors table of a ResultStore, so they survive restarts and are shared
+    between processes.
+    Lookups return the anchors of the same input, those of the most recent run
+    or the defaults, together with where they came from.
+    Anchors are stored with their source, "exact" or "estimated",
+    exact anchors are never replaced by estimated ones.
+    """
+
+    def __init__(self, defaults, size=128, path=None):
+        self.defaults = defaults
+        self.size = size
+        self.path = path
+        self.anchors = OrderedDict()
+        self.store_pid = None
+        self.result_store = None
+
+    def persistent(self):
+        """
+        The result store of this process, opened on first use, None without path
+        """
+        if self.path is None:
+            return None
+        if self.store_pid != os.getpid():
+            self.result_store = ResultStore(self.path)
+            self.store_pid = os.getpid()
+        return self.result_store
+
+    def store(self, values, timeframe, step_length, anchors, source="exact"):
+        key = anchor_key(values, timeframe, step_length)
+        if source != "exact" and self.anchors.get(key, (None, None))[1] == "exact":
+            return
+        self.anchors[key] = (dict(anchors), source)
+        self.anchors.move_to_end(key)
+        while len(self.anchors) > self.size:
+            self.anchors.popitem(last=False)
+        store = self.persistent()
+        if store is not None:
+            try:
+                store.store_anchors(key, anchors, source)
+            except Exception as e:
+                print("storing the anchors failed", e)
+
+    def lookup(self, key=None):
+        store = self.persistent()
+        if store is None:
+            return None
+        try:
+            return store.get_anchors(key)
+        except Exception as e:
+            print("reading the anchors failed", e)
+            return None
+
+    def get(self, values, timeframe, step_length):
+        key = anchor_key(values, timeframe, step_length)
+        found = self.anchors.get(key) or self.lookup(key)
+        if found is not None:
+            return dict(found[0]), f"cache ({found[1]})"
+        found = (next(reversed(self.anchors.values())) if self.anchors else None) or self.lookup()
+        if found is not None:
+            return dict(found[0]), f"latest run ({found[1]})"
+        return dict(self.defaults), "defaults"
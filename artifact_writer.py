@@ -0,0 +1,141 @@
+import atexit
+import json
+import os
+import queue
+import threading
+
+# Tasks that may wait in the writer queue before submit blocks the caller
+MAX_BACKLOG = 16
+
+# Plots are drawn off the main thread, where only a non interactive backend works
+PLOT_BACKEND = "Agg"
+
+# Seconds close waits at interpreter shutdown for the remaining artifacts
+SHUTDOWN_TIMEOUT = 60
+
+
+def write_json(path, data):
+    """
+    Writes through a temporary file, so readers never see a partial result
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def plot_load_comparison(**kwargs):
+    # The plotting stack is only imported by the writer thread, when the first plot is drawn
+    import matplotlib
+
+    matplotlib.use(PLOT_BACKEND, force=True)
+    from Daten.results.plotter import plot_load_comparison as plot
+
+    plot(**kwargs)
+
+
+def store_run(**run):
+    from result_store import ResultStore
+
+    with ResultStore() as store:
+        store.add_run(**run)
+
+
+class ArtifactWriter:
+    """
+    Writes results and plots in a background thread, so the scheduling path returns
+    as soon as the schedule is published.
+    The queue is bounded by max_backlog, submit blocks while it is full,
+    or drops the task if block is False, e.g. when called from a callback that must not wait.
+    Tasks run in submission order, a failing task is reported and the next one runs.
+    Plots are drawn with the PLOT_BACKEND, they are saved by the plotter and never shown.
+    """
+
+    def __init__(self, max_backlog=MAX_BACKLOG):
+        self.tasks = queue.Queue(maxsize=max_backlog)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="artifact-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.close, SHUTDOWN_TIMEOUT)
+
+    def submit(self, function, *args, block=True, **kwargs):
+        """
+        Queues a task, returns False if block is False and it was dropped for a full backlog
+        """
+        if self.closed:
+            raise RuntimeError("artifact writer is closed")
+        self.start()
+        if not block:
+            try:
+                self.tasks.put_nowait((function, args, kwargs))
+                return True
+            except queue.Full:
+                self.dropped += 1
+                print("artifact writer backlog full, dropping", function.__name__)
+                return False
+        if self.tasks.full():
+            print("artifact writer backlog full, waiting")
+        self.tasks.put((function, args, kwargs))
+        return True
+
+    def write_json(self, path, data, block=True):
+        return self.submit(write_json, path, data, block=block)
+
+    def plot(self, block=True, **kwargs):
+        return self.submit(plot_load_comparison, block=block, **kwargs)
+
+    def store_run(self, block=True, **run):
+        return self.submit(store_run, block=block, **run)
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                function, args, kwargs = task
+                function(*args, **kwargs)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print("writing artifact failed:", e)
+            finally:
+                self.tasks.task_done()
+
+    def backlog(self):
+        return self.tasks.qsize()
+
+    def flush(self):
+        """
+        Blocks until every submitted task is done
+        """
+        if self.thread is not None:
+            self.tasks.join()
+
+    def close(self, timeout=None):
+        """
+        Writes the remaining artifacts and stops the thread
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.thread is None:
+            return
+        self.tasks.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print("artifact writer stopped with", self.backlog(), "artifacts left")
+
+
+artifact_writer = ArtifactWriter()
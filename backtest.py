@@ -0,0 +1,291 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from result_store import input_hash
+
+BACKTEST_DIR = "Daten/backtests"
+
+DAY = 24 * 3600
+
+# Data files the days of a backtest are taken from
+DATA_FILES = {
+    "Daten/Gasdemand_test.pkl": "time",
+    "Daten/electricity_grid_04-11_04_2022.pkl": "time",
+    "Daten/Lastreihe_CN_04-11_04_2022.pkl": "time",
+}
+
+
+def available_days():
+    """
+    Number of whole days covered by all data files
+    """
+    from load_import import load_cached_obj
+
+    return int(min(max(load_cached_obj(name)[key]) for name, key in DATA_FILES.items()) // DAY)
+
+
+def storage_end_states(model, step_length):
+    """
+    State of charge of every storage after the last step of the horizon
+    """
+    from components.storage import Storage
+
+    states = {}
+    last = max(model.t)
+    for device in model.devices:
+        if not isinstance(device, Storage):
+            continue
+        charge = model.get_attribute(device, "state_of_charge")[last].value
+        charging = model.get_attribute(device, f"{device.energy_type}_negative_power")[last].value
+        discharging = model.get_attribute(device, f"{device.energy_type}_positive_power")[last].value
+        charge += (
+            charging * device.charging_efficiency - discharging / device.charging_efficiency
+        ) * (step_length / 3600)
+        states[device.name] = min(max(charge, 0), device.capacity)
+    return states
+
+
+def run_day(day, values, step_length, weights, anchor_mode, initial_charge=None):
+    """
+    Runs multi_step_optimization on one day of the data files, in a worker process
+    """
+    from schedule_generator import INITIAL_CHARGE_KEY, START_KEY, multi_step_optimization
+
+    start = time.perf_counter()
+    day_values = dict(values, **{START_KEY: day * DAY})
+    if initial_charge is not None:
+        day_values[INITIAL_CHARGE_KEY] = initial_charge
+    try:
+        model = multi_step_optimization(
+            DAY // step_length,
+            day_values,
+            step_length,
+            anchor_mode=anchor_mode,
+            income_weight=weights[0],
+            fulfillment_weight=weights[1],
+        )
+    except Exception as e:
+        return {"day": day, "error": str(e), "time": time.perf_counter() - start}
+    return {
+        "day": day,
+        "income_sum": model.income_sum(),
+        "mean_deviation": model.mean_deviation(),
+        "solver_status": model.solver_status,
+        "initial_charge": initial_charge,
+        "end_state": storage_end_states(model, step_length),
+        "time": time.perf_counter() - start,
+    }
+
+
+def run_segment(days, values, step_length, weights, anchor_mode, initial_charge, directory):
+    """
+    Runs consecutive days, each one starting from the storage end states of the day before.
+    Every finished day is checkpointed, so a resumed run continues after it.
+    """
+    results = []
+    for day in days:
+        result = run_day(day, values, step_length, weights, anchor_mode, initial_charge)
+        save_day(directory, result)
+        results.append(result)
+        if "error" in result:
+            # Without an end state the following days can not be chained
+            break
+        initial_charge = result["end_state"]
+    return results
+
+
+def day_path(directory, day):
+    return os.path.join(directory, "days", f"{day:04d}.json")
+
+
+def save_day(directory, result):
+    path = day_path(directory, result["day"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(result, f)
+    os.replace(temporary, path)
+
+
+def load_days(directory):
+    """
+    Checkpointed results by day, days that failed are run again on resume
+    """
+    results = {}
+    folder = os.path.join(directory, "days")
+    if not os.path.isdir(folder):
+        return results
+    for name in os.listdir(folder):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(folder, name)) as f:
+            result = json.load(f)
+        if "error" not in result:
+            results[result["day"]] = result
+    return results
+
+
+def stored_configuration(directory):
+    """
+    Configuration of an earlier run of the backtest, None for a new one
+    """
+    path = os.path.join(directory, "configuration.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_configuration(directory, configuration):
+    """
+    Writes the configuration of a new run, a resumed run has to use the same one
+    """
+    path = os.path.join(directory, "configuration.json")
+    stored = stored_configuration(directory)
+    if stored is not None:
+        if stored != configuration:
+            raise ValueError(
+                f"backtest {directory} was started with another configuration, "
+                "use a new name or delete it"
+            )
+        return
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(configuration, f, indent=2)
+
+
+def segments(days, count):
+    """
+    Splits days into count runs of consecutive days of nearly equal length
+    """
+    count = max(1, min(count, len(days)))
+    size, rest = divmod(len(days), count)
+    result = []
+    position = 0
+    for index in range(count):
+        length = size + (index < rest)
+        result.append(days[position : position + length])
+        position += length
+    return result
+
+
+def backtest(
+    values,
+    name,
+    days=None,
+    step_length=900,
+    weights=None,
+    anchor_mode="exact",
+    chain_storage=False,
+    workers=None,
+    directory=BACKTEST_DIR,
+):
+    """
+    Replays multi_step_optimization over historical days in a process pool.
+    Every day is checkpointed in directory/name, running the same backtest again resumes it.
+
+    Without chain_storage every day starts from the storage states of the systemvalues and
+    days are solved independently. With chain_storage every day starts from the end states
+    of the day before, so the days are split into one run of consecutive days per worker.
+    Only the first day of every run starts from the systemvalues, a resumed run starts
+    from the end states of its last checkpointed day. The runs are stored in the configuration
+    and reused on resume, so the results do not depend on the workers of the resumed run.
+
+    :param values: systemvalues with the device parameters
+    :param days: list of day indices, all days of the data files by default
+    :param weights: (income_weight, fulfillment_weight), those of schedule_generator by default
+    """
+    from scheduler_daemon import warm_worker
+
+    if weights is None:
+        from schedule_generator import FULFILLMENT_WEIGHT, INCOME_WEIGHT
+
+        weights = (INCOME_WEIGHT, FULFILLMENT_WEIGHT)
+    days = list(range(available_days())) if days is None else sorted(days)
+    directory = os.path.join(directory, name)
+    workers = workers or os.cpu_count() or 1
+    configuration = {
+        "values": input_hash(values),
+        "step_length": step_length,
+        "weights": list(weights),
+        "anchor_mode": anchor_mode,
+        "chain_storage": chain_storage,
+    }
+    if chain_storage:
+        stored = stored_configuration(directory)
+        runs = stored.get("segments") if stored is not None else None
+        if runs is None or sorted(day for run in runs for day in run) != days:
+            # Other days than the stored runs are reported by check_configuration
+            runs = segments(days, workers)
+        configuration["segments"] = runs
+    check_configuration(directory, configuration)
+    done = load_days(directory)
+    print("backtest", name, len(done), "of", len(days), "days done")
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_worker) as pool:
+        if chain_storage:
+            futures = []
+            for run in configuration["segments"]:
+                finished = [day for day in run if day in done]
+                # Days of a run are finished in order, resume after the last one
+                remaining = [day for day in run if day not in done]
+                initial_charge = done[max(finished)]["end_state"] if finished else None
+                if remaining:
+                    futures.append(
+                        pool.submit(
+                            run_segment, remaining, values, step_length, weights, anchor_mode,
+                            initial_charge, directory,
+                        )
+                    )
+            for future in as_completed(futures):
+                for result in future.result():
+                    done[result["day"]] = result
+                    print("day", result["day"], result.get("solver_status", result.get("error")))
+        else:
+            futures = [
+                pool.submit(
+                    run_segment, [day], values, step_length, weights, anchor_mode, None,
+                    directory,
+                )
+                for day in days
+                if day not in done
+            ]
+            for future in as_completed(futures):
+                for result in future.result():
+                    done[result["day"]] = result
+                    print("day", result["day"], result.get("solver_status", result.get("error")))
+    results = [done[day] for day in days if day in done]
+    report = aggregate(results)
+    report["wall_time"] = time.perf_counter() - start
+    report["missing_days"] = [day for day in days if day not in done]
+    with open(os.path.join(directory, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def aggregate(results):
+    """
+    Income and deviation KPIs over the days of a backtest
+    """
+    solved = [result for result in results if "error" not in result]
+    statuses = {}
+    for result in results:
+        status = result.get("solver_status", "error")
+        statuses[status] = statuses.get(status, 0) + 1
+    if not solved:
+        return {"days": len(results), "solved": 0, "statuses": statuses}
+    incomes = [result["income_sum"] for result in solved]
+    deviations = [result["mean_deviation"] for result in solved]
+    return {
+        "days": len(results),
+        "solved": len(solved),
+        "statuses": statuses,
+        "income_sum": sum(incomes),
+        "mean_daily_income": sum(incomes) / len(solved),
+        "worst_daily_income": min(incomes),
+        "mean_deviation": sum(deviations) / len(solved),
+        "max_deviation": max(deviations),
+        "solve_time": sum(result["time"] for result in results),
+    }
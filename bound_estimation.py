@@ -0,0 +1,155 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The root node of the MIP solve gives the relaxation bound strengthened by the cuts of the
+# solver, together with the incumbent the root heuristics found.
+# Node limit per backend that stops right after the root node.
+ROOT_NODE_LIMITS = {"gurobi": 0, "highs": 1, "cbc": 0}
+
+# Weights of the two anchor solves in multi_step_optimization
+ANCHOR_PHASES = {"min_deviation": (0, 1), "max_income": (1, 0)}
+
+
+def root_bounds(phase, timeframe, values, step_length, time_limit=None):
+    """
+    Solves the root node of one anchor model with the configured backend,
+    in the linear formulation if the backend needs it.
+    The bound of the objective is translated back to the anchor,
+    the other anchor of the phase is taken from the root incumbent if there is one.
+    """
+    from schedule_generator import (
+        MAX_INCOME,
+        MIN_INCOME,
+        PEAK_RMSD,
+        build_model,
+    )
+    from solver_backends import SolverOptions, get_backend
+
+    backend = get_backend()
+    income_weight, fulfillment_weight = ANCHOR_PHASES[phase]
+    model = build_model(
+        timeframe,
+        values,
+        step_length,
+        income_weight=income_weight,
+        fulfillment_weight=fulfillment_weight,
+        max_mean_deviation=PEAK_RMSD,
+        min_mean_deviation=0,
+        max_income=MAX_INCOME,
+        min_income=MIN_INCOME,
+        linear=not backend.supports_bilinear,
+    )
+    result = backend.solve(
+        model, SolverOptions(time_limit=time_limit, node_limit=ROOT_NODE_LIMITS.get(backend.name))
+    )
+    if result.bound is None:
+        raise RuntimeError(f"no root bound from {backend.name} ({result.status})")
+    bound = result.bound
+    has_solution = result.has_solution
+    estimate = {}
+    if phase == "min_deviation":
+        # fulfillment_dof = 1 - mean_deviation / PEAK_RMSD
+        estimate["min_mean_deviation"] = max((1 - bound) * PEAK_RMSD, 0)
+        if has_solution:
+            estimate["min_income"] = model.income_sum()
+    else:
+        # income_dof = (income_sum - MIN_INCOME) / (MAX_INCOME - MIN_INCOME)
+        estimate["max_income"] = MIN_INCOME + bound * (MAX_INCOME - MIN_INCOME)
+        if has_solution:
+            estimate["max_mean_deviation"] = model.mean_deviation()
+    return estimate
+
+
+def estimate_anchors(timeframe, values, step_length, deadline=None):
+    """
+    Estimates the normalization anchors from the root relaxations of both anchor models,
+    solved in parallel if the backend is thread safe. Anchors that can not be estimated
+    are taken from the anchor cache, complete estimates are stored there as "estimated".
+    Returns (anchors, source), source is "estimated" if both models gave all their anchors.
+    """
+    from anchors import valid_anchors
+    from schedule_generator import anchor_cache
+    from solver_backends import SolverUnavailable, get_backend
+
+    cached, source = anchor_cache.get(values, timeframe, step_length)
+    try:
+        workers = len(ANCHOR_PHASES) if get_backend().thread_safe else 1
+    except SolverUnavailable as e:
+        print("anchor estimation failed, using anchors from", source, e)
+        return cached, source
+    anchors = dict(cached)
+    time_limit = None if deadline is None else max(deadline - time.time(), 0.1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(root_bounds, phase, timeframe, values, step_length, time_limit)
+            for phase in ANCHOR_PHASES
+        ]
+        estimated = {}
+        for future in futures:
+            try:
+                estimated.update(future.result())
+            except Exception as e:
+                print("anchor estimation failed, using anchors from", source, e)
+    anchors.update(estimated)
+    if not valid_anchors(anchors):
+        print("inconsistent anchor estimates, using anchors from", source)
+        return cached, source
+    if len(estimated) < len(anchors):
+        return anchors, "partly estimated"
+    anchor_cache.store(values, timeframe, step_length, anchors, source="estimated")
+    return anchors, "estimated"
+
+
+def compare_anchor_modes(timeframe, values, step_length, modes=("estimated", "cached")):
+    """
+    Runs the exact three solve method and the given anchor modes on the same systemvalues
+    and reports how far their compromise schedules are from the exact one.
+    The objective of every schedule is evaluated with the exact anchors.
+    """
+    from schedule_generator import (
+        FULFILLMENT_WEIGHT,
+        INCOME_WEIGHT,
+        extract_schedule_from_result,
+        multi_step_optimization,
+    )
+
+    runs = {}
+    for mode in ("exact",) + tuple(modes):
+        start = time.perf_counter()
+        model = multi_step_optimization(timeframe, values, step_length, anchor_mode=mode)
+        runs[mode] = {
+            "time": time.perf_counter() - start,
+            "anchors": model.anchors,
+            "income_sum": model.income_sum(),
+            "mean_deviation": model.mean_deviation(),
+            "schedule": extract_schedule_from_result(model),
+        }
+    exact = runs["exact"]
+    anchors = exact["anchors"]
+    for run in runs.values():
+        run["objective"] = INCOME_WEIGHT * (run["income_sum"] - anchors["min_income"]) / (
+            anchors["max_income"] - anchors["min_income"]
+        ) + FULFILLMENT_WEIGHT * (
+            1
+            - (run["mean_deviation"] - anchors["min_mean_deviation"])
+            / (anchors["max_mean_deviation"] - anchors["min_mean_deviation"])
+        )
+    report = {"exact": {key: exact[key] for key in ["time", "objective", "anchors"]}}
+    for mode in modes:
+        run = runs[mode]
+        report[mode] = {
+            "time": run["time"],
+            "objective": run["objective"],
+            "anchors": run["anchors"],
+            "objective_loss": exact["objective"] - run["objective"],
+            "income_difference": run["income_sum"] - exact["income_sum"],
+            "deviation_difference": run["mean_deviation"] - exact["mean_deviation"],
+            "max_setpoint_difference": {
+                facility: max(
+                    abs(a - b)
+                    for a, b in zip(run["schedule"][facility], exact["schedule"][facility])
+                )
+                for facility in exact["schedule"]
+            },
+        }
+    return report
@@ -0,0 +1,433 @@
+"""
+Command line entry point: python cli.py <command> [options]
+
+Only argparse and json are imported at startup, every command imports what it needs,
+so quick commands like validate and inspect do not load pyomo, numpy or redis.
+"""
+import argparse
+import json
+import os
+import sys
+
+# Seconds a fresh interpreter may take to start and run a quick command
+IMPORT_BUDGET = 0.5
+
+# Modules the quick commands must not import
+HEAVY_MODULES = ["pyomo", "numpy", "redis", "matplotlib", "gurobipy", "highspy"]
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_solver_options(args):
+    # Read by solver_backends.get_backend and instance_capture.capture_directory,
+    # also in worker processes
+    if args.backend is not None:
+        os.environ["SOLVER_BACKEND"] = args.backend
+    if args.capture:
+        os.environ["CAPTURE_INSTANCES"] = "1"
+    if args.no_sample_bounds:
+        os.environ["SAMPLE_SOLVER_BOUNDS"] = "0"
+
+
+def dispatch_options(args):
+    portfolio = None
+    if args.portfolio:
+        from portfolio import DEFAULT_PORTFOLIO as portfolio
+    progress_channel = None
+    if args.anytime:
+        from schedule_generator import PROGRESS_CHANNEL as progress_channel
+    return {
+        "progress_channel": progress_channel,
+        "deadline_seconds": args.deadline,
+        "anchor_mode": args.anchors,
+        "portfolio": portfolio,
+        "pool_size": args.pool,
+        "use_history": args.history,
+    }
+
+
+def schedule(args):
+    apply_solver_options(args)
+    from schedule_generator import connect_and_schedule
+
+    connect_and_schedule(args.timeframe, args.step_length, args.filename, **dispatch_options(args))
+
+
+def daemon(args):
+    apply_solver_options(args)
+    from redis_utils import StreamTransport
+    from scheduler_daemon import SchedulerDaemon
+
+    SchedulerDaemon(
+        args.timeframe,
+        args.step_length,
+        workers=args.workers,
+        transport=StreamTransport() if args.streams else None,
+        **dispatch_options(args),
+    ).run_forever()
+
+
+def systemvalue_files(path):
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json")
+        )
+    return [path]
+
+
+def day_range(text):
+    """
+    Days as "first:last" (last excluded) or a comma separated list
+    """
+    if ":" in text:
+        first, last = text.split(":")
+        return list(range(int(first), int(last)))
+    return [int(day) for day in text.split(",")]
+
+
+def backtest(args):
+    apply_solver_options(args)
+    from backtest import backtest as run_backtest
+
+    report = run_backtest(
+        load_json(args.systemvalues),
+        args.name,
+        days=None if args.days is None else day_range(args.days),
+        step_length=args.step_length,
+        weights=args.weights,
+        anchor_mode=args.anchors,
+        chain_storage=args.chain,
+        workers=args.workers,
+    )
+    print(json.dumps(report, indent=2))
+
+
+def benchmark(args):
+    apply_solver_options(args)
+    from schedule_generator import DEFAULT_ANCHORS, FULFILLMENT_WEIGHT, INCOME_WEIGHT, build_model
+    from solver_backends import SolverOptions, benchmark_backends
+
+    report = benchmark_backends(
+        build_model,
+        dict(
+            timeframe=args.timeframe,
+            values=load_json(args.systemvalues),
+            step_length=args.step_length,
+            income_weight=INCOME_WEIGHT,
+            fulfillment_weight=FULFILLMENT_WEIGHT,
+            **DEFAULT_ANCHORS,
+        ),
+        backends=args.backends,
+        options=SolverOptions(time_limit=args.time_limit, mip_gap=args.mip_gap),
+        repetitions=args.repetitions,
+    )
+    print(json.dumps(report, indent=2))
+
+
+def evaluate(args):
+    from population_evaluation import (
+        evaluator_from_values,
+        population_from_matrices,
+        random_population,
+        throughput,
+    )
+
+    evaluator = evaluator_from_values(args.timeframe, load_json(args.systemvalues), args.step_length)
+    if args.population is None:
+        population = random_population(evaluator, args.random, seed=0)
+        scores = evaluator.evaluate(population)
+    else:
+        population = population_from_matrices(load_json(args.population), args.timeframe)
+        scores = evaluator.evaluate(population)
+        for index in range(len(population)):
+            print(
+                "plan", index, "objective", scores["objective"][index], "income",
+                scores["income"][index], "deviation", scores["mean_deviation"][index],
+                "violation", scores["violation"][index],
+            )
+    print(int(scores["feasible"].sum()), "of", len(population), "plans feasible")
+    print(round(throughput(evaluator, population)), "plans/s")
+
+
+def repair(args):
+    from population_evaluation import evaluator_from_values, population_from_matrices
+    from schedule_repair import repair_matrices
+
+    evaluator = evaluator_from_values(args.timeframe, load_json(args.systemvalues), args.step_length)
+    plans = load_json(args.plans)
+    repaired = repair_matrices(evaluator, plans)
+    for name, matrices in [("before", plans), ("after", repaired)]:
+        scores = evaluator.evaluate(population_from_matrices(matrices, args.timeframe))
+        print(name, int(scores["feasible"].sum()), "of", len(plans), "plans feasible")
+    # The input plans are never overwritten
+    output = args.output or "%s.repaired.json" % os.path.splitext(args.plans)[0]
+    if os.path.abspath(output) == os.path.abspath(args.plans):
+        raise SystemExit("--output must not be the input plan file")
+    with open(output, "w") as f:
+        json.dump(repaired, f)
+    print("repaired plans written to", output)
+
+
+def fallback(args):
+    apply_solver_options(args)
+    values = load_json(args.systemvalues)
+    if args.compare:
+        from fallback_dispatch import quality_report
+
+        report = quality_report(
+            args.timeframe, values, args.step_length, anchor_mode=args.anchors
+        )
+    else:
+        import time
+
+        from fallback_dispatch import fallback_dispatch
+        from population_evaluation import evaluator_from_values
+
+        evaluator = evaluator_from_values(args.timeframe, values, args.step_length)
+        start = time.perf_counter()
+        _, _, report = fallback_dispatch(evaluator)
+        report["time"] = time.perf_counter() - start
+    print(json.dumps(report, indent=2))
+
+
+def tune(args):
+    from solver_tuning import tune as tune_parameters
+
+    tune_parameters(
+        args.directory,
+        backend=args.backend,
+        candidates=args.candidates,
+        time_limit=args.time_limit,
+        workers=args.workers,
+    )
+
+
+def replay(args):
+    from instance_capture import compare_replays, replay_corpus
+
+    replays = replay_corpus(
+        args.directory, backend=args.backend, mode=args.mode, workers=args.workers,
+        report_path=args.report,
+    )
+    baseline = load_json(args.compare) if args.compare else None
+    comparison = compare_replays(baseline, replays)
+    comparison.pop("instances")
+    print(json.dumps(comparison, indent=2))
+
+
+def validate(args):
+    from payload_codec import PayloadError, decode_payload, validate_systemvalues
+
+    failed = False
+    for path in systemvalue_files(args.systemvalues):
+        try:
+            with open(path, "rb") as f:
+                validate_systemvalues(decode_payload(f.read()))
+            print(path, "valid")
+        except (OSError, PayloadError) as e:
+            print(path, "invalid:", e)
+            failed = True
+    return 1 if failed else 0
+
+
+def inspect(args):
+    """
+    Summarizes a result json file, or lists the latest runs of the result store
+    """
+    if args.path is not None and args.path.endswith(".json"):
+        result = load_json(args.path)
+        for key, value in result.items():
+            if isinstance(value, dict):
+                print(key, {name: len(series) for name, series in value.items()})
+            elif isinstance(value, list):
+                print(key, len(value), "entries")
+            else:
+                print(key, value)
+        return 0
+    from result_store import RESULT_STORE_PATH, ResultStore
+
+    with ResultStore(args.path or RESULT_STORE_PATH) as store:
+        for run in store.query_runs(limit=args.limit):
+            print(json.dumps(run))
+    return 0
+
+
+def startup(args):
+    """
+    Checks that a fresh interpreter validates a payload within IMPORT_BUDGET
+    and without importing any of the HEAVY_MODULES, exits with 1 otherwise
+    """
+    import subprocess
+    import tempfile
+    import time
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        f.write("{}")
+    code = (
+        "import contextlib, io, sys, cli\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        f"    cli.main(['validate', {f.name!r}])\n"
+        "print(','.join(m for m in cli.HEAVY_MODULES if m in sys.modules))"
+    )
+    timings = []
+    try:
+        for _ in range(args.repetitions):
+            start = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=directory,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+            timings.append(time.perf_counter() - start)
+    finally:
+        os.remove(f.name)
+    best = min(timings)
+    print("startup", round(best, 3), "s, budget", args.budget, "s")
+    if output:
+        print("heavy modules imported at startup:", output)
+    return 0 if best <= args.budget and not output else 1
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Energy hub scheduling")
+    commands = parser.add_subparsers(dest="command")
+
+    horizon = argparse.ArgumentParser(add_help=False)
+    horizon.add_argument("--timeframe", type=int, default=96, help="number of steps")
+    horizon.add_argument("--step-length", type=int, default=900, help="seconds per step")
+
+    solving = argparse.ArgumentParser(add_help=False)
+    solving.add_argument("--backend", help="solver backend, see solver_backends.py")
+    solving.add_argument("--capture", action="store_true", help="capture the solved instances")
+    solving.add_argument(
+        "--no-sample-bounds", action="store_true", help="only record the final solver bounds"
+    )
+    solving.add_argument("--deadline", type=float, help="seconds until the schedule is due")
+    solving.add_argument("--anchors", default="exact", choices=["exact", "estimated", "cached"])
+    solving.add_argument("--portfolio", action="store_true", help="race solver configurations")
+    solving.add_argument("--anytime", action="store_true", help="publish every incumbent")
+    solving.add_argument("--pool", type=int, help="publish up to this many distinct plans")
+    solving.add_argument(
+        "--history", action="store_true", help="warm start from the nearest past solutions"
+    )
+
+    command = commands.add_parser(
+        "schedule", parents=[horizon, solving], help="schedule one set of systemvalues"
+    )
+    command.add_argument("--filename", default="milp60.json")
+    command.set_defaults(function=schedule)
+
+    command = commands.add_parser(
+        "daemon", parents=[horizon, solving], help="schedule every set of systemvalues"
+    )
+    command.add_argument("workers", type=int, nargs="?", default=1)
+    command.add_argument("--streams", action="store_true", help="read from a redis stream")
+    command.set_defaults(function=daemon)
+
+    command = commands.add_parser("backtest", help="schedule every day of the data files")
+    command.add_argument("systemvalues", help="json file with the device parameters")
+    command.add_argument("--name", default="default", help="resumes the backtest of this name")
+    command.add_argument("--days", help='"first:last" or a comma separated list')
+    command.add_argument("--step-length", type=int, default=900, help="seconds per step")
+    command.add_argument("--weights", type=float, nargs=2, help="income and fulfillment weight")
+    command.add_argument("--anchors", default="exact", choices=["exact", "estimated", "cached"])
+    command.add_argument("--chain", action="store_true", help="chain storage end states")
+    command.add_argument("--workers", type=int)
+    command.add_argument("--backend", help="solver backend, see solver_backends.py")
+    command.add_argument("--capture", action="store_true", help="capture the solved instances")
+    command.add_argument(
+        "--no-sample-bounds", action="store_true", help="only record the final solver bounds"
+    )
+    command.set_defaults(function=backtest)
+
+    command = commands.add_parser(
+        "benchmark", parents=[horizon, solving], help="solve one model with every backend"
+    )
+    command.add_argument("systemvalues", help="json file with systemvalues")
+    command.add_argument("--backends", nargs="*")
+    command.add_argument("--repetitions", type=int, default=1)
+    command.add_argument("--time-limit", type=float)
+    command.add_argument("--mip-gap", type=float)
+    command.set_defaults(function=benchmark)
+
+    command = commands.add_parser(
+        "evaluate", parents=[horizon], help="score activity matrices without a solver"
+    )
+    command.add_argument("systemvalues", help="json file with systemvalues")
+    command.add_argument("population", nargs="?", help="json file with a list of plans")
+    command.add_argument("--random", type=int, default=1000, help="random plans without a file")
+    command.set_defaults(function=evaluate)
+
+    command = commands.add_parser(
+        "repair", parents=[horizon], help="project activity matrices onto the feasible set"
+    )
+    command.add_argument("systemvalues", help="json file with systemvalues")
+    command.add_argument("plans", help="json file with a list of plans")
+    command.add_argument(
+        "--output", help="json file for the repaired plans, <plans>.repaired.json by default"
+    )
+    command.set_defaults(function=repair)
+
+    command = commands.add_parser(
+        "fallback", parents=[horizon], help="rule based schedule without a solver"
+    )
+    command.add_argument("systemvalues", help="json file with systemvalues")
+    command.add_argument("--compare", action="store_true", help="report the gap to the MILP")
+    command.add_argument("--backend", help="solver backend of the comparison")
+    command.add_argument("--capture", action="store_true", help="capture the solved instances")
+    command.add_argument(
+        "--no-sample-bounds", action="store_true", help="only record the final solver bounds"
+    )
+    command.add_argument("--anchors", default="exact", choices=["exact", "estimated", "cached"])
+    command.set_defaults(function=fallback)
+
+    command = commands.add_parser("tune", help="tune solver parameters on captured instances")
+    command.add_argument("directory", nargs="?", default="Daten/instances")
+    command.add_argument("--backend", default="gurobi")
+    command.add_argument("--candidates", type=int, default=20)
+    command.add_argument("--time-limit", type=float, default=60)
+    command.add_argument("--workers", type=int)
+    command.set_defaults(function=tune)
+
+    command = commands.add_parser("replay", help="solve captured instances again")
+    command.add_argument("directory", nargs="?", default="Daten/instances")
+    command.add_argument("--backend")
+    command.add_argument("--mode", default="model", choices=["model", "file"])
+    command.add_argument("--workers", type=int)
+    command.add_argument("--report", help="write the replays to this json file")
+    command.add_argument("--compare", help="json file of an earlier replay to compare with")
+    command.set_defaults(function=replay)
+
+    command = commands.add_parser("validate", help="check systemvalues files")
+    command.add_argument("systemvalues", help="json file or directory of json files")
+    command.set_defaults(function=validate)
+
+    command = commands.add_parser("inspect", help="summarize a result file or the result store")
+    command.add_argument("path", nargs="?")
+    command.add_argument("--limit", type=int, default=10)
+    command.set_defaults(function=inspect)
+
+    command = commands.add_parser("startup", help="check the import time of the entry point")
+    command.add_argument("--budget", type=float, default=IMPORT_BUDGET)
+    command.add_argument("--repetitions", type=int, default=5)
+    command.set_defaults(function=startup)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Without a command the systemvalues are scheduled once, as main.py always did
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["schedule"] + argv
+    args = build_parser().parse_args(argv)
+    return args.function(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,8 @@ class Converter(Component):
     """
     A generic converter component.
     max_powers and min_powers < 0 for inputs, > 0 for outputs
+    linear replaces the product of setpoint and is_active, which equals the setpoint
+    because of active_setpoint, so the model can be solved by MILP solvers.
     """
 
     def __init__(
@@ -23,6 +25,7 @@ class Converter(Component):
         pr_CO2: float = 0,
         CH4_CO2_conversion: float = 0,
         step_length: int = 1,
+        linear: bool = False,
         **kwargs,
     ) -> None:
         super().__init__(types=input_types + output_types, **kwargs)
@@ -37,6 +40,18 @@ class Converter(Component):
         self.thermic_efficiency = thermic_efficiency
         self.min_power = min_powers[output_types[0]]
         self.max_power = max_powers[output_types[0]]
+        # Kept for evaluating schedules without the model, see population_evaluation.py
+        self.max_powers = max_powers
+        self.input_types = input_types
+        self.output_types = output_types
+        self.conversion_factors = conversion_factors
+        self.ramp_up = ramp_up
+        self.ramp_down = ramp_down
+        self.heat_price = heat_price
+        self.is_chp = is_chp
+        self.pr_CO2 = pr_CO2
+        self.CH4_CO2_conversion = CH4_CO2_conversion
+        self.step_length = step_length
 
         no_outflow = [
             (
@@ -67,6 +82,17 @@ class Converter(Component):
             )
             for type, max_power in max_powers.items()
         ]
+        if linear:
+            active_powers = [
+                (
+                    f"{type}_setpoint",
+                    lambda model, t: (
+                        model.get_attribute(self, "setpoint")[t] * max_power
+                        == model.get_attribute(self, f"{type}_power")[t]
+                    ),
+                )
+                for type, max_power in max_powers.items()
+            ]
 
         active_setpoint = [
             (
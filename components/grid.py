@@ -26,6 +26,10 @@ class Grid(Component):
 
         self.values.extend([Value("is_buying", Binary), Value("income", Reals)])
         self.has_cost_objective = True
+        self.energy_cost = energy_cost
+        self.max_selling_power = max_selling_power
+        self.max_buying_power = max_buying_power
+        self.step_length = step_length
 
         positive_powers = [
             (
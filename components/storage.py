@@ -4,7 +4,11 @@ from components.component import Component, Value
 
 
 class Storage(Component):
-    """ """
+    """
+    Storage with a state of charge, charging and discharging through one setpoint.
+    linear replaces the products of is_charging with the powers and the setpoint
+    by the auxiliary charging_setpoint, so the model can be solved by MILP solvers.
+    """
 
     def __init__(
         self,
@@ -16,6 +20,7 @@ class Storage(Component):
         charging_efficiency: float,
         initial_charge: float = 0,
         step_length: int = 3600,
+        linear: bool = False,
     ) -> None:
         super().__init__(name, types=input_types)
 
@@ -24,6 +29,7 @@ class Storage(Component):
         self.capacity = capacity
         self.max_charging_power = max_charging_power
         self.max_discharging_power = max_discharging_power
+        self.step_length = step_length
         self.values.extend(
             [
                 Value("state_of_charge", NonNegativeReals, initialize=initial_charge),
@@ -44,7 +50,7 @@ class Storage(Component):
         negative_power = f"{self.energy_type}_negative_power"
         power = f"{self.energy_type}_power"
 
-        self.constraints = [
+        constraints = [
             (
                 "power_sum",
                 lambda model, t: (
@@ -167,6 +173,63 @@ class Storage(Component):
                 ),
             ),
         ]
+        if linear:
+            self.values.append(Value("charging_setpoint", UnitInterval))
+            bilinear = [
+                "positive_charge",
+                "negative_charge",
+                "upper_positive_setpoint",
+                "negative_setpoint",
+            ]
+            constraints = [
+                constraint for constraint in constraints if constraint[0] not in bilinear
+            ]
+            constraints.extend(
+                [
+                    (
+                        "charging_setpoint_charging",
+                        lambda model, t: (
+                            model.get_attribute(self, "charging_setpoint")[t]
+                            <= model.get_attribute(self, "is_charging")[t]
+                        ),
+                    ),
+                    (
+                        "charging_setpoint_upper",
+                        lambda model, t: (
+                            model.get_attribute(self, "charging_setpoint")[t]
+                            <= model.get_attribute(self, "setpoint")[t]
+                        ),
+                    ),
+                    (
+                        "charging_setpoint_lower",
+                        lambda model, t: (
+                            model.get_attribute(self, "charging_setpoint")[t]
+                            >= model.get_attribute(self, "setpoint")[t]
+                            - (1 - model.get_attribute(self, "is_charging")[t])
+                        ),
+                    ),
+                    (
+                        "upper_positive_setpoint",
+                        lambda model, t: (
+                            model.get_attribute(self, positive_power)[t]
+                            == max_discharging_power
+                            * (
+                                model.get_attribute(self, "setpoint")[t]
+                                - model.get_attribute(self, "charging_setpoint")[t]
+                            )
+                        ),
+                    ),
+                    (
+                        "negative_setpoint",
+                        lambda model, t: (
+                            model.get_attribute(self, negative_power)[t]
+                            == max_charging_power
+                            * model.get_attribute(self, "charging_setpoint")[t]
+                        ),
+                    ),
+                ]
+            )
+        self.constraints = constraints
         """
         self.constraints.append[
             (
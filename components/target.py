@@ -27,6 +27,8 @@ class Target(Component):
         )
         self.has_fulfillment_objective = True
         self.target = time_series
+        self.electricity_prices = electricity_prices
+        self.step_length = step_length
         self.values.extend(
             [
                 Value("limit", NonNegativeReals),
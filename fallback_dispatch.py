@@ -0,0 +1,193 @@
+import time
+
+import numpy as np
+
+from population_evaluation import DEVIATION_STEPS, converter_powers, evaluator_from_values
+from schedule_repair import repair_population
+
+# Setpoint levels between the minimal power and 1 the greedy dispatch tries for every device
+LEVELS = 21
+
+# Passes over the converters in merit order
+ROUNDS = 2
+
+
+def step_objective(evaluator, income, deviation):
+    """
+    Contribution of one step to the weighted objective of IndexedModel.set_objective_with_weights
+
+    :param deviation: absolute deviation from the target times the step length in hours
+    """
+    anchors = evaluator.anchors
+    return evaluator.income_weight * income / (
+        anchors["max_income"] - anchors["min_income"]
+    ) - evaluator.fulfillment_weight * deviation / DEVIATION_STEPS / (
+        anchors["max_mean_deviation"] - anchors["min_mean_deviation"]
+    )
+
+
+def greedy_setpoints(evaluator, levels=LEVELS, rounds=ROUNDS):
+    """
+    Setpoints (resources x time) chosen step by step for the weighted objective of the evaluator.
+
+    Converters are off or run at one of levels setpoints from their minimal power to 1.
+    They are dispatched in merit order, the one with the best value on its own first,
+    every one choosing the level that is best together with the others, for all steps at once.
+    Storages then charge or discharge step by step as far as their state of charge allows.
+    Ramps are left to the repair.
+    """
+    (energy_type, target), = evaluator.targets.items()
+    demand = evaluator.series(target.target)
+    price = evaluator.series(target.electricity_prices)
+    steps = np.arange(evaluator.timeframe)
+    ones = np.ones(evaluator.timeframe)
+
+    def value(income, power):
+        return step_objective(
+            evaluator,
+            income + price * power * evaluator.hours,
+            np.abs(demand + power) * evaluator.hours,
+        )
+
+    candidates = {}
+    for device in evaluator.converters:
+        if device.name not in evaluator.resources:
+            continue
+        ratio = device.min_power / device.max_power
+        level = np.concatenate([[0], np.linspace(ratio, 1, levels)])
+        powers = converter_powers(device, level[:, np.newaxis] * ones)
+        candidates[device.name] = (
+            level,
+            powers.get(energy_type, np.zeros((len(level), evaluator.timeframe))),
+            evaluator.converter_income(device, powers),
+        )
+    order = sorted(
+        candidates,
+        key=lambda name: -value(candidates[name][2], candidates[name][1]).mean(axis=1).max(),
+    )
+    choice = {name: np.zeros(evaluator.timeframe, dtype=int) for name in candidates}
+
+    def chosen(names, index):
+        # Sum of the chosen powers (index 1) or incomes (index 2) of the converters names
+        return sum(
+            (candidates[name][index][choice[name], steps] for name in names), np.zeros_like(ones)
+        )
+
+    for _ in range(rounds):
+        for name in order:
+            others = [other for other in order if other != name]
+            _, power, income = candidates[name]
+            choice[name] = np.argmax(
+                value(income + chosen(others, 2), power + chosen(others, 1)), axis=0
+            )
+
+    setpoints = np.zeros((len(evaluator.resources), evaluator.timeframe))
+    for name, (level, _, _) in candidates.items():
+        setpoints[evaluator.resources.index(name)] = level[choice[name]]
+
+    net = chosen(order, 1)
+    income = chosen(order, 2)
+    level = np.concatenate([[0], np.linspace(-1, 1, 2 * levels - 1)])
+    for device in evaluator.storages:
+        if device.name not in evaluator.resources:
+            continue
+        power_levels = np.where(
+            level > 0, level * device.max_discharging_power, level * device.max_charging_power
+        )
+        charge = float(device.initial_charge)
+        for t in steps:
+            discharging, charging = evaluator.storage_limits(device, charge)
+            power = np.clip(power_levels, -charging, discharging)
+            if device.energy_type == energy_type:
+                power = power[
+                    np.argmax(
+                        step_objective(
+                            evaluator,
+                            income[t] + price[t] * (net[t] + power) * evaluator.hours,
+                            np.abs(demand[t] + net[t] + power) * evaluator.hours,
+                        )
+                    )
+                ]
+                net[t] += power
+            else:
+                power = 0.0
+            setpoints[evaluator.resources.index(device.name), t] = (
+                power / device.max_discharging_power
+                if power > 0
+                else power / device.max_charging_power
+            )
+            charge = evaluator.next_charge(device, charge, power)
+    return setpoints
+
+
+def schedule_scores(evaluator, schedule):
+    """
+    Scores of evaluator.evaluate for one schedule {facility: setpoints}, as plain floats
+    """
+    population = np.array([[schedule[name] for name in evaluator.resources]])
+    scores = evaluator.evaluate(population)
+    return {
+        "objective": float(scores["objective"][0]),
+        "income": float(scores["income"][0]),
+        "mean_deviation": float(scores["mean_deviation"][0]),
+        "violation": float(scores["violation"][0]),
+        "feasible": bool(scores["feasible"][0]),
+    }
+
+
+def fallback_dispatch(evaluator, levels=LEVELS):
+    """
+    Rule based schedule for when no MILP schedule can be found: greedy_setpoints,
+    made feasible by repair_population
+
+    :return: schedule {facility: setpoints} as extract_schedule_from_result returns it,
+        the power sent to the target per step as in run_dispatch, and the schedule_scores
+    """
+    population = repair_population(evaluator, greedy_setpoints(evaluator, levels)[np.newaxis])
+    (energy_type, target), = evaluator.targets.items()
+    power = evaluator.simulate(population)["powers"][target.name][energy_type][0]
+    schedule = {
+        name: population[0, index].tolist() for index, name in enumerate(evaluator.resources)
+    }
+    return schedule, (-power).tolist(), schedule_scores(evaluator, schedule)
+
+
+def objective_gap(milp_objective, fallback_objective):
+    """
+    Share of the MILP objective the fallback schedule falls short of
+    """
+    return (milp_objective - fallback_objective) / max(abs(milp_objective), 1e-10)
+
+
+def quality_report(timeframe, values, step_length, **kwargs):
+    """
+    Solves with the fallback schedule as MIP start and compares both schedules,
+    kwargs are passed to multi_step_optimization
+    """
+    from schedule_generator import (
+        anchor_cache,
+        extract_schedule_from_result,
+        multi_step_optimization,
+        warm_start_from_schedule,
+    )
+
+    evaluator = evaluator_from_values(
+        timeframe, values, step_length, anchors=anchor_cache.get(values, timeframe, step_length)[0]
+    )
+    start = time.perf_counter()
+    schedule, _, _ = fallback_dispatch(evaluator)
+    fallback_time = time.perf_counter() - start
+    start = time.perf_counter()
+    model = multi_step_optimization(
+        timeframe, values, step_length, warm_start=warm_start_from_schedule(schedule), **kwargs
+    )
+    milp_time = time.perf_counter() - start
+    # Both schedules are scored with the anchors of the final solve
+    evaluator.anchors = dict(model.anchors)
+    fallback = schedule_scores(evaluator, schedule)
+    milp = schedule_scores(evaluator, extract_schedule_from_result(model))
+    return {
+        "fallback": dict(fallback, time=fallback_time),
+        "milp": dict(milp, time=milp_time, model_objective=model.obj()),
+        "gap": objective_gap(model.obj(), fallback["objective"]),
+    }
@@ -0,0 +1,240 @@
+import glob
+import json
+import os
+import statistics
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+INSTANCE_DIR = "Daten/instances"
+
+# solve_model captures every instance when this environment variable is set to a directory or 1
+CAPTURE_VARIABLE = "CAPTURE_INSTANCES"
+
+# File formats the models can be written in, MPS needs the linear formulation
+MODEL_FORMATS = ["lp", "mps"]
+
+
+def capture_directory(capture=None):
+    """
+    Directory instances are captured to, None if capturing is off.
+    capture is True, False, a directory or None to use CAPTURE_INSTANCES.
+    """
+    if capture is None:
+        capture = os.environ.get(CAPTURE_VARIABLE)
+        if capture in (None, "", "0"):
+            return None
+        if capture == "1":
+            capture = True
+    if capture is False:
+        return None
+    return INSTANCE_DIR if capture is True else capture
+
+
+def capture_instance(model, build_arguments, options, result, directory=INSTANCE_DIR,
+                     model_format=None):
+    """
+    Writes the model and everything needed to rebuild and compare it into its own directory:
+    model.lp or model.mps and instance.json with the systemvalues, the remaining arguments of
+    build_model, the solver options, the result and the timing.
+    Returns the directory of the instance.
+
+    :param options: SolverOptions of the solve, the warm start is not captured
+    :param result: SolveResult of the solve
+    """
+    linear = build_arguments.get("linear", False)
+    model_format = model_format or ("mps" if linear else "lp")
+    path = os.path.join(
+        directory, time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    )
+    os.makedirs(path, exist_ok=True)
+    start = time.perf_counter()
+    model.write(
+        os.path.join(path, "model." + model_format),
+        io_options={"symbolic_solver_labels": True},
+    )
+    write_time = time.perf_counter() - start
+    instance = {
+        "captured": time.time(),
+        "model_file": "model." + model_format,
+        "build_arguments": {
+            key: value for key, value in build_arguments.items() if key != "values"
+        },
+        "values": build_arguments["values"],
+        "options": {
+            "threads": options.threads,
+            "time_limit": options.time_limit,
+            "mip_gap": options.mip_gap,
+            "extra": options.extra,
+            "warm_start": options.warm_start is not None,
+        },
+        "result": result.as_dict(),
+        "write_time": write_time,
+    }
+    with open(os.path.join(path, "instance.json"), "w") as f:
+        json.dump(instance, f, default=str)
+    return path
+
+
+def load_instance(path):
+    with open(os.path.join(path, "instance.json")) as f:
+        instance = json.load(f)
+    instance["path"] = path
+    return instance
+
+
+def list_instances(directory=INSTANCE_DIR):
+    return sorted(
+        os.path.dirname(path) for path in glob.glob(os.path.join(directory, "*", "instance.json"))
+    )
+
+
+def solve_file(path, backend, options):
+    """
+    Solves a captured model file directly with the solver library,
+    without pyomo and independent of the current model code
+    """
+    start = time.perf_counter()
+    if backend == "gurobi":
+        import gurobipy
+
+        model = gurobipy.read(path)
+        for name, value in options.solver_options(
+            {"mip_gap": "MIPGap", "time_limit": "TimeLimit", "threads": "Threads"}
+        ).items():
+            model.setParam(name, value)
+        model.optimize()
+        has_solution = model.SolCount > 0
+        return {
+            "status": str(model.Status),
+            "objective": model.ObjVal if has_solution else None,
+            "bound": model.ObjBound if has_solution else None,
+            "time": time.perf_counter() - start,
+        }
+    if backend == "highs":
+        import highspy
+
+        highs = highspy.Highs()
+        highs.setOptionValue("output_flag", False)
+        highs.readModel(path)
+        for name, value in options.solver_options(
+            {"mip_gap": "mip_rel_gap", "time_limit": "time_limit", "threads": "threads"}
+        ).items():
+            highs.setOptionValue(name, value)
+        highs.run()
+        info = highs.getInfo()
+        has_solution = info.primal_solution_status == 2
+        return {
+            "status": highs.modelStatusToString(highs.getModelStatus()),
+            "objective": info.objective_function_value if has_solution else None,
+            "bound": info.mip_dual_bound if has_solution else None,
+            "time": time.perf_counter() - start,
+        }
+    raise ValueError(f"model files can be replayed with gurobi or highs, not {backend}")
+
+
+def replay_instance(path, backend=None, mode="model", options=None):
+    """
+    Solves a captured instance again.
+    mode "model" rebuilds the model from the captured systemvalues with the current code,
+    mode "file" solves the captured model file, so only solver parameters can differ.
+
+    :param options: dictionary of SolverOptions arguments, the captured options by default
+    """
+    from solver_backends import SolverOptions, get_backend
+
+    instance = load_instance(path)
+    captured = instance["options"]
+    options = SolverOptions(
+        **(
+            options
+            if options is not None
+            else {key: captured[key] for key in ["threads", "time_limit", "mip_gap", "extra"]}
+        )
+    )
+    backend = get_backend(backend or instance["result"]["backend"])
+    replay = {"path": path, "backend": backend.name, "mode": mode}
+    try:
+        if mode == "file":
+            replay.update(
+                solve_file(os.path.join(path, instance["model_file"]), backend.name, options)
+            )
+        else:
+            from schedule_generator import build_model
+
+            arguments = dict(instance["build_arguments"], values=instance["values"])
+            arguments["linear"] = not backend.supports_bilinear
+            start = time.perf_counter()
+            model = build_model(**arguments)
+            replay["build_time"] = time.perf_counter() - start
+            replay.update(backend.solve(model, options).as_dict())
+    except Exception as e:
+        replay["error"] = str(e)
+    return replay
+
+
+def replay_corpus(directory=INSTANCE_DIR, backend=None, mode="model", options=None,
+                  workers=None, report_path=None):
+    """
+    Replays all instances of a directory in parallel processes.
+    With workers > 1 the solves compete for cores, so pass threads in options for stable timings.
+    Returns the replays and writes them to report_path if given.
+    """
+    paths = list_instances(directory)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        replays = list(
+            pool.map(
+                replay_instance,
+                paths,
+                [backend] * len(paths),
+                [mode] * len(paths),
+                [options] * len(paths),
+            )
+        )
+    if report_path is not None:
+        os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(replays, f, indent=2)
+    return replays
+
+
+def compare_replays(baseline, candidate):
+    """
+    Compares two replays of the same corpus, or the captured results with a replay
+    if baseline is None. Speed-up > 1 means the candidate is faster.
+    """
+    if baseline is None:
+        baseline = [
+            dict(load_instance(replay["path"])["result"], path=replay["path"])
+            for replay in candidate
+        ]
+    baseline = {replay["path"]: replay for replay in baseline}
+    instances = []
+    for replay in candidate:
+        before = baseline.get(replay["path"])
+        if before is None or "error" in replay or "error" in before:
+            continue
+        if before.get("time") is None or replay.get("time") is None:
+            continue
+        instances.append(
+            {
+                "path": replay["path"],
+                "time_before": before["time"],
+                "time_after": replay["time"],
+                "speed_up": before["time"] / max(replay["time"], 1e-9),
+                "objective_difference": (
+                    replay["objective"] - before["objective"]
+                    if replay.get("objective") is not None
+                    and before.get("objective") is not None
+                    else None
+                ),
+            }
+        )
+    speed_ups = [instance["speed_up"] for instance in instances]
+    return {
+        "instances": instances,
+        "compared": len(instances),
+        "median_speed_up": statistics.median(speed_ups) if speed_ups else None,
+        "total_time_before": sum(instance["time_before"] for instance in instances),
+        "total_time_after": sum(instance["time_after"] for instance in instances),
+    }
@@ -1,6 +1,16 @@
 import pickle
+from functools import lru_cache
 
 
 def load_obj(name):
     with open(name, "rb") as f:
-        return pickle.load(f)
\ No newline at end of file
+        return pickle.load(f)
+
+
+@lru_cache(maxsize=None)
+def load_cached_obj(name):
+    """
+    Same as load_obj, but every file is only read once per process.
+    The returned object is shared and must not be modified.
+    """
+    return load_obj(name)
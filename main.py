@@ -1,3 +1,6 @@
-from schedule_generator import *
+import sys
 
-connect_and_schedule(96, 900, "milp60.json")
+from cli import main
+
+# python main.py [command] [options], see cli.py
+sys.exit(main())
@@ -0,0 +1,337 @@
+import ast
+import json
+import os
+import socket
+import struct
+import time
+from array import array
+from numbers import Real
+
+from facility_parameters import facility_dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Tagged payloads start with a NUL byte, which neither json nor python literals can
+HEADER_MARKER = b"\x00"
+
+
+class PayloadError(ValueError):
+    """
+    Raised for messages that can not be decoded or do not match the expected schema
+    """
+
+
+class JsonCodec:
+    """
+    Plain json, sent without header so existing consumers keep working.
+    Uses orjson when it is installed.
+    """
+
+    name = "json"
+
+    def encode(self, payload):
+        if orjson is not None:
+            return orjson.dumps(payload)
+        return json.dumps(payload).encode("UTF-8")
+
+    def decode(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+PLAN_KEYS = ["planID", "childID", "NrOfGenes", "resourcePlan"]
+
+
+class ScheduleCodec:
+    """
+    Compact encoding for activity matrices as created by create_fake_activity_matrix.
+    The plan structure is stored as json, all powerGeneration values in one float64 block.
+    Further keys of a plan are kept in the structure.
+    """
+
+    name = "schedule"
+
+    def encode(self, payload):
+        structure = []
+        values = array("d")
+        for plan in payload:
+            resources = []
+            for resource in plan["resourcePlan"]:
+                resources.append(
+                    [resource["resourceID"], len(resource["powerGeneration"])]
+                )
+                values.extend(float(value) for value in resource["powerGeneration"])
+            entry = [plan["planID"], plan["childID"], plan["NrOfGenes"], resources]
+            extra = {key: value for key, value in plan.items() if key not in PLAN_KEYS}
+            if extra:
+                entry.append(extra)
+            structure.append(entry)
+        header = json.dumps(structure, separators=(",", ":")).encode("UTF-8")
+        return struct.pack("<I", len(header)) + header + values.tobytes()
+
+    def decode(self, data):
+        (length,) = struct.unpack_from("<I", data)
+        structure = json.loads(data[4 : 4 + length])
+        values = array("d")
+        values.frombytes(data[4 + length :])
+        payload = []
+        position = 0
+        for plan_id, child_id, genes, resources, *extra in structure:
+            resource_plan = []
+            for resource_id, steps in resources:
+                resource_plan.append(
+                    {
+                        "resourceID": resource_id,
+                        "powerGeneration": values[position : position + steps].tolist(),
+                    }
+                )
+                position += steps
+            payload.append(
+                {
+                    "planID": plan_id,
+                    "childID": child_id,
+                    "NrOfGenes": genes,
+                    "resourcePlan": resource_plan,
+                    **(extra[0] if extra else {}),
+                }
+            )
+        return payload
+
+
+CODECS = {codec.name: codec for codec in [ScheduleCodec(), MsgpackCodec(), JsonCodec()]}
+
+# Order in which codecs are chosen when publisher and subscriber support several
+CODEC_PREFERENCE = ["msgpack", "json"]
+
+
+def available_codecs():
+    return [
+        name for name in CODECS if name != "msgpack" or msgpack is not None
+    ]
+
+
+def encode_payload(payload, codec="json"):
+    if codec not in available_codecs():
+        raise PayloadError(f"Codec {codec} is not available")
+    data = CODECS[codec].encode(payload)
+    if codec == "json":
+        return data
+    return HEADER_MARKER + codec.encode("UTF-8") + HEADER_MARKER + data
+
+
+def decode_payload(data):
+    """
+    Decodes a message from redis.
+    Tagged messages use the codec named in their header, untagged ones are json,
+    or python literals as older publishers send them.
+    """
+    if isinstance(data, str):
+        data = data.encode("UTF-8")
+    try:
+        if data.startswith(HEADER_MARKER):
+            end = data.index(HEADER_MARKER, 1)
+            codec = data[1:end].decode("UTF-8")
+            if codec not in available_codecs():
+                raise PayloadError(f"Codec {codec} is not available")
+            return CODECS[codec].decode(data[end + 1 :])
+        try:
+            return CODECS["json"].decode(data)
+        except ValueError:
+            return ast.literal_eval(data.decode("UTF-8"))
+    except PayloadError:
+        raise
+    except Exception as e:
+        raise PayloadError(f"Could not decode payload: {e}") from e
+
+
+# Seconds an advertisement of a subscriber is kept, subscribers refresh it while subscribed
+ADVERTISEMENT_TTL = 300
+
+# Seconds a publisher reuses the codec it negotiated for a channel
+NEGOTIATION_INTERVAL = 10
+
+negotiated = {}
+
+
+def subscriber_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def codec_key(channel):
+    """
+    Set of the subscribers of the channel that advertised their codecs
+    """
+    return "codecs:" + channel
+
+
+def advertisement_key(channel, subscriber):
+    return f"codecs:{channel}:{subscriber}"
+
+
+def advertise_codecs(
+    redis_instance, channel, codecs=None, subscriber=None, ttl=ADVERTISEMENT_TTL
+):
+    """
+    Announces which codecs a subscriber of the channel can decode, for ttl seconds
+    """
+    codecs = available_codecs() if codecs is None else codecs
+    subscriber = subscriber_id() if subscriber is None else subscriber
+    pipeline = redis_instance.pipeline(transaction=False)
+    pipeline.set(advertisement_key(channel, subscriber), ",".join(codecs), ex=ttl)
+    pipeline.sadd(codec_key(channel), subscriber)
+    pipeline.execute()
+
+
+def withdraw_codecs(redis_instance, channel, subscriber=None):
+    subscriber = subscriber_id() if subscriber is None else subscriber
+    pipeline = redis_instance.pipeline(transaction=False)
+    pipeline.delete(advertisement_key(channel, subscriber))
+    pipeline.srem(codec_key(channel), subscriber)
+    pipeline.execute()
+
+
+def subscriber_count(redis_instance, channel):
+    """
+    Number of pubsub subscribers of the channel, advertised or not
+    """
+    for name, count in redis_instance.pubsub_numsub(channel):
+        if isinstance(name, bytes):
+            name = name.decode("UTF-8")
+        if name == channel:
+            return count
+    return 0
+
+
+def negotiate_codec(redis_instance, channel):
+    """
+    Picks the preferred codec every subscriber of the channel supports, json otherwise.
+    Subscribers whose advertisement expired are removed. If the channel has more subscribers
+    than live advertisements, some never advertised, e.g. the EMS, and json is used.
+    The choice is reused for NEGOTIATION_INTERVAL seconds.
+    """
+    key = (id(redis_instance), channel)
+    codec, negotiated_at = negotiated.get(key, (None, 0))
+    if codec is not None and time.monotonic() - negotiated_at < NEGOTIATION_INTERVAL:
+        return codec
+    subscribers = [
+        subscriber.decode("UTF-8") if isinstance(subscriber, bytes) else subscriber
+        for subscriber in redis_instance.smembers(codec_key(channel))
+    ]
+    supported = None
+    live = 0
+    if subscribers:
+        advertisements = redis_instance.mget(
+            [advertisement_key(channel, subscriber) for subscriber in subscribers]
+        )
+        expired = [
+            subscriber
+            for subscriber, advertisement in zip(subscribers, advertisements)
+            if advertisement is None
+        ]
+        if expired:
+            redis_instance.srem(codec_key(channel), *expired)
+        for advertisement in advertisements:
+            if advertisement is None:
+                continue
+            live += 1
+            if isinstance(advertisement, bytes):
+                advertisement = advertisement.decode("UTF-8")
+            codecs = set(advertisement.split(","))
+            supported = codecs if supported is None else supported & codecs
+    if supported is not None and subscriber_count(redis_instance, channel) > live:
+        supported = None
+    codec = "json"
+    for name in CODEC_PREFERENCE:
+        if supported is not None and name in supported and name in available_codecs():
+            codec = name
+            break
+    negotiated[key] = (codec, time.monotonic())
+    return codec
+
+
+# Fields of the systemvalues read by model_from_facility_parameters
+REQUIRED_PARAMETERS = {
+    "BHKW": {"metadata": ["P_max_KWK", "P_min_KWK", "t_startup"]},
+    "Electrolyseur": {"input": ["Eta_PEM", "P_max_PEM", "t_ramp_PEM"]},
+    "Methanation": {"input": ["P_max_meth", "P_min_meth", "t_ramp_meth"]},
+    "Battery": {"input": ["P_max_Bat", "EBat", "eta_Bat"]},
+}
+
+# Fields used as divisors when building the model
+POSITIVE_PARAMETERS = {
+    "P_max_KWK",
+    "t_startup",
+    "Eta_PEM",
+    "P_max_PEM",
+    "t_ramp_PEM",
+    "P_max_meth",
+    "t_ramp_meth",
+    "P_max_Bat",
+    "EBat",
+    "eta_Bat",
+}
+
+
+def compile_schema(reference=facility_dict, required=REQUIRED_PARAMETERS):
+    """
+    Builds the list of checks for the parameters structure.
+    The expected types are taken from the defaults in facility_parameters.
+    """
+    checks = []
+    for facility, sections in required.items():
+        for section, keys in sections.items():
+            for key in keys:
+                default = reference[facility][section][key]
+                expected = Real if isinstance(default, Real) else type(default)
+                checks.append(
+                    ((facility, section, key), expected, key in POSITIVE_PARAMETERS)
+                )
+    return checks
+
+
+def compile_validator(checks=None):
+    checks = compile_schema() if checks is None else checks
+
+    def validate(values):
+        if not isinstance(values, dict) or not isinstance(values.get("parameters"), dict):
+            raise PayloadError("Systemvalues need a parameters dictionary")
+        parameters = values["parameters"]
+        for path, expected, positive in checks:
+            value = parameters
+            for depth, key in enumerate(path):
+                if not isinstance(value, dict) or key not in value:
+                    raise PayloadError(
+                        "Missing parameter " + "/".join(path[: depth + 1])
+                    )
+                value = value[key]
+            if isinstance(value, bool) or not isinstance(value, expected):
+                raise PayloadError(
+                    f"Parameter {'/'.join(path)} has type {type(value).__name__}"
+                )
+            if positive and value <= 0:
+                raise PayloadError(f"Parameter {'/'.join(path)} needs to be positive")
+        return values
+
+    return validate
+
+
+validate_systemvalues = compile_validator()
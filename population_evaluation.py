@@ -0,0 +1,365 @@
+import time
+
+import numpy as np
+
+from components.converter import Converter
+from components.grid import Grid
+from components.storage import Storage
+from components.target import Target
+from schedule_generator import (
+    DEFAULT_ANCHORS,
+    FULFILLMENT_WEIGHT,
+    INCOME_WEIGHT,
+    START_KEY,
+    add_prices_to_model,
+    add_target_to_model,
+    facility_names,
+    model_from_facility_parameters,
+    name_to_id,
+)
+
+# Resources along the second axis of a population, in the order of extract_schedule_from_result
+RESOURCES = facility_names
+
+# IndexedModel.set_objective_with_weights divides the deviation sum by 96 for every timeframe
+DEVIATION_STEPS = 96
+
+# Violations up to this size are rounding errors of the solver
+FEASIBILITY_TOLERANCE = 1e-6
+
+id_to_name = {resource_id: name for name, resource_id in name_to_id.items()}
+
+
+def converter_powers(device, setpoint):
+    """
+    Powers of a converter at a setpoint, by energy type, see power_equality.
+    The converters of the hub have a single input.
+    """
+    powers = {
+        energy_type: setpoint * max_power for energy_type, max_power in device.max_powers.items()
+    }
+    converted = sum(
+        powers[energy_type] * device.conversion_factors[energy_type]
+        for energy_type in device.output_types
+    )
+    for energy_type in device.input_types:
+        powers[energy_type] = -converted / (
+            device.conversion_factors[energy_type] * len(device.input_types)
+        )
+    return powers
+
+
+class PopulationEvaluator:
+    """
+    Scores a whole population of schedules in one batch, without building or solving a model.
+
+    A population is an array (plans x resources x time) of setpoints in the order of resources,
+    storage setpoints are negative while charging as in extract_schedule_from_result.
+    The device parameters are read from the components of an IndexedModel, the converters,
+    storages and the target are simulated with the same equations as their constraints.
+    Converters that are not resources stay off. The grid of an energy type takes what the
+    other devices leave, storages that are not resources take what exceeds the grid limits,
+    e.g. the h2 storage covers h2 deficits because the h2 grid only buys.
+    Everything that still does not balance counts as a violation.
+    """
+
+    def __init__(
+        self,
+        model,
+        step_length,
+        income_weight=INCOME_WEIGHT,
+        fulfillment_weight=FULFILLMENT_WEIGHT,
+        anchors=DEFAULT_ANCHORS,
+        resources=RESOURCES,
+    ):
+        self.timeframe = len(model.t)
+        self.step_length = step_length
+        self.hours = step_length / 3600
+        self.income_weight = income_weight
+        self.fulfillment_weight = fulfillment_weight
+        self.anchors = dict(anchors)
+        self.resources = list(resources)
+        self.energy_types = list(model.energy_types)
+        self.converters = [device for device in model.devices if isinstance(device, Converter)]
+        self.storages = [device for device in model.devices if isinstance(device, Storage)]
+        self.grids = {
+            device.energy_types[0]: device for device in model.devices if isinstance(device, Grid)
+        }
+        self.targets = {
+            device.energy_types[0]: device for device in model.devices if isinstance(device, Target)
+        }
+
+    def series(self, values):
+        return np.asarray(values, dtype=float)[: self.timeframe]
+
+    def setpoints(self, population):
+        population = np.asarray(population, dtype=float)
+        if population.ndim == 2:
+            population = population[np.newaxis]
+        if population.shape[1] != len(self.resources) or population.shape[2] < self.timeframe:
+            raise ValueError(
+                f"population of shape {population.shape} does not match "
+                f"{len(self.resources)} resources and {self.timeframe} steps"
+            )
+        return {
+            name: population[:, index, : self.timeframe]
+            for index, name in enumerate(self.resources)
+        }
+
+    def simulate(self, population):
+        """
+        Powers, states of charge, income, deviation and violations of every plan
+
+        :return: dict with powers {device: {energy type: plans x time}},
+            state_of_charge {storage: plans x time}, income and mean_deviation (plans),
+            and violations {kind: plans}, each the summed size of the violated constraints
+        """
+        setpoints = self.setpoints(population)
+        plans = next(iter(setpoints.values())).shape[0]
+        shape = (plans, self.timeframe)
+        powers = {}
+        state_of_charge = {}
+        net = {energy_type: np.zeros(shape) for energy_type in self.energy_types}
+        income = np.zeros(plans)
+        violations = {
+            kind: np.zeros(plans)
+            for kind in ["bounds", "min_power", "ramp_up", "state_of_charge", "balance"]
+        }
+
+        for device in self.converters:
+            setpoint = setpoints.get(device.name, np.zeros(shape))
+            violations["bounds"] += (
+                np.clip(-setpoint, 0, None) + np.clip(setpoint - 1, 0, None)
+            ).sum(axis=1)
+            # min_power and active_setpoint: a converter is off or above its minimal power
+            ratio = device.min_power / device.max_power
+            below = (setpoint > FEASIBILITY_TOLERANCE) & (setpoint < ratio)
+            violations["min_power"] += np.where(
+                below, np.minimum(setpoint, ratio - setpoint), 0
+            ).sum(axis=1)
+            violations["ramp_up"] += np.clip(
+                np.diff(setpoint, axis=1) - device.step_length / device.ramp_up, 0, None
+            ).sum(axis=1)
+
+            device_powers = converter_powers(device, setpoint)
+            powers[device.name] = device_powers
+            for energy_type, power in device_powers.items():
+                net[energy_type] += power
+            income += self.converter_income(device, device_powers).sum(axis=1)
+
+        balancing = []
+        for device in self.storages:
+            if device.name not in setpoints:
+                balancing.append(device)
+                continue
+            setpoint = setpoints[device.name]
+            violations["bounds"] += np.clip(np.abs(setpoint) - 1, 0, None).sum(axis=1)
+            positive = np.clip(setpoint, 0, None) * device.max_discharging_power
+            negative = np.clip(-setpoint, 0, None) * device.max_charging_power
+            # next_state_of_charge: the charge of a step follows the powers of the step before
+            flow = (
+                negative * device.charging_efficiency - positive / device.charging_efficiency
+            ) * device.step_length / 3600
+            charge = device.initial_charge + np.concatenate(
+                [np.zeros((plans, 1)), np.cumsum(flow[:, :-1], axis=1)], axis=1
+            )
+            violations["state_of_charge"] += self.storage_violation(
+                device, charge, positive, negative
+            )
+            powers[device.name] = {device.energy_type: positive - negative}
+            state_of_charge[device.name] = charge
+            net[device.energy_type] += positive - negative
+
+        for energy_type in self.energy_types:
+            if energy_type in self.targets:
+                continue
+            remaining = -net[energy_type]
+            grid = self.grids.get(energy_type)
+            if grid is not None:
+                exchange = np.clip(remaining, grid.max_buying_power, grid.max_selling_power)
+                powers[grid.name] = {energy_type: exchange}
+                remaining = remaining - exchange
+            for device in balancing:
+                if device.energy_type == energy_type:
+                    power, charge = self.balance_storage(device, remaining)
+                    powers[device.name] = {energy_type: power}
+                    state_of_charge[device.name] = charge
+                    remaining = remaining - power
+            violations["balance"] += np.abs(remaining).sum(axis=1) * self.hours
+
+        deviation = np.zeros(plans)
+        for energy_type, target in self.targets.items():
+            power = -net[energy_type]
+            powers[target.name] = {energy_type: power}
+            deviation += np.abs(self.series(target.target) - power).sum(axis=1) * self.hours
+            income += (self.series(target.electricity_prices) * -power).sum(axis=1) * self.hours
+
+        return {
+            "powers": powers,
+            "state_of_charge": state_of_charge,
+            "income": income,
+            "mean_deviation": deviation / DEVIATION_STEPS,
+            "violations": violations,
+        }
+
+    def storage_violation(self, device, charge, positive, negative):
+        """
+        Summed violation of capacity, output_only_charge and cant_overcharge
+        """
+        steps = 3600 / device.step_length
+        efficiency = device.charging_efficiency
+        return (
+            np.clip(-charge, 0, None)
+            + np.clip(charge - device.capacity, 0, None)
+            + np.clip(positive / efficiency * steps - charge, 0, None)
+            + np.clip(negative * efficiency * steps - (device.capacity - charge), 0, None)
+        ).sum(axis=1)
+
+    def converter_income(self, device, powers):
+        """
+        Income of a converter per step, see its income constraint
+        """
+        if device.is_chp:
+            methane = powers["methane"]
+            return (
+                -methane * device.thermic_efficiency * self.series(device.heat_price)
+                + methane * device.pr_CO2 * device.CH4_CO2_conversion
+            ) * self.hours
+        if "methane" in device.output_types:
+            return powers["methane"] * device.pr_CO2 * device.CH4_CO2_conversion * self.hours
+        return np.zeros_like(powers[device.output_types[0]])
+
+    def storage_limits(self, device, charge):
+        """
+        Largest discharging and charging power at a state of charge: output_only_charge and
+        cant_overcharge, and a charge within 0 and the capacity after the step
+        """
+        hours = device.step_length / 3600
+        efficiency = device.charging_efficiency
+        discharging = np.minimum(
+            device.max_discharging_power, charge * efficiency * min(hours, 1 / hours)
+        )
+        charging = np.minimum(
+            device.max_charging_power,
+            (device.capacity - charge) / efficiency / max(hours, 1 / hours),
+        )
+        return np.clip(discharging, 0, None), np.clip(charging, 0, None)
+
+    def next_charge(self, device, charge, power):
+        """
+        next_state_of_charge after a step with power, positive while discharging
+        """
+        positive = np.clip(power, 0, None)
+        negative = np.clip(-power, 0, None)
+        efficiency = device.charging_efficiency
+        return charge + (negative * efficiency - positive / efficiency) * device.step_length / 3600
+
+    def balance_storage(self, device, demand):
+        """
+        Discharges (demand > 0) or charges (demand < 0) a storage as far as its constraints allow,
+        step by step for all plans at once
+        """
+        power = np.zeros(demand.shape)
+        charge = np.zeros(demand.shape)
+        current = np.full(demand.shape[0], float(device.initial_charge))
+        for t in range(self.timeframe):
+            charge[:, t] = current
+            discharging, charging = self.storage_limits(device, current)
+            power[:, t] = np.clip(demand[:, t], -charging, discharging)
+            current = self.next_charge(device, current, power[:, t])
+        return power, charge
+
+    def evaluate(self, population):
+        """
+        Scores of every plan: income, mean_deviation, objective as in
+        IndexedModel.set_objective_with_weights, violation and feasible
+        """
+        result = self.simulate(population)
+        anchors = self.anchors
+        income_dof = (result["income"] - anchors["min_income"]) / (
+            anchors["max_income"] - anchors["min_income"]
+        )
+        fulfillment_dof = 1 - (result["mean_deviation"] - anchors["min_mean_deviation"]) / (
+            anchors["max_mean_deviation"] - anchors["min_mean_deviation"]
+        )
+        violation = sum(result["violations"].values())
+        return {
+            "income": result["income"],
+            "mean_deviation": result["mean_deviation"],
+            "objective": income_dof * self.income_weight + fulfillment_dof * self.fulfillment_weight,
+            "violation": violation,
+            "feasible": violation <= FEASIBILITY_TOLERANCE,
+            "violations": result["violations"],
+        }
+
+
+def evaluator_from_values(timeframe, values, step_length, **kwargs):
+    """
+    Evaluator with the devices, prices and target schedule_generator would build for values,
+    kwargs are passed to PopulationEvaluator
+    """
+    start = values.get(START_KEY, 0)
+    model = model_from_facility_parameters(values, timeframe, step_length)
+    model = add_prices_to_model(model, timeframe, step_length, start)
+    model = add_target_to_model(model, timeframe, step_length, start)
+    return PopulationEvaluator(model, step_length, **kwargs)
+
+
+def population_from_matrices(plans, timeframe, resources=RESOURCES):
+    """
+    Population array of a list of plans in the gleam format of create_fake_activity_matrix,
+    resources missing in a plan are zero
+    """
+    population = np.zeros((len(plans), len(resources), timeframe))
+    index = {name: position for position, name in enumerate(resources)}
+    for plan_index, plan in enumerate(plans):
+        for resource in plan["resourcePlan"]:
+            name = id_to_name.get(str(resource["resourceID"]))
+            if name in index:
+                generation = np.asarray(resource["powerGeneration"], dtype=float)[:timeframe]
+                population[plan_index, index[name], : len(generation)] = generation
+    return population
+
+
+def matrices_from_population(population, resources=RESOURCES):
+    """
+    Plans in the gleam format of create_fake_activity_matrix, one per row of the population
+    """
+    return [
+        {
+            "planID": plan_index,
+            "childID": 0,
+            "NrOfGenes": 0,
+            "resourcePlan": [
+                {"resourceID": name_to_id[name], "powerGeneration": plan[index].tolist()}
+                for index, name in enumerate(resources)
+            ],
+        }
+        for plan_index, plan in enumerate(np.asarray(population, dtype=float))
+    ]
+
+
+def random_population(evaluator, plans, seed=None):
+    """
+    Uniform setpoints, in [-1, 1] for storages and [0, 1] for converters
+    """
+    generator = np.random.default_rng(seed)
+    population = generator.uniform(0, 1, (plans, len(evaluator.resources), evaluator.timeframe))
+    storages = [device.name for device in evaluator.storages]
+    for index, name in enumerate(evaluator.resources):
+        if name in storages:
+            population[:, index] = population[:, index] * 2 - 1
+    return population
+
+
+def throughput(evaluator, population, repetitions=5):
+    """
+    Plans evaluated per second, best of repetitions
+    """
+    best = None
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        evaluator.evaluate(population)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(population) / best
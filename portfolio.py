@@ -0,0 +1,170 @@
+import multiprocessing
+import os
+import queue
+import sqlite3
+import time
+
+from pyomo.core.base import Var
+
+from result_store import RESULT_STORE_PATH, ResultStore
+from solver_backends import ACCEPTED_TERMINATIONS, BACKENDS, SolverOptions
+
+# The wins are counted in the result store, which several processes can update at once
+PORTFOLIO_STATS_PATH = RESULT_STORE_PATH
+
+# Seconds between checks whether the racing processes are still alive
+RESULT_POLL_INTERVAL = 1
+
+# backend is a name of solver_backends.BACKENDS, options are passed to the solver unchanged
+DEFAULT_PORTFOLIO = [
+    {"name": "gurobi", "backend": "gurobi", "options": {}},
+    {"name": "gurobi-feasibility", "backend": "gurobi", "options": {"MIPFocus": 1}},
+    {"name": "gurobi-bound", "backend": "gurobi", "options": {"MIPFocus": 2}},
+    {"name": "highs", "backend": "highs", "options": {}},
+    {"name": "cbc", "backend": "cbc", "options": {}},
+]
+
+DEFAULT_GAP = 1e-4
+
+
+class PortfolioFailed(RuntimeError):
+    """
+    Raised when no configuration of the portfolio found a solution
+    """
+
+
+def instance_class(timeframe, step_length, income_weight, fulfillment_weight):
+    return f"{timeframe}x{step_length}:{income_weight}/{fulfillment_weight}"
+
+
+def solver_options(config, mip_gap=None, time_limit=None, threads=None):
+    return SolverOptions(
+        threads=threads, time_limit=time_limit, mip_gap=mip_gap, extra=config["options"]
+    )
+
+
+def race_worker(config, build_arguments, options, results):
+    """
+    Builds the model in its own process, solves it with one configuration
+    and puts the variable values on the results queue.
+    Backends that can not handle bilinear terms get the linear formulation.
+    """
+    try:
+        from schedule_generator import build_model
+
+        backend = BACKENDS[config["backend"]]
+        arguments = dict(build_arguments, linear=not backend.supports_bilinear)
+        model = build_model(**arguments)
+        result = backend.solve(model, options)
+        if not result.has_solution or result.status not in ACCEPTED_TERMINATIONS:
+            raise RuntimeError(f"no solution ({result.status})")
+        results.put(
+            {
+                "name": config["name"],
+                "status": result.status,
+                "gap": result.gap,
+                "time": result.time,
+                "values": {
+                    var.name: var.extract_values()
+                    for var in model.component_objects(Var, active=True)
+                },
+            }
+        )
+    except Exception as e:
+        results.put({"name": config["name"], "error": str(e)})
+
+
+def race(build_arguments, portfolio=None, mip_gap=DEFAULT_GAP, deadline=None, threads=None):
+    """
+    Solves the model described by build_arguments with every configuration of the portfolio
+    in parallel processes. The first result within mip_gap wins and the other processes are killed.
+    Results with a larger gap are only used if no configuration reaches the gap before the deadline.
+    Processes that die without a result, e.g. killed for their memory, count as failed.
+    """
+    portfolio = order_by_wins(DEFAULT_PORTFOLIO if portfolio is None else portfolio, build_arguments)
+    threads = threads or max(1, (os.cpu_count() or 1) // len(portfolio))
+    time_limit = None if deadline is None else max(deadline - time.time(), 0.1)
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=race_worker,
+            args=(
+                config,
+                build_arguments,
+                solver_options(config, mip_gap, time_limit, threads),
+                results,
+            ),
+            daemon=True,
+        )
+        for config in portfolio
+    ]
+    for process in processes:
+        process.start()
+    winner = None
+    fallback = None
+    errors = []
+    received = 0
+    try:
+        while received < len(processes):
+            wait = RESULT_POLL_INTERVAL
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                wait = min(wait, remaining)
+            try:
+                result = results.get(timeout=wait)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes) and results.empty():
+                    errors.append(("portfolio", "processes ended without a result"))
+                    break
+                continue
+            received += 1
+            if "error" in result:
+                errors.append((result["name"], result["error"]))
+                continue
+            if result["gap"] is None or result["gap"] <= mip_gap:
+                winner = result
+                break
+            if fallback is None or result["gap"] < fallback["gap"]:
+                fallback = result
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+            process.join()
+    winner = winner or fallback
+    if winner is None:
+        raise PortfolioFailed(f"No configuration of the portfolio found a solution: {errors}")
+    record_win(build_arguments, winner["name"])
+    return winner
+
+
+def stats_key(build_arguments):
+    return instance_class(
+        build_arguments["timeframe"],
+        build_arguments["step_length"],
+        build_arguments["income_weight"],
+        build_arguments["fulfillment_weight"],
+    )
+
+
+def record_win(build_arguments, name, path=PORTFOLIO_STATS_PATH):
+    try:
+        with ResultStore(path) as store:
+            store.record_win(stats_key(build_arguments), name)
+    except sqlite3.Error as e:
+        print("recording the portfolio win failed", e)
+
+
+def order_by_wins(portfolio, build_arguments, path=PORTFOLIO_STATS_PATH):
+    """
+    Starts the configurations that won most often for the instance class first
+    """
+    try:
+        with ResultStore(path) as store:
+            wins = store.portfolio_wins(stats_key(build_arguments))
+    except sqlite3.Error as e:
+        print("reading the portfolio wins failed", e)
+        wins = {}
+    return sorted(portfolio, key=lambda config: -wins.get(config["name"], 0))
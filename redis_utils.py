@@ -1,39 +1,383 @@
-import ast
+import os
 import redis
+import socket
 import sys
 import time
-import json
+import threading
 
+from payload_codec import (
+    ADVERTISEMENT_TTL,
+    PayloadError,
+    advertise_codecs,
+    decode_payload,
+    encode_payload,
+    negotiate_codec,
+    withdraw_codecs,
+)
+from tracing import CORRELATION_KEY, CORRELATION_SUFFIX, span, tag_message
 
-def engage_redis(cluster, channel):
-    if cluster:
-        r = redis.StrictRedis(host="redis.webis", port=6379)
-    else:
-        r = redis.StrictRedis(host="127.0.0.1", port=6379)
-    stream = r.pubsub()
-    stream.subscribe(channel)
-    return r, stream
+# Maximum time a single blocking read waits before checking timeout and cancellation
+BLOCK_INTERVAL = 1
+CANCEL_CHECK_INTERVAL = 0.1
 
 
-def send_redis(schedule, redis_instance):
-    redis_instance.publish("algorithm.EA.epoch.1", json.dumps(schedule))
+REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+CLUSTER_HOST = "redis.webis"
 
 
-def wait_for_stream(stream):
-    i = 0
+class RedisConnection:
+    """
+    Client on a shared connection pool with one reusable pubsub per channel.
+    A client can be passed in directly, e.g. a local redis stand-in for tests.
+    The codecs this process decodes are advertised for every subscribed channel
+    and refreshed in the background while the subscription lasts, see payload_codec.py.
+    """
+
+    pools = {}
+
+    def __init__(self, host=None, port=None, client=None):
+        self.host = REDIS_HOST if host is None else host
+        self.port = REDIS_PORT if port is None else port
+        if client is None:
+            key = (self.host, self.port)
+            if key not in RedisConnection.pools:
+                RedisConnection.pools[key] = redis.ConnectionPool(
+                    host=self.host, port=self.port
+                )
+            client = redis.StrictRedis(connection_pool=RedisConnection.pools[key])
+        self.client = client
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.refresher = None
+
+    def subscribe(self, channel):
+        with self.lock:
+            if channel not in self.subscriptions:
+                stream = self.client.pubsub()
+                stream.subscribe(channel)
+                self.subscriptions[channel] = stream
+                self.advertise(channel)
+                if self.refresher is None:
+                    self.refresher = threading.Thread(target=self.refresh, daemon=True)
+                    self.refresher.start()
+            return self.subscriptions[channel]
+
+    def unsubscribe(self, channel):
+        with self.lock:
+            stream = self.subscriptions.pop(channel, None)
+        if stream is not None:
+            stream.close()
+            try:
+                withdraw_codecs(self.client, channel)
+            except redis.RedisError as e:
+                print("withdrawing the codecs of", channel, "failed", e)
+
+    def advertise(self, channel):
+        try:
+            advertise_codecs(self.client, channel)
+        except redis.RedisError as e:
+            print("advertising the codecs of", channel, "failed", e)
+
+    def refresh(self):
+        while True:
+            time.sleep(ADVERTISEMENT_TTL / 3)
+            with self.lock:
+                channels = list(self.subscriptions)
+            for channel in channels:
+                self.advertise(channel)
+
+    def publish(self, channel, payload, codec=None):
+        send_redis(payload, self.client, channel=channel, codec=codec)
+
+    def publish_many(self, messages, codec=None):
+        """
+        Publishes several (channel, payload) pairs in one pipelined round trip
+        """
+        codecs = {}
+        pipeline = self.client.pipeline(transaction=False)
+        for channel, payload in messages:
+            if channel not in codecs:
+                codecs[channel] = (
+                    negotiate_codec(self.client, channel) if codec is None else codec
+                )
+            pipeline.publish(channel, encode_payload(payload, codecs[channel]))
+        return pipeline.execute()
+
+    def close(self):
+        for channel in list(self.subscriptions):
+            self.unsubscribe(channel)
+
+
+connections = {}
+
+
+def get_connection(host=None, port=None, client=None):
+    """
+    Returns the shared connection for host and port, creating it on first use
+    """
+    key = (REDIS_HOST if host is None else host, REDIS_PORT if port is None else port)
+    if client is not None:
+        connections[key] = RedisConnection(*key, client=client)
+    elif key not in connections:
+        connections[key] = RedisConnection(*key)
+    return connections[key]
+
+
+def engage_redis(cluster, channel, host=None, port=None):
+    """
+    Returns the shared client and the subscription for the channel.
+    cluster selects the cluster host, otherwise host and port default to REDIS_HOST and REDIS_PORT.
+    """
+    connection = get_connection(CLUSTER_HOST if cluster else host, port)
+    return connection.client, connection.subscribe(channel)
+
+
+class StreamTransport:
+    """
+    Work queue on a redis stream with a consumer group, an alternative to pubsub.
+    Every entry is delivered to one consumer of the group and stays pending until it is acknowledged,
+    entries of stalled consumers are reclaimed after claim_idle seconds.
+    A consumer keeps the entries it is still working on by calling heartbeat with their ids.
+    Entries that were delivered more than max_deliveries times are moved to the dead_letter stream.
+    """
+
+    def __init__(
+        self,
+        stream="Systemvalues.stream",
+        group="scheduler",
+        consumer=None,
+        connection=None,
+        claim_idle=300,
+        codec="json",
+        maxlen=10000,
+        max_deliveries=3,
+        dead_letter=None,
+    ):
+        self.stream = stream
+        self.group = group
+        self.consumer = (
+            f"{socket.gethostname()}-{os.getpid()}" if consumer is None else consumer
+        )
+        self.connection = get_connection() if connection is None else connection
+        self.client = self.connection.client
+        self.claim_idle = claim_idle
+        self.codec = codec
+        self.maxlen = maxlen
+        self.max_deliveries = max_deliveries
+        self.dead_letter = stream + ".dead" if dead_letter is None else dead_letter
+        self.last_heartbeat = 0
+        try:
+            self.client.xgroup_create(stream, group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def add(self, payload):
+        return self.client.xadd(
+            self.stream,
+            {"data": encode_payload(payload, self.codec)},
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+
+    def heartbeat(self, entry_ids):
+        """
+        Resets the idle time of entries this consumer still works on, so they are not reclaimed.
+        Sent at most every claim_idle / 3 seconds.
+        """
+        now = time.monotonic()
+        if not entry_ids or now - self.last_heartbeat < self.claim_idle / 3:
+            return
+        self.last_heartbeat = now
+        self.client.xclaim(
+            self.stream, self.group, self.consumer, 0, list(entry_ids), justid=True
+        )
+
+    def deliveries(self, entry_id):
+        pending = self.client.xpending_range(
+            self.stream, self.group, min=entry_id, max=entry_id, count=1
+        )
+        return pending[0]["times_delivered"] if pending else 0
+
+    def bury(self, entry_id, fields, deliveries):
+        """
+        Moves an entry to the dead letter stream and acknowledges it
+        """
+        print("moving entry", entry_id, "to", self.dead_letter, "after", deliveries, "deliveries")
+        self.client.xadd(
+            self.dead_letter,
+            dict(fields, entry_id=entry_id, deliveries=deliveries),
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+        self.ack(entry_id)
+
+    def reclaim(self, count=1, exclude=()):
+        """
+        Takes over entries other consumers did not acknowledge within claim_idle.
+        Entries in exclude are being worked on by this consumer and are left out,
+        entries delivered too often are moved to the dead letter stream.
+        """
+        response = self.client.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=int(self.claim_idle * 1000),
+            start_id="0-0",
+            count=count,
+        )
+        entries = []
+        for entry_id, fields in response[1]:
+            if entry_id in exclude or fields is None:
+                continue
+            deliveries = self.deliveries(entry_id)
+            if deliveries > self.max_deliveries:
+                self.bury(entry_id, fields, deliveries)
+                continue
+            entries.append((entry_id, fields))
+        return entries
+
+    def read(self, count=1, block=1, exclude=()):
+        """
+        Returns up to count (entry_id, payload) pairs, reclaimed entries first.
+        Waits at most block seconds for new entries.
+        Entries that can not be decoded are acknowledged and skipped.
+
+        :param exclude: ids of entries this consumer is still working on, see reclaim
+        """
+        entries = self.reclaim(count, exclude)
+        if not entries:
+            response = self.client.xreadgroup(
+                self.group,
+                self.consumer,
+                {self.stream: ">"},
+                count=count,
+                block=int(block * 1000),
+            )
+            entries = response[0][1] if response else []
+        result = []
+        for entry_id, fields in entries:
+            try:
+                result.append((entry_id, decode_payload(fields[b"data"])))
+            except (KeyError, PayloadError) as e:
+                print("skipping entry", entry_id, e)
+                self.ack(entry_id)
+        return result
+
+    def ack(self, entry_id):
+        self.client.xack(self.stream, self.group, entry_id)
+
+    def pending(self):
+        return self.client.xpending(self.stream, self.group)
+
+
+def send_redis(
+    schedule, redis_instance, channel="algorithm.EA.epoch.1", codec=None, correlation_id=None
+):
+    """
+    :param codec: name of the payload codec, negotiated with the subscribers if None
+    :param correlation_id: added to a dict message, for other messages it is published
+        on the channel with tracing.CORRELATION_SUFFIX right before them
+    """
+    if codec is None:
+        codec = negotiate_codec(redis_instance, channel)
+    if correlation_id is None or isinstance(schedule, dict):
+        redis_instance.publish(
+            channel, encode_payload(tag_message(schedule, correlation_id), codec)
+        )
+        return
+    pipeline = redis_instance.pipeline(transaction=False)
+    pipeline.publish(
+        channel + CORRELATION_SUFFIX,
+        encode_payload({CORRELATION_KEY: correlation_id, "channel": channel}, "json"),
+    )
+    pipeline.publish(channel, encode_payload(schedule, codec))
+    pipeline.execute()
+
+
+def drain_messages(stream):
+    """
+    Discards the messages buffered on a subscription, so the next read waits for a new one.
+    Returns the number of discarded messages.
+    """
+    discarded = 0
     while True:
-        values = stream.get_message()
-        if not values:
-            i = loading_symbol("Waiting for new Values.", i)
-        elif values["data"] != 1:
-            break
-    values = ast.literal_eval(values["data"].decode("UTF-8"))
+        message = stream.get_message(timeout=0)
+        if message is None:
+            return discarded
+        if message["type"] == "message":
+            discarded += 1
+
+
+def wait_for_stream(
+    stream, timeout=None, cancel=None, spinner=True, validate=None, stage="message"
+):
+    """
+    Blocks until a message arrives on the subscribed channel and returns its data.
+    The socket read itself blocks, so a new message is handled as soon as it arrives.
+
+    :param timeout: seconds to wait before a TimeoutError is raised, None waits forever
+    :param cancel: threading.Event, waiting stops and returns None once it is set
+    :param spinner: show the loading symbol while waiting
+    :param validate: called with the decoded message, raises PayloadError if it is malformed
+    :param stage: the waiting and decoding are traced as wait_<stage> and decode_<stage>
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    loading = Spinner("Waiting for new Values.") if spinner else None
+    try:
+        with span("wait_" + stage):
+            values = wait_for_message(stream, deadline, timeout, cancel)
+    finally:
+        if loading is not None:
+            loading.stop()
+    if values is None:
+        return None
+    with span("decode_" + stage):
+        values = decode_payload(values["data"])
+        if validate is not None:
+            validate(values)
     return values
 
 
-def loading_symbol(message, counter=0):
-    sys.stdout.write(message + " " + "|/-\\"[(counter % 4)])
-    sys.stdout.flush()
-    time.sleep(1)
-    sys.stdout.write((len(message) + 2) * "\b")
-    return counter + 1
+def wait_for_message(stream, deadline, timeout, cancel):
+    """
+    Returns the next message of the subscription, None once cancel is set
+    """
+    while True:
+        if cancel is not None and cancel.is_set():
+            return None
+        read_timeout = CANCEL_CHECK_INTERVAL if cancel is not None else BLOCK_INTERVAL
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No message received within %s seconds" % timeout)
+            read_timeout = min(read_timeout, remaining)
+        message = stream.get_message(ignore_subscribe_messages=True, timeout=read_timeout)
+        if message and message["data"] != 1:
+            return message
+
+
+class Spinner:
+    """
+    Shows the loading symbol in a background thread, independent of the receive path
+    """
+
+    def __init__(self, message, interval=0.25):
+        self.message = message
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        counter = 0
+        while not self.stopped.wait(self.interval):
+            sys.stdout.write(self.message + " " + "|/-\\"[(counter % 4)])
+            sys.stdout.flush()
+            sys.stdout.write((len(self.message) + 2) * "\b")
+            counter += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
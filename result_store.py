@@ -0,0 +1,353 @@
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from array import array
+
+from tracing import CORRELATION_KEY
+
+RESULT_STORE_PATH = "Daten/results/results.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    input_hash TEXT,
+    income_weight REAL,
+    fulfillment_weight REAL,
+    solver_status TEXT,
+    income_sum REAL,
+    mean_deviation REAL,
+    filename TEXT,
+    ems BLOB
+);
+CREATE INDEX IF NOT EXISTS runs_timestamp ON runs (timestamp);
+CREATE INDEX IF NOT EXISTS runs_input_hash ON runs (input_hash);
+CREATE INDEX IF NOT EXISTS runs_weights ON runs (income_weight, fulfillment_weight);
+CREATE INDEX IF NOT EXISTS runs_solver_status ON runs (solver_status);
+CREATE TABLE IF NOT EXISTS series (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (run_id, kind, resource)
+);
+CREATE TABLE IF NOT EXISTS anchors (
+    key TEXT PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    source TEXT NOT NULL,
+    min_mean_deviation REAL,
+    max_mean_deviation REAL,
+    min_income REAL,
+    max_income REAL
+);
+CREATE INDEX IF NOT EXISTS anchors_timestamp ON anchors (timestamp);
+CREATE TABLE IF NOT EXISTS portfolio_wins (
+    instance_class TEXT NOT NULL,
+    name TEXT NOT NULL,
+    wins INTEGER NOT NULL,
+    PRIMARY KEY (instance_class, name)
+);
+"""
+
+ANCHOR_COLUMNS = ["min_mean_deviation", "max_mean_deviation", "min_income", "max_income"]
+
+RUN_COLUMNS = [
+    "id",
+    "timestamp",
+    "input_hash",
+    "income_weight",
+    "fulfillment_weight",
+    "solver_status",
+    "income_sum",
+    "mean_deviation",
+    "filename",
+]
+
+
+def input_hash(values):
+    """
+    Stable hash of the systemvalues a run was computed from, without the correlation id
+    """
+    if isinstance(values, dict) and CORRELATION_KEY in values:
+        values = {key: value for key, value in values.items() if key != CORRELATION_KEY}
+    payload = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("UTF-8")).hexdigest()
+
+
+def pack_series(values):
+    return array("d", [float(value) for value in values]).tobytes()
+
+
+def unpack_series(blob):
+    values = array("d")
+    values.frombytes(blob)
+    return values.tolist()
+
+
+class ResultStore:
+    """
+    Local index of scheduling runs backed by SQLite.
+    Scalar data of a run (timestamp, input hash, weights, solver status, KPIs) lives in
+    indexed columns, so queries and aggregations never have to read the schedules.
+    Every schedule row is stored as its own float64 blob in the series table.
+    """
+
+    def __init__(self, path=RESULT_STORE_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_run(
+        self,
+        input_hash,
+        income_weight,
+        fulfillment_weight,
+        solver_status,
+        income_sum,
+        mean_deviation,
+        milp_power,
+        milp_schedule,
+        ems_schedule=None,
+        timestamp=None,
+        filename=None,
+    ):
+        """
+        Stores one run and returns its id
+
+        :param milp_power: resulting power at the target for every time step
+        :param milp_schedule: setpoints per facility as returned by extract_schedule_from_result
+        :param ems_schedule: schedule received from the EMS, stored as compressed json
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (timestamp, input_hash, income_weight, fulfillment_weight,"
+                " solver_status, income_sum, mean_deviation, filename, ems)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time() if timestamp is None else timestamp,
+                    input_hash,
+                    income_weight,
+                    fulfillment_weight,
+                    solver_status,
+                    income_sum,
+                    mean_deviation,
+                    filename,
+                    None
+                    if ems_schedule is None
+                    else zlib.compress(json.dumps(ems_schedule).encode("UTF-8")),
+                ),
+            )
+            run_id = cursor.lastrowid
+            rows = [(run_id, "milp_power", "target", pack_series(milp_power))]
+            rows.extend(
+                (run_id, "milp_schedule", facility, pack_series(setpoints))
+                for facility, setpoints in milp_schedule.items()
+            )
+            self.connection.executemany(
+                "INSERT INTO series (run_id, kind, resource, data) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        return run_id
+
+    def get_run(self, run_id):
+        """
+        Returns a run including its schedules, None if it does not exist
+        """
+        row = self.connection.execute(
+            f"SELECT {', '.join(RUN_COLUMNS)}, ems FROM runs WHERE id = ?", (run_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        run = dict(zip(RUN_COLUMNS, row[:-1]))
+        run["ems"] = None if row[-1] is None else json.loads(zlib.decompress(row[-1]))
+        run["milp_schedule"] = {}
+        for kind, resource, data in self.connection.execute(
+            "SELECT kind, resource, data FROM series WHERE run_id = ?", (run_id,)
+        ):
+            if kind == "milp_power":
+                run["milp_power"] = unpack_series(data)
+            else:
+                run["milp_schedule"][resource] = unpack_series(data)
+        return run
+
+    def store_anchors(self, key, anchors, source):
+        """
+        Stores the normalization anchors computed for key, see anchors.anchor_key.
+        Exact anchors are not replaced by anchors from another source.
+        """
+        with self.connection:
+            self.connection.execute(
+                f"INSERT INTO anchors (key, timestamp, source, {', '.join(ANCHOR_COLUMNS)})"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET timestamp = excluded.timestamp,"
+                " source = excluded.source, "
+                + ", ".join(f"{column} = excluded.{column}" for column in ANCHOR_COLUMNS)
+                + " WHERE excluded.source = 'exact' OR anchors.source != 'exact'",
+                (key, time.time(), source, *(anchors[column] for column in ANCHOR_COLUMNS)),
+            )
+
+    def get_anchors(self, key=None):
+        """
+        Returns (anchors, source) stored for key, without key those of the most recent run,
+        exact ones first. None if there are none.
+        """
+        query = f"SELECT source, {', '.join(ANCHOR_COLUMNS)} FROM anchors"
+        if key is None:
+            row = self.connection.execute(
+                query + " ORDER BY source = 'exact' DESC, timestamp DESC LIMIT 1"
+            ).fetchone()
+        else:
+            row = self.connection.execute(query + " WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ANCHOR_COLUMNS, row[1:])), row[0]
+
+    def record_win(self, instance_class, name):
+        """
+        Counts a win of the portfolio configuration name for the instance class
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO portfolio_wins (instance_class, name, wins) VALUES (?, ?, 1)"
+                " ON CONFLICT (instance_class, name) DO UPDATE SET wins = wins + 1",
+                (instance_class, name),
+            )
+
+    def portfolio_wins(self, instance_class):
+        """
+        Returns {configuration name: wins} for the instance class
+        """
+        return dict(
+            self.connection.execute(
+                "SELECT name, wins FROM portfolio_wins WHERE instance_class = ?",
+                (instance_class,),
+            )
+        )
+
+    def _where(self, since, until, input_hash, solver_status, weights):
+        clauses = []
+        arguments = []
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            arguments.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            arguments.append(until)
+        if input_hash is not None:
+            clauses.append("input_hash = ?")
+            arguments.append(input_hash)
+        if solver_status is not None:
+            clauses.append("solver_status = ?")
+            arguments.append(solver_status)
+        if weights is not None:
+            clauses.append("income_weight = ? AND fulfillment_weight = ?")
+            arguments.extend(weights)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", arguments
+
+    def query_runs(
+        self,
+        since=None,
+        until=None,
+        input_hash=None,
+        solver_status=None,
+        weights=None,
+        limit=None,
+    ):
+        """
+        Returns the scalar data of all matching runs, newest first
+
+        :param weights: tuple of (income_weight, fulfillment_weight)
+        """
+        where, arguments = self._where(since, until, input_hash, solver_status, weights)
+        query = f"SELECT {', '.join(RUN_COLUMNS)} FROM runs{where} ORDER BY timestamp DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            arguments.append(limit)
+        return [dict(zip(RUN_COLUMNS, row)) for row in self.connection.execute(query, arguments)]
+
+    def aggregate(
+        self,
+        group_by="input_hash",
+        since=None,
+        until=None,
+        input_hash=None,
+        solver_status=None,
+        weights=None,
+    ):
+        """
+        Aggregates income_sum and mean_deviation per group
+
+        :param group_by: "input_hash", "weights" or "solver_status"
+        """
+        groups = {
+            "input_hash": ["input_hash"],
+            "weights": ["income_weight", "fulfillment_weight"],
+            "solver_status": ["solver_status"],
+        }[group_by]
+        where, arguments = self._where(since, until, input_hash, solver_status, weights)
+        columns = ", ".join(groups)
+        keys = groups + [
+            "runs",
+            "mean_income",
+            "min_income",
+            "max_income",
+            "mean_deviation",
+            "min_deviation",
+            "max_deviation",
+        ]
+        query = (
+            f"SELECT {columns}, COUNT(*), AVG(income_sum), MIN(income_sum), MAX(income_sum),"
+            f" AVG(mean_deviation), MIN(mean_deviation), MAX(mean_deviation)"
+            f" FROM runs{where} GROUP BY {columns}"
+        )
+        return [dict(zip(keys, row)) for row in self.connection.execute(query, arguments)]
+
+    def import_json_results(self, directory="Daten/results"):
+        """
+        Imports result files written by connect_and_schedule into the store.
+        Those files contain no KPIs or weights, so the columns stay empty.
+        """
+        imported = 0
+        known = {
+            row[0]
+            for row in self.connection.execute(
+                "SELECT filename FROM runs WHERE filename IS NOT NULL"
+            )
+        }
+        for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            name = os.path.basename(filename)
+            if name in known:
+                continue
+            with open(filename) as f:
+                result = json.load(f)
+            self.add_run(
+                input_hash=None,
+                income_weight=None,
+                fulfillment_weight=None,
+                solver_status=None,
+                income_sum=None,
+                mean_deviation=None,
+                milp_power=result["milp_power"],
+                milp_schedule=result["milp_schedule"],
+                ems_schedule=result.get("ems"),
+                timestamp=os.path.getmtime(filename),
+                filename=name,
+            )
+            imported += 1
+        return imported
@@ -1,15 +1,43 @@
-import pickle
-import numpy as np
-from pyomo.opt import SolverFactory
+import itertools
+import queue
+import threading
+import time
 
 from components.target import Target
 from components.grid import Grid
-from load_import import load_obj
+from load_import import load_obj, load_cached_obj
 from indexed_model import IndexedModel
 from components.converter import Converter
 from components.storage import Storage
 from redis_utils import *
-from Daten.results.plotter import plot_load_comparison
+from payload_codec import REQUIRED_PARAMETERS, validate_systemvalues
+from result_store import RESULT_STORE_PATH, input_hash
+from warm_start import (
+    WarmStartLibrary,
+    apply_warm_start,
+    extract_variable_values,
+    input_features,
+)
+from anchors import AnchorCache, valid_anchors
+from time_budget import TimeBudget
+from bound_estimation import estimate_anchors
+from solution_cache import SolutionCache, cache_key
+from portfolio import DEFAULT_GAP, PortfolioFailed, race
+from solver_backends import SolverOptions, SolverUnavailable, get_backend
+from instance_capture import capture_directory, capture_instance
+from solver_tuning import tuned_options, tuning_class
+from solver_telemetry import GAP_BUCKETS, SolveTrace, model_size, record_solve, registry
+from solution_pool import POOL_GAP, distinct_schedules, no_good_pool
+from tracing import (
+    Tracer,
+    activate,
+    active_correlation_id,
+    correlation_id,
+    finish_trace,
+    span,
+    tag_message,
+)
+from artifact_writer import artifact_writer
 
 facility_names = [
     "chp",
@@ -45,46 +73,92 @@ PEAK_RMSD = 1.0693029029
 MIN_INCOME = -26875.717205459492
 MAX_INCOME = 7954.206175268439
 
+DEFAULT_ANCHORS = {
+    "min_mean_deviation": 0,
+    "max_mean_deviation": PEAK_RMSD,
+    "min_income": MIN_INCOME,
+    "max_income": MAX_INCOME,
+}
+anchor_cache = AnchorCache(DEFAULT_ANCHORS, path=RESULT_STORE_PATH)
+solution_cache = SolutionCache()
+warm_start_library = None
+
+# Shortest time limit given to a solve, even when the deadline has already passed
+MIN_TIME_LIMIT = 0.1
+
+# Channel for intermediate schedules of the anytime mode
+PROGRESS_CHANNEL = "algorithm.EA.progress"
+
+# solver_status of schedules from the rule based fallback dispatcher
+FALLBACK_STATUS = "fallback"
 
-def get_gas_price(timeframe, step_length):
-    data = load_obj("Daten/Gasdemand_test.pkl")
+# Optional keys of the systemvalues: seconds into the data files at which the horizon starts,
+# and {storage name: mwh} initial charges that replace the defaults of the storages
+START_KEY = "start"
+INITIAL_CHARGE_KEY = "initial_charge"
+
+
+def get_gas_price(timeframe, step_length, start=0):
+    """
+    :param start: seconds into the data file at which the horizon starts
+    """
+    data = load_cached_obj("Daten/Gasdemand_test.pkl")
     times = data["time"]
     prices = data["Price"]
     result = []
-    prev_time = 0
+    prev_time = start
+    end = start + timeframe * step_length
     for time, price in zip(times, prices):
-        while prev_time < time and prev_time < timeframe * step_length:
+        while prev_time < time and prev_time < end:
             result.append(price * 1000) # €/kwh to €/mwH
             prev_time += step_length
-        if prev_time > timeframe * step_length:
+        if prev_time > end:
             break
     return result
 
 
-def get_electricity_price(timeframe, step_length):
-    data = load_obj("Daten/electricity_grid_04-11_04_2022.pkl")
+def get_electricity_price(timeframe, step_length, start=0):
+    data = load_cached_obj("Daten/electricity_grid_04-11_04_2022.pkl")
     times = data["time"]
     prices = data["price"]
     result = []
-    prev_time = 0
+    prev_time = start
+    end = start + timeframe * step_length
     for time, price in zip(times, prices):
-        while prev_time < time and prev_time < timeframe * step_length:
+        while prev_time < time and prev_time < end:
             result.append(price * 10) # cent/kwH to €/mwH
             prev_time += step_length
-        if prev_time > timeframe * step_length:
+        if prev_time > end:
             break
     return result
 
 
-def model_from_facility_parameters(parameters, timeframe, step_length):
+def initial_charges(values):
+    """
+    Initial charges {storage name: mwh} of the storages, the defaults unless the systemvalues
+    give them under INITIAL_CHARGE_KEY
+    """
+    capacity = values["parameters"]["Battery"]["input"]["EBat"] / 3600000000 # Joule to mwh
+    charges = {
+        "h2_storage": 0,
+        "Battery": capacity / 2,
+        "Gasstorage": 750 * METHANE_ENERGY,
+    }
+    charges.update(values.get(INITIAL_CHARGE_KEY) or {})
+    return charges
+
+
+def model_from_facility_parameters(parameters, timeframe, step_length, linear=False):
     """
     parameters: systemvalues from simulation
     timeframe: number of steps to be simulated (needs to be the same in EMS)
     step_length: length of a time step in seconds (also currently the same as in EMS)
+    linear: use the linear formulation of converters and storages, for MILP solvers
     """
     model = IndexedModel(index=range(0, timeframe))
+    charges = initial_charges(parameters)
 
-    heat_price = get_gas_price(timeframe, step_length)
+    heat_price = get_gas_price(timeframe, step_length, parameters.get(START_KEY, 0))
     print("initiated models")
     chp_params = parameters["parameters"]["BHKW"]["metadata"]
     chp = Converter(
@@ -102,6 +176,7 @@ def model_from_facility_parameters(parameters, timeframe, step_length):
         pr_CO2=pr_CO2,
         CH4_to_CO2=CH4_to_CO2,
         step_length=step_length,
+        linear=linear,
     )
     model.add_device(chp)
 
@@ -123,6 +198,7 @@ def model_from_facility_parameters(parameters, timeframe, step_length):
         ramp_up=electrolysis_params["input"]["t_ramp_PEM"],
         ramp_down=1,
         step_length=step_length,
+        linear=linear,
     )
     model.add_device(electrolysis)
 
@@ -142,6 +218,7 @@ def model_from_facility_parameters(parameters, timeframe, step_length):
             "h2": 0.25 * H2_ENERGY * 62.3 * (1 / METHANE_ENERGY) * (1 / 496),
         },  # mol * mwh/kg * kg/mol * kg/mwH * mol/kg
         step_length=step_length,
+        linear=linear,
     )
     # 62.3 kg/mol methane
     # 496 kg/mol h2
@@ -156,7 +233,8 @@ def model_from_facility_parameters(parameters, timeframe, step_length):
         input_types=["h2"],
         charging_efficiency=1,
         step_length=step_length,
-        initial_charge=0,
+        initial_charge=charges["h2_storage"],
+        linear=linear,
     )
     model.add_device(h2_storage)
 
@@ -166,10 +244,11 @@ def model_from_facility_parameters(parameters, timeframe, step_length):
         max_charging_power=battery_params["P_max_Bat"] / 1000000,
         max_discharging_power=battery_params["P_max_Bat"] / 1000000,
         capacity=battery_params["EBat"] / 3600000000, # Joule to mwh
-        initial_charge=battery_params["EBat"] / 3600000000 / 2,
+        initial_charge=charges["Battery"],
         charging_efficiency=battery_params["eta_Bat"],
         input_types=["electricity"],
         step_length=step_length,
+        linear=linear,
     )
     model.add_device(battery)
 
@@ -178,22 +257,23 @@ def model_from_facility_parameters(parameters, timeframe, step_length):
         max_charging_power=0.27 * METHANE_ENERGY * step_length,
         max_discharging_power=0.27 * METHANE_ENERGY * step_length,
         capacity=1500 * METHANE_ENERGY,
-        initial_charge=750 * METHANE_ENERGY,
+        initial_charge=charges["Gasstorage"],
         charging_efficiency=1,
         input_types=["methane"],
         step_length=step_length,
+        linear=linear,
     )
     model.add_device(gas_storage)
     print("added storage")
     return model
 
 
-def add_prices_to_model(model, timeframe, step_length):
+def add_prices_to_model(model, timeframe, step_length, start=0):
     """
      Reads data from the grid files to get
      energy prices for the Model
     """
-    gas_price = get_gas_price(timeframe, step_length)
+    gas_price = get_gas_price(timeframe, step_length, start)
     gas_network = Grid(
         "gas_grid",
         max_buying_power=-1000,
@@ -216,19 +296,26 @@ def add_prices_to_model(model, timeframe, step_length):
     return model
 
 
-def add_target_to_model(model, timeframe, step_length):
-    """
-    Reads the demand file to get the target for the energy hub
-    """
-    data = load_obj("Daten/Lastreihe_CN_04-11_04_2022.pkl")
+def get_target(timeframe, step_length, start=0):
+    data = load_cached_obj("Daten/Lastreihe_CN_04-11_04_2022.pkl")
     times = data["time"][1:]
     load_series = data["Lastreihe"][1:]
     result = []
     for time,  load in zip(times, load_series):
-        if time > timeframe * step_length:
+        if time <= start:
+            continue
+        if time > start + timeframe * step_length:
             break
         result.append(-load / 1000000)
-    electricity_prices = get_electricity_price(timeframe, step_length)
+    return result
+
+
+def add_target_to_model(model, timeframe, step_length, start=0):
+    """
+    Reads the demand file to get the target for the energy hub
+    """
+    result = get_target(timeframe, step_length, start)
+    electricity_prices = get_electricity_price(timeframe, step_length, start)
 
     target = Target(
         "target",
@@ -241,7 +328,7 @@ def add_target_to_model(model, timeframe, step_length):
     return model
 
 
-def solve_model(
+def build_model(
     timeframe,
     values,
     step_length,
@@ -251,19 +338,18 @@ def solve_model(
     min_mean_deviation,
     max_income,
     min_income,
+    linear=False,
 ):
     """
-
-    :param timeframe: Number of steps
-    :param values: Systemvalues to use
-    :param step_length Number of seconds per step
+    Creates the complete model with the weighted objective, see solve_model
     """
     print("received values")
-    model = model_from_facility_parameters(values, timeframe, step_length)
+    start = values.get(START_KEY, 0)
+    model = model_from_facility_parameters(values, timeframe, step_length, linear)
     print("generated facilities")
-    model = add_prices_to_model(model, timeframe, step_length)
+    model = add_prices_to_model(model, timeframe, step_length, start)
     print("added prices")
-    model = add_target_to_model(model, timeframe, step_length)
+    model = add_target_to_model(model, timeframe, step_length, start)
     print("added target")
     model.set_objective_with_weights(
         income_weight=income_weight,
@@ -277,10 +363,137 @@ def solve_model(
     print("objective created")
     model.generate_power_balance()
     print("power balance created")
-    gurobi = SolverFactory("gurobi", solver_io="python")
-    print("starting to solve")
-    result = gurobi.solve(model, report_timing=True)
+    return model
+
+
+def solve_model(
+    timeframe,
+    values,
+    step_length,
+    income_weight,
+    fulfillment_weight,
+    max_mean_deviation,
+    min_mean_deviation,
+    max_income,
+    min_income,
+    cancel=None,
+    warm_start=None,
+    on_incumbent=None,
+    deadline=None,
+    mip_gap=None,
+    hints=None,
+    portfolio=None,
+    backend=None,
+    linear=None,
+    capture=None,
+    pool_size=None,
+):
+    """
+
+    :param timeframe: Number of steps
+    :param values: Systemvalues to use
+    :param step_length Number of seconds per step
+    :param cancel: Event, the solver is interrupted once it is set and Superseded is raised
+    :param warm_start: variable values {name: {t: value}} used as MIP start
+    :param on_incumbent: called with (model, mip_gap, elapsed) for every improved solution,
+        the schedule variables of the model hold the incumbent during the call
+    :param deadline: time.time() by which the solve has to end, NoSolution is raised
+        if no feasible solution was found until then
+    :param mip_gap: relative gap at which the solver stops
+    :param hints: variable values {name: {t: value}} passed to the solver as hints
+    :param portfolio: list of solver configurations raced in parallel processes, see portfolio.py,
+        cancel, warm_start, on_incumbent and hints are not used then
+    :param backend: name of the solver backend, see solver_backends.py
+    :param linear: use the linear formulation, by default if the backend needs it
+    :param capture: directory or True to write the solved instance for replays, see
+        instance_capture.py, by default the CAPTURE_INSTANCES environment variable decides
+    :param pool_size: keep up to pool_size solutions within POOL_GAP of the best one in
+        model.solution_pool, from the solution pool of the backend or by solving again with
+        the commitment of the found solutions excluded, see solution_pool.py
+    """
+    backend = get_backend(backend)
+    build_arguments = dict(
+        timeframe=timeframe,
+        values=values,
+        step_length=step_length,
+        income_weight=income_weight,
+        fulfillment_weight=fulfillment_weight,
+        max_mean_deviation=max_mean_deviation,
+        min_mean_deviation=min_mean_deviation,
+        max_income=max_income,
+        min_income=min_income,
+        linear=not backend.supports_bilinear if linear is None else linear,
+    )
+    with span("build"):
+        model = build_model(**build_arguments)
+    if portfolio is not None:
+        print("starting portfolio race")
+        try:
+            winner = race(
+                build_arguments,
+                portfolio=portfolio,
+                mip_gap=DEFAULT_GAP if mip_gap is None else mip_gap,
+                deadline=deadline,
+            )
+        except PortfolioFailed as e:
+            raise NoSolution(str(e))
+        print("portfolio winner", winner["name"], "after", winner["time"], "s")
+        apply_warm_start(model, winner["values"])
+        model.solver_status = winner["status"]
+        return model
+    options = SolverOptions(
+        time_limit=None if deadline is None else max(deadline - time.time(), MIN_TIME_LIMIT),
+        mip_gap=mip_gap,
+        warm_start=warm_start,
+        extra=tuned_options(backend.name, timeframe, step_length, values),
+        pool_size=pool_size,
+        pool_gap=POOL_GAP if pool_size else None,
+    )
+    print("starting to solve with", backend.name, options.extra)
+    trace = SolveTrace()
+    with span("solve"):
+        result = backend.solve(
+            model,
+            options,
+            cancel=cancel,
+            on_incumbent=on_incumbent,
+            incumbent_variables=schedule_variables(model) if on_incumbent is not None else None,
+            hints=hints,
+            trace=trace,
+        )
     print(result)
+    model.solve_result = result
+    model.solve_trace = trace
+    record_solve(
+        trace,
+        result,
+        model_size(model),
+        {
+            "backend": backend.name,
+            "instance_class": tuning_class(timeframe, step_length, values),
+            "phase": f"{income_weight}/{fulfillment_weight}",
+        },
+    )
+    directory = capture_directory(capture)
+    if directory is not None:
+        try:
+            print("captured instance", capture_instance(model, build_arguments, options, result, directory))
+        except Exception as e:
+            print("capturing the instance failed", e)
+    model.solver_status = result.status
+    if cancel is not None and cancel.is_set():
+        raise Superseded(extract_variable_values(model) if result.has_solution else None)
+    if not result.has_solution:
+        raise NoSolution(model.solver_status)
+    if pool_size:
+        with span("pool"):
+            model.solution_pool = result.pool
+            if result.pool is None:
+                model.solution_pool = no_good_pool(
+                    model, backend, options, commitment_variables(model), pool_size, POOL_GAP,
+                    deadline,
+                )
+        print("solution pool of", len(model.solution_pool), "solutions")
 
     print("income dof, sum (€)", model.income_dof(), model.income_sum())
     print(
@@ -292,6 +505,102 @@ def solve_model(
     return model
 
 
+class NoSolution(Exception):
+    """
+    Raised when the solver stopped without a feasible solution, e.g. at the deadline
+    """
+
+
+class Superseded(Exception):
+    """
+    Raised when a solve is interrupted because newer systemvalues arrived.
+    incumbent holds the variable values of the best solution found so far, if any.
+    """
+
+    def __init__(self, incumbent=None):
+        super().__init__("superseded by newer systemvalues")
+        self.incumbent = incumbent
+
+
+def schedule_variables(model):
+    """
+    Variables read by extract_schedule_from_result
+    """
+    variables = [model.get_attribute_by_name(facility, "setpoint") for facility in facility_names]
+    variables.append(model.get_attribute_by_name("Battery", "is_charging"))
+    return [data for var in variables for data in var.values()]
+
+
+def commitment_variables(model):
+    """
+    Binaries that decide which facilities of the schedule run and whether the battery charges
+    """
+    variables = [
+        model.get_attribute_by_name(
+            facility, "is_charging" if facility == "Battery" else "is_active"
+        )
+        for facility in facility_names
+    ]
+    return [data for var in variables for data in var.values()]
+
+
+class IncumbentPublisher:
+    """
+    on_incumbent callback that publishes every improved schedule on the progress channel.
+    Consumers can act on an early plan and replace it when one with a smaller gap arrives.
+    The messages carry the correlation id of the active trace.
+    The callback only copies the schedule, a background thread publishes it,
+    so the solver is not held up by redis. close() waits until everything is published.
+    """
+
+    def __init__(self, channel=PROGRESS_CHANNEL, connection=None):
+        self.channel = channel
+        self.connection = get_connection() if connection is None else connection
+        self.sequence = itertools.count()
+        self.correlation = active_correlation_id()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, model, mip_gap, elapsed):
+        self.queue.put(
+            (next(self.sequence), mip_gap, elapsed, extract_schedule_from_result(model))
+        )
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            sequence, mip_gap, elapsed, schedule = item
+            try:
+                self.connection.publish(
+                    self.channel,
+                    tag_message(
+                        {
+                            "sequence": sequence,
+                            "mipGap": mip_gap,
+                            "elapsed": elapsed,
+                            "matrix": create_fake_activity_matrix(schedule),
+                        },
+                        self.correlation,
+                    ),
+                )
+            except Exception as e:
+                print("publishing the incumbent failed", e)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def incumbent_publisher(channel=PROGRESS_CHANNEL, connection=None):
+    """
+    Creates an IncumbentPublisher for the progress channel
+    """
+    return IncumbentPublisher(channel, connection)
+
+
 def extract_schedule_from_result(model):
     schedule = {}
     for facility in facility_names:
@@ -323,6 +632,28 @@ def extract_schedule_from_result(model):
     return schedule
 
 
+def warm_start_from_schedule(schedule):
+    """
+    Variable values {name: {t: value}} of a schedule as extract_schedule_from_result returns it,
+    for use as MIP start
+    """
+    values = {}
+    for facility, setpoints in schedule.items():
+        values[f"{facility}_setpoint"] = {t: abs(setpoint) for t, setpoint in enumerate(setpoints)}
+        if facility == "Battery":
+            values["Battery_is_charging"] = {
+                t: float(setpoint < 0) for t, setpoint in enumerate(setpoints)
+            }
+            values["Battery_charging_setpoint"] = {
+                t: max(-setpoint, 0) for t, setpoint in enumerate(setpoints)
+            }
+        else:
+            values[f"{facility}_is_active"] = {
+                t: float(setpoint > 0) for t, setpoint in enumerate(setpoints)
+            }
+    return values
+
+
 def create_fake_activity_matrix(schedule):
     """
     Creates an empty activity matrix in the same format as gleam would use (to send to the EMS)
@@ -344,32 +675,130 @@ def create_fake_activity_matrix(schedule):
     return matrix
 
 
-def connect_and_schedule(timeframe, step_length, filename):
-    data = load_obj("Daten/Lastreihe_CN_04-11_04_2022.pkl")
+def pool_schedules(model):
+    """
+    Schedules of the solution pool of the model with distinct commitment patterns, best first.
+    The model holds its best solution again afterwards.
+    """
+    best = extract_variable_values(model)
+    schedules = []
+    for solution in model.solution_pool:
+        apply_warm_start(model, solution["values"])
+        schedules.append(extract_schedule_from_result(model))
+    apply_warm_start(model, best)
+    return distinct_schedules(schedules)
+
+
+def pool_activity_matrix(schedules):
+    """
+    One plan per schedule in the format of create_fake_activity_matrix, with its own ids
+    """
+    return [
+        dict(plan, planID=index, childID=index)
+        for index, schedule in enumerate(schedules)
+        for plan in create_fake_activity_matrix(schedule)
+    ]
+
+
+def activity_matrix(result):
+    """
+    The activity matrix published for a result of run_dispatch, the whole pool if it has one
+    """
+    if result.get("pool_schedules"):
+        return pool_activity_matrix(result["pool_schedules"])
+    return create_fake_activity_matrix(result["milp_schedule"])
+
+
+def connect_and_schedule(
+    timeframe,
+    step_length,
+    filename,
+    progress_channel=None,
+    deadline_seconds=None,
+    anchor_mode="exact",
+    portfolio=None,
+    pool_size=None,
+    use_history=False,
+):
+    """
+    :param deadline_seconds: seconds after receiving the systemvalues by which the schedule is sent
+    :param pool_size: publish up to pool_size distinct near-optimal plans, see run_dispatch
+    :param use_history: warm start from the nearest past solutions, see run_dispatch
+
+    Every stage is traced, the trace is appended to tracing.TRACE_PATH
+    under the correlation id that came with the systemvalues, also if the dispatch fails.
+    The json result, the result store entry and the plot are written by the artifact writer
+    in the background, call artifact_writer.flush() to wait for them.
+    """
+    tracer = Tracer()
+    try:
+        with activate(tracer):
+            schedule_traced(
+                tracer, timeframe, step_length, filename, progress_channel, deadline_seconds,
+                anchor_mode, portfolio, pool_size, use_history,
+            )
+    except BaseException as e:
+        tracer.error = repr(e)
+        raise
+    finally:
+        finish_trace(tracer)
+
+
+def schedule_traced(
+    tracer,
+    timeframe,
+    step_length,
+    filename,
+    progress_channel,
+    deadline_seconds,
+    anchor_mode,
+    portfolio,
+    pool_size=None,
+    use_history=False,
+):
+    with span("load_data"):
+        data = load_obj("Daten/Lastreihe_CN_04-11_04_2022.pkl")
     times = data["time"]
     load_series = data["Lastreihe"]
     target = []
-    for time, load in zip(times, load_series):
-        if time > timeframe * 900:
+    for step_time, load in zip(times, load_series):
+        if step_time > timeframe * 900:
             break
         target.append(load / 1000000)
 
-    redis, system = engage_redis(cluster=False, channel="Systemvalues")
-    values = wait_for_stream(system)
+    with span("subscribe"):
+        redis, system = engage_redis(cluster=False, channel="Systemvalues")
+    values = wait_for_stream(system, validate=validate_systemvalues, stage="systemvalues")
+    received = time.time()
+    tracer.received = received
+    tracer.correlation_id = correlation_id(values)
     print(values)
 
-    model = multi_step_optimization(timeframe, values, step_length)
-
-    milp_schedule = extract_schedule_from_result(model)
-    matrix = create_fake_activity_matrix(milp_schedule)
+    result = run_dispatch(
+        timeframe,
+        values,
+        step_length,
+        progress_channel=progress_channel,
+        deadline=None if deadline_seconds is None else received + deadline_seconds,
+        anchor_mode=anchor_mode,
+        portfolio=portfolio,
+        pool_size=pool_size,
+        use_history=use_history,
+    )
+    milp_schedule = result["milp_schedule"]
+    matrix = activity_matrix(result)
 
-    send_redis(matrix, redis)
-    milp_result = model.get_attribute_by_name(
-        "target", "electricity_power"
-    ).extract_values()
-    milp_result = [-milp_result[t] for t in range(timeframe)]
-    redis, r_schedule = engage_redis(cluster=False, channel="Schedule")
-    ems_schedule = wait_for_stream(r_schedule)
+    with span("publish"):
+        # Subscribe before publishing, so the answer of the EMS can not be missed,
+        # and drop schedules the reused subscription buffered for earlier plans
+        redis, r_schedule = engage_redis(cluster=False, channel="Schedule")
+        discarded = drain_messages(r_schedule)
+        if discarded:
+            print("discarded", discarded, "earlier schedules")
+        send_redis(matrix, redis, correlation_id=tracer.correlation_id)
+    tracer.published = time.time()
+    milp_result = result["milp_power"]
+    ems_schedule = wait_for_stream(r_schedule, stage="ems_schedule")
     print("got schedule")
     combined_schedule = {
         "milp_power": milp_result,
@@ -377,11 +806,243 @@ def connect_and_schedule(timeframe, step_length, filename):
         "ems": ems_schedule,
 
     }
-    with open("Daten/results/" + filename, "w") as f:
-        json.dump(combined_schedule, f)
+    with span("queue_artifacts"):
+        artifact_writer.write_json("Daten/results/" + filename, combined_schedule)
+        artifact_writer.store_run(
+            input_hash=input_hash(values),
+            income_weight=INCOME_WEIGHT,
+            fulfillment_weight=FULFILLMENT_WEIGHT,
+            solver_status=result["solver_status"],
+            income_sum=result["income_sum"],
+            mean_deviation=result["mean_deviation"],
+            milp_power=milp_result,
+            milp_schedule=milp_schedule,
+            ems_schedule=ems_schedule,
+            filename=filename,
+        )
+        artifact_writer.plot(milp=milp_result, milp_ems=ems_schedule, systemvalues=values)
+
+
+def run_dispatch(
+    timeframe,
+    values,
+    step_length,
+    cancel=None,
+    warm_start=None,
+    progress_channel=None,
+    deadline=None,
+    anchor_mode="exact",
+    use_cache=True,
+    use_history=False,
+    portfolio=None,
+    pool_size=None,
+    use_fallback=True,
+):
+    """
+    Runs the optimization for one set of systemvalues.
+    Only plain python objects are returned, so it can be run in worker processes.
+    Results of optimal solves without deadline and with the anchors anchor_mode asks for
+    are kept in the solution cache, keyed by the anchors themselves in the "cached" mode,
+    a repeated input is answered from there
+    without building or solving a model. Under a deadline the solves stop at a relaxed gap
+    and may fall back to other anchors, so those results are not cached.
+    With use_history the nearest past solutions are used as MIP start and hints,
+    and optimal solutions are added to the warm start library.
+    Hints need the persistent gurobi interface, so use_history is off by default.
+
+    :param progress_channel: publish every incumbent of the final solve on this channel
+    :param deadline: time.time() by which the schedule has to be found
+    :param anchor_mode: see multi_step_optimization
+    :param portfolio: race these solver configurations for every solve, see portfolio.py
+    :param pool_size: also return up to pool_size near-optimal schedules with distinct
+        commitment patterns of the final solve as pool_schedules, best first
+    :param use_fallback: compute the rule based fallback schedule first, see fallback_dispatch.py.
+        It is the MIP start if there is no other, it is returned with solver_status
+        FALLBACK_STATUS if no solver is installed or no solution is found before the deadline,
+        with fallback_feasible False if repair left violations of fallback_violation,
+        otherwise its objective gap to the MILP schedule is returned as fallback_gap
+    """
+    # The cached anchors change with every exact or estimated run, so they are part of the key
+    cached_anchors = None
+    if use_cache and anchor_mode == "cached":
+        cached_anchors = anchor_cache.get(values, timeframe, step_length)[0]
+    if use_cache:
+        with span("cache_lookup"):
+            key = dispatch_cache_key(
+                timeframe, values, step_length, anchor_mode, pool_size, cached_anchors
+            )
+            cached, tier = solution_cache.get(key)
+        if cached is not None:
+            print("schedule from the", tier, "cache", solution_cache.metrics())
+            return dict(cached, cache=tier)
+    hints = None
+    if use_history:
+        library = get_warm_start_library()
+        features = dispatch_features(timeframe, values, step_length)
+        if warm_start is None:
+            warm_start, hints = library.suggest(features, timeframe)
+    fallback = fallback_schedule(timeframe, values, step_length) if use_fallback else None
+    if warm_start is None and fallback is not None:
+        warm_start = warm_start_from_schedule(fallback[1])
+    publisher = None if progress_channel is None else incumbent_publisher(progress_channel)
+    try:
+        model = multi_step_optimization(
+            timeframe,
+            values,
+            step_length,
+            cancel=cancel,
+            warm_start=warm_start,
+            on_incumbent=publisher,
+            deadline=deadline,
+            anchor_mode=anchor_mode,
+            hints=hints,
+            portfolio=portfolio,
+            pool_size=pool_size,
+        )
+    except (NoSolution, SolverUnavailable) as e:
+        if fallback is None:
+            raise
+        evaluator, schedule, power, scores = fallback
+        print("no MILP schedule:", e, "- using the fallback schedule")
+        if not scores["feasible"]:
+            print("the fallback schedule still violates constraints by", scores["violation"])
+        return {
+            "milp_schedule": schedule,
+            "milp_power": power,
+            "income_sum": scores["income"],
+            "mean_deviation": scores["mean_deviation"],
+            "solver_status": FALLBACK_STATUS,
+            "fallback_feasible": scores["feasible"],
+            "fallback_violation": scores["violation"],
+            "anchors": evaluator.anchors,
+            "cache": None,
+        }
+    finally:
+        if publisher is not None:
+            publisher.close()
+    with span("extract"):
+        milp_power = model.get_attribute_by_name(
+            "target", "electricity_power"
+        ).extract_values()
+        result = {
+            "milp_schedule": extract_schedule_from_result(model),
+            "milp_power": [-milp_power[t] for t in range(timeframe)],
+            "income_sum": model.income_sum(),
+            "mean_deviation": model.mean_deviation(),
+            "solver_status": model.solver_status,
+            "anchors": model.anchors,
+        }
+        if getattr(model, "solution_pool", None):
+            result["pool_schedules"] = pool_schedules(model)
+    if fallback is not None:
+        result["fallback_gap"] = fallback_gap(fallback, model)
+    if (
+        use_cache
+        and model.solver_status == "optimal"
+        and deadline is None
+        and (
+            model.anchor_source == anchor_mode
+            if cached_anchors is None
+            else model.anchors == cached_anchors
+        )
+    ):
+        solution_cache.put(key, result)
+    if use_history and model.solver_status == "optimal":
+        library.add_model(model, features, timeframe)
+    return dict(result, cache=None)
+
+
+def fallback_schedule(timeframe, values, step_length):
+    """
+    Schedule of the rule based fallback dispatcher with the cached anchors,
+    as (evaluator, schedule, power, scores), see fallback_dispatch.py. None if it failed.
+    """
+    from fallback_dispatch import fallback_dispatch
+    from population_evaluation import evaluator_from_values
+
+    try:
+        with span("fallback"):
+            evaluator = evaluator_from_values(
+                timeframe, values, step_length, anchors=anchor_cache.get(values, timeframe, step_length)[0]
+            )
+            return (evaluator,) + fallback_dispatch(evaluator)
+    except Exception as e:
+        print("computing the fallback schedule failed", e)
+        return None
+
+
+def fallback_gap(fallback, model):
+    """
+    Objective gap of the fallback schedule to the MILP schedule of model, with the anchors of
+    the model. It is printed and observed in the solver telemetry registry.
+    """
+    from fallback_dispatch import objective_gap, schedule_scores
+
+    evaluator, schedule, _, _ = fallback
+    evaluator.anchors = dict(model.anchors)
+    gap = objective_gap(model.obj(), schedule_scores(evaluator, schedule)["objective"])
+    print("objective gap of the fallback schedule", gap)
+    registry.observe("fallback_objective_gap", gap, buckets=GAP_BUCKETS)
+    return gap
+
+
+def get_warm_start_library():
+    """
+    The library is opened on first use, so every worker process gets its own connection
+    """
+    global warm_start_library
+    if warm_start_library is None:
+        warm_start_library = WarmStartLibrary()
+    return warm_start_library
+
+
+def dispatch_series(timeframe, values, step_length):
+    start = values.get(START_KEY, 0)
+    return {
+        "gas_price": get_gas_price(timeframe, step_length, start),
+        "electricity_price": get_electricity_price(timeframe, step_length, start),
+        "target": get_target(timeframe, step_length, start),
+    }
+
+
+def dispatch_features(timeframe, values, step_length):
+    """
+    Features of everything the model is built from: the series of the horizon,
+    the device parameters it reads and the initial charges of the storages
+    """
+    parameters = values["parameters"]
+    scalars = [
+        parameters[facility][section][key]
+        for facility, sections in REQUIRED_PARAMETERS.items()
+        for section, keys in sections.items()
+        for key in keys
+    ]
+    charges = initial_charges(values)
+    scalars.extend(charges[name] for name in sorted(charges))
+    return input_features(dispatch_series(timeframe, values, step_length), scalars)
 
-    plot_load_comparison(milp=milp_result, milp_ems=ems_schedule, systemvalues=values)
-    model_values = model.values()
+
+def dispatch_cache_key(
+    timeframe, values, step_length, anchor_mode="exact", pool_size=None, anchors=None
+):
+    """
+    Key of the solution cache, results with pools of different size are cached separately.
+    anchors are the anchors of the "cached" anchor_mode, the other modes compute them
+    from the inputs.
+    """
+    parameters = values["parameters"]
+    if values.get(INITIAL_CHARGE_KEY):
+        parameters = dict(parameters, **{INITIAL_CHARGE_KEY: values[INITIAL_CHARGE_KEY]})
+    return cache_key(
+        parameters=parameters,
+        series=dispatch_series(timeframe, values, step_length),
+        weights=(INCOME_WEIGHT, FULFILLMENT_WEIGHT),
+        timeframe=timeframe,
+        step_length=step_length,
+        anchor_mode=anchor_mode,
+        pool_size=pool_size or 0,
+        anchors=anchors,
+    )
 
 
 def single_step_optimization(timeframe, values, target):
@@ -399,49 +1060,162 @@ def single_step_optimization(timeframe, values, target):
     return model
 
 
-def multi_step_optimization(timeframe, values, step_length):
+def multi_step_optimization(
+    timeframe,
+    values,
+    step_length,
+    cancel=None,
+    warm_start=None,
+    on_incumbent=None,
+    deadline=None,
+    anchor_mode="exact",
+    hints=None,
+    portfolio=None,
+    income_weight=INCOME_WEIGHT,
+    fulfillment_weight=FULFILLMENT_WEIGHT,
+    pool_size=None,
+):
     """
     Test if better performance possible when using own prediction for optimal incomes and deviation
+    cancel, warm_start, hints and portfolio are passed to every solve, on_incumbent only to the final weighted one,
+    see solve_model
+    income_weight and fulfillment_weight weight the normalized objectives of the final solve,
+    pool_size asks the final solve for a solution pool
+
+    :param deadline: time.time() by which the final schedule has to be found,
+        the time is split between the solves by a TimeBudget
+    :param anchor_mode: "exact" solves both anchor models, "estimated" uses their root
+        relaxations (see bound_estimation), "cached" the anchors previous exact or estimated
+        runs stored in the result store, see anchors.AnchorCache, the defaults without any.
+        Where the anchors came from is set as model.anchor_source, "exact" only if both
+        anchor models were solved.
     """
+    budget = None if deadline is None else TimeBudget(deadline)
+    if anchor_mode == "exact":
+        anchors, source = solve_anchors(
+            timeframe, values, step_length, cancel, warm_start, budget, hints, portfolio
+        )
+    elif anchor_mode == "estimated":
+        anchors, source = estimate_anchors(
+            timeframe,
+            values,
+            step_length,
+            deadline=None if budget is None else budget.phase_deadline("min_deviation"),
+        )
+    elif anchor_mode == "cached":
+        anchors, source = anchor_cache.get(values, timeframe, step_length)
+        print("using anchors from", source)
+    else:
+        raise ValueError(f"Unknown anchor mode {anchor_mode}")
+    if budget is not None:
+        budget.skip("min_deviation")
+        budget.skip("max_income")
     model = solve_model(
         timeframe,
         values,
         step_length,
-        income_weight=0,
-        fulfillment_weight=1,
-        max_mean_deviation=PEAK_RMSD,
-        min_mean_deviation=0,
-        min_income=MIN_INCOME,
-        max_income=MAX_INCOME,
-    )
-    minimum_income_result = model.income_sum()
-    min_mean_deviation = model.mean_deviation()
-    print("min_mean_deviation", min_mean_deviation)
-    print("min_income", minimum_income_result)
-    model = solve_model(
-        timeframe,
-        values,
-        step_length,
-        income_weight=1,
-        fulfillment_weight=0,
-        max_mean_deviation=PEAK_RMSD,
-        min_mean_deviation=min_mean_deviation,
-        min_income=MIN_INCOME,
-        max_income=MAX_INCOME,
-    )
-    max_income_result = model.income_sum()
-    max_mean_deviation = model.mean_deviation()
-    print("optimum_income", max_income_result)
-    print("peak_deviation", max_mean_deviation)
-    model = solve_model(
-        timeframe,
-        values,
-        step_length,
-        income_weight=INCOME_WEIGHT,
-        fulfillment_weight=FULFILLMENT_WEIGHT,
-        max_mean_deviation=max_mean_deviation,
-        min_mean_deviation=min_mean_deviation,
-        min_income=minimum_income_result,
-        max_income=max_income_result,
+        income_weight=income_weight,
+        fulfillment_weight=fulfillment_weight,
+        max_mean_deviation=anchors["max_mean_deviation"],
+        min_mean_deviation=anchors["min_mean_deviation"],
+        min_income=anchors["min_income"],
+        max_income=anchors["max_income"],
+        cancel=cancel,
+        warm_start=warm_start,
+        hints=hints,
+        portfolio=portfolio,
+        on_incumbent=on_incumbent,
+        deadline=None if budget is None else budget.phase_deadline("weighted"),
+        mip_gap=None if budget is None else budget.mip_gap("weighted"),
+        pool_size=pool_size,
     )
+    model.anchors = anchors
+    model.anchor_source = source
     return model
+
+
+def solve_anchors(
+    timeframe,
+    values,
+    step_length,
+    cancel=None,
+    warm_start=None,
+    budget=None,
+    hints=None,
+    portfolio=None,
+):
+    """
+    Solves for the best fulfillment and the best income, which normalize the weighted objective.
+    Without enough time left in the budget, or if a solve finds no solution in time,
+    the anchors of a previous run are used instead.
+    Returns (anchors, source), source is "exact" if both solves found their anchor.
+    """
+    anchors, source = anchor_cache.get(values, timeframe, step_length)
+    if budget is not None and not budget.anchors_affordable():
+        print("not enough time for the anchor solves, using anchors from", source)
+        budget.skip("min_deviation")
+        budget.skip("max_income")
+        return anchors, source
+    anchors = dict(anchors)
+    solved = 0
+    try:
+        model = solve_model(
+            timeframe,
+            values,
+            step_length,
+            income_weight=0,
+            fulfillment_weight=1,
+            max_mean_deviation=PEAK_RMSD,
+            min_mean_deviation=0,
+            min_income=MIN_INCOME,
+            max_income=MAX_INCOME,
+            cancel=cancel,
+            warm_start=warm_start,
+            hints=hints,
+            portfolio=portfolio,
+            deadline=None if budget is None else budget.phase_deadline("min_deviation"),
+            mip_gap=None if budget is None else budget.mip_gap("min_deviation"),
+        )
+        anchors["min_income"] = model.income_sum()
+        anchors["min_mean_deviation"] = model.mean_deviation()
+        print("min_mean_deviation", anchors["min_mean_deviation"])
+        print("min_income", anchors["min_income"])
+        solved += 1
+    except NoSolution:
+        print("no fulfillment anchor in time, using anchors from", source)
+    if budget is not None:
+        budget.finish("min_deviation")
+    try:
+        model = solve_model(
+            timeframe,
+            values,
+            step_length,
+            income_weight=1,
+            fulfillment_weight=0,
+            max_mean_deviation=PEAK_RMSD,
+            min_mean_deviation=anchors["min_mean_deviation"],
+            min_income=MIN_INCOME,
+            max_income=MAX_INCOME,
+            cancel=cancel,
+            warm_start=warm_start,
+            hints=hints,
+            portfolio=portfolio,
+            deadline=None if budget is None else budget.phase_deadline("max_income"),
+            mip_gap=None if budget is None else budget.mip_gap("max_income"),
+        )
+        anchors["max_income"] = model.income_sum()
+        anchors["max_mean_deviation"] = model.mean_deviation()
+        print("optimum_income", anchors["max_income"])
+        print("peak_deviation", anchors["max_mean_deviation"])
+        solved += 1
+    except NoSolution:
+        print("no income anchor in time, using anchors from", source)
+    if budget is not None:
+        budget.finish("max_income")
+    if not valid_anchors(anchors):
+        print("inconsistent anchors, using the defaults")
+        return dict(DEFAULT_ANCHORS), "defaults"
+    if solved < 2:
+        return anchors, "partly exact" if solved else source
+    anchor_cache.store(values, timeframe, step_length, anchors)
+    return anchors, "exact"
@@ -0,0 +1,156 @@
+import numpy as np
+
+from population_evaluation import (
+    FEASIBILITY_TOLERANCE,
+    converter_powers,
+    id_to_name,
+    population_from_matrices,
+)
+
+
+def project_converter(device, setpoint, previous=None):
+    """
+    Nearest setpoint in {0} and [min_power / max_power, 1], limited by ramp_up from previous.
+    A converter that can not ramp up to its minimal power stays off.
+    """
+    ratio = device.min_power / device.max_power
+    setpoint = np.clip(setpoint, 0, 1)
+    setpoint = np.where(setpoint < ratio, np.where(setpoint < ratio / 2, 0, ratio), setpoint)
+    if previous is not None:
+        setpoint = np.minimum(setpoint, previous + device.step_length / device.ramp_up)
+        setpoint = np.where(setpoint < ratio, 0, setpoint)
+    return setpoint
+
+
+def reduce_converters(devices, setpoints, energy_type, excess):
+    """
+    Lowers the setpoints of devices until their power of energy_type changed by excess,
+    in the order of devices, a converter lowered below its minimal power is switched off
+    """
+    for device in devices:
+        if not np.any(excess > FEASIBILITY_TOLERANCE):
+            return
+        setpoint = setpoints[device.name]
+        power = np.abs(converter_powers(device, np.ones_like(setpoint))[energy_type])
+        lowered = np.clip(setpoint - excess / power, 0, None)
+        lowered = np.where(lowered < device.min_power / device.max_power, 0, lowered)
+        excess = excess - (setpoint - lowered) * power
+        setpoints[device.name] = lowered
+
+
+def repair_population(evaluator, population):
+    """
+    Projects every plan onto the feasible set of the devices of the evaluator.
+
+    Step by step for all plans at once: converters are moved to 0 or above their minimal power
+    and limited by ramp_up, storages of the plan are limited to what their state of charge
+    allows. Where an energy type can not be balanced by its grid and the storages outside the
+    plan, the consumers of a deficit or the producers of a surplus are lowered.
+    Balancing only lowers setpoints, so ramp_up still holds for the following step.
+    Whether the result is feasible can be checked with evaluator.evaluate.
+
+    :param population: array (plans x resources x time), see PopulationEvaluator
+    :return: the repaired array (plans x resources x timeframe)
+    """
+    setpoints = {name: values.copy() for name, values in evaluator.setpoints(population).items()}
+    plans = next(iter(setpoints.values())).shape[0]
+    converters = [device for device in evaluator.converters if device.name in setpoints]
+    planned = [device for device in evaluator.storages if device.name in setpoints]
+    balancing = [device for device in evaluator.storages if device.name not in setpoints]
+    storages = {device.name: device for device in evaluator.storages}
+    charges = {
+        device.name: np.full(plans, float(device.initial_charge)) for device in evaluator.storages
+    }
+
+    def imbalance(energy_type):
+        # What the grid and the storages outside the plan leave of the balance of energy_type,
+        # and the powers of those storages
+        net = sum(
+            converter_powers(device, current[device.name]).get(energy_type, 0)
+            for device in converters
+        ) + sum(
+            storage_powers[device.name]
+            for device in planned
+            if device.energy_type == energy_type
+        )
+        remaining = -net + np.zeros(plans)
+        grid = evaluator.grids.get(energy_type)
+        if grid is not None:
+            remaining = remaining - np.clip(
+                remaining, grid.max_buying_power, grid.max_selling_power
+            )
+        powers = {}
+        for device in balancing:
+            if device.energy_type == energy_type:
+                discharging, charging = evaluator.storage_limits(device, charges[device.name])
+                powers[device.name] = np.clip(remaining, -charging, discharging)
+                remaining = remaining - powers[device.name]
+        return remaining, powers
+
+    balanced = [
+        energy_type for energy_type in evaluator.energy_types if energy_type not in evaluator.targets
+    ]
+    for t in range(evaluator.timeframe):
+        current = {}
+        for device in converters:
+            previous = setpoints[device.name][:, t - 1] if t > 0 else None
+            current[device.name] = project_converter(device, setpoints[device.name][:, t], previous)
+
+        storage_powers = {}
+        for device in planned:
+            setpoint = np.clip(setpoints[device.name][:, t], -1, 1)
+            power = np.where(
+                setpoint > 0,
+                setpoint * device.max_discharging_power,
+                setpoint * device.max_charging_power,
+            )
+            discharging, charging = evaluator.storage_limits(device, charges[device.name])
+            storage_powers[device.name] = np.clip(power, -charging, discharging)
+
+        # Lowering a converter changes the balance of its other energy types,
+        # so the balances are repeated until none of them changes
+        for _ in range(len(balanced)):
+            changed = False
+            for energy_type in balanced:
+                remaining, _ = imbalance(energy_type)
+                if np.any(np.abs(remaining) > FEASIBILITY_TOLERANCE):
+                    changed = True
+                    consumers = [d for d in converters if energy_type in d.input_types]
+                    producers = [d for d in converters if energy_type in d.output_types]
+                    reduce_converters(consumers, current, energy_type, np.clip(remaining, 0, None))
+                    reduce_converters(producers, current, energy_type, np.clip(-remaining, 0, None))
+            if not changed:
+                break
+
+        for device in converters:
+            setpoints[device.name][:, t] = current[device.name]
+        for device in planned:
+            power = storage_powers[device.name]
+            setpoints[device.name][:, t] = np.where(
+                power > 0, power / device.max_discharging_power, power / device.max_charging_power
+            )
+            charges[device.name] = evaluator.next_charge(device, charges[device.name], power)
+        for energy_type in balanced:
+            for name, power in imbalance(energy_type)[1].items():
+                charges[name] = evaluator.next_charge(storages[name], charges[name], power)
+
+    return np.stack([setpoints[name] for name in evaluator.resources], axis=1)
+
+
+def repair_matrices(evaluator, plans):
+    """
+    Repairs plans in the gleam format of create_fake_activity_matrix,
+    plan ids and resources that are not evaluated are kept
+    """
+    repaired = repair_population(evaluator, population_from_matrices(plans, evaluator.timeframe))
+    index = {name: position for position, name in enumerate(evaluator.resources)}
+    result = []
+    for plan, setpoints in zip(plans, repaired):
+        resource_plan = []
+        for resource in plan["resourcePlan"]:
+            name = id_to_name.get(str(resource["resourceID"]))
+            if name in index:
+                resource = dict(resource, powerGeneration=setpoints[index[name]].tolist())
+            resource_plan.append(resource)
+        result.append(dict(plan, resourcePlan=resource_plan))
+    return result
@@ -0,0 +1,434 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from load_import import load_cached_obj
+from payload_codec import PayloadError, validate_systemvalues
+from redis_utils import CANCEL_CHECK_INTERVAL, engage_redis, send_redis, wait_for_stream
+from artifact_writer import artifact_writer
+from result_store import input_hash
+from tracing import Tracer, activate, correlation_id, finish_trace
+
+# Data files every worker reads for each model
+DATA_FILES = [
+    "Daten/Gasdemand_test.pkl",
+    "Daten/electricity_grid_04-11_04_2022.pkl",
+    "Daten/Lastreihe_CN_04-11_04_2022.pkl",
+]
+
+
+def warm_worker():
+    """
+    Initializer of the worker processes.
+    Imports pyomo and the model code and loads the data files once per worker.
+    """
+    import schedule_generator
+
+    for name in DATA_FILES:
+        load_cached_obj(name)
+
+
+# Key of the systemvalues that identifies the hub, newer values supersede older ones of the same hub
+HUB_KEY = "hub"
+
+
+def dispatch_job(
+    timeframe,
+    values,
+    step_length,
+    cancel=None,
+    warm_start=None,
+    progress_channel=None,
+    deadline=None,
+    anchor_mode="exact",
+    portfolio=None,
+    correlation=None,
+    pool_size=None,
+    use_history=False,
+):
+    """
+    Runs in the worker processes.
+    An interrupted job returns the incumbent it had found instead of a schedule.
+    The spans traced in the worker are returned with the result.
+    """
+    import schedule_generator
+
+    tracer = Tracer(correlation)
+    try:
+        with activate(tracer):
+            result = schedule_generator.run_dispatch(
+                timeframe,
+                values,
+                step_length,
+                cancel=cancel,
+                warm_start=warm_start,
+                progress_channel=progress_channel,
+                deadline=deadline,
+                anchor_mode=anchor_mode,
+                portfolio=portfolio,
+                pool_size=pool_size,
+                use_history=use_history,
+            )
+    except schedule_generator.Superseded as e:
+        return {"superseded": True, "incumbent": e.incumbent, "spans": tracer.spans}
+    return dict(result, spans=tracer.spans)
+
+
+class Job:
+    def __init__(self, values, entry_id=None):
+        self.values = values
+        self.entry_id = entry_id
+        self.hub = values.get(HUB_KEY, "default") if isinstance(values, dict) else "default"
+        self.received = time.monotonic()
+        self.received_at = time.time()
+        self.cancel = None
+        self.warm_start = None
+        self.tracer = Tracer(correlation_id(values))
+        self.tracer.received = self.received_at
+
+
+class DaemonStats:
+    """
+    Counters of the scheduler daemon
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.cache_hits = 0
+        self.completed = 0
+        self.failed = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.completed += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self, queue_depth=0, running=0):
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            return {
+                "uptime": uptime,
+                "queue_depth": queue_depth,
+                "running": running,
+                "received": self.received,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "superseded": self.superseded,
+                "cache_hits": self.cache_hits,
+                "cache_hit_rate": self.cache_hits / self.completed if self.completed else 0,
+                "completed": self.completed,
+                "failed": self.failed,
+                "mean_latency": self.latency_sum / self.completed
+                if self.completed
+                else 0,
+                "max_latency": self.latency_max,
+                "throughput_per_hour": self.completed / uptime * 3600 if uptime else 0,
+            }
+
+
+class SchedulerDaemon:
+    """
+    Stays subscribed to the systemvalues and schedules every message on a pool of solver workers.
+    Jobs wait in a bounded queue. When it is full, queued jobs that newer systemvalues of their
+    hub replaced are dropped, if there are none receiving waits until a job leaves the queue,
+    so the latest job of every hub is scheduled.
+    With a StreamTransport the jobs are read from a redis stream shared by several daemons instead,
+    they are acknowledged once the schedule is published.
+    The entries of queued and running jobs are kept alive by heartbeats, so neither this daemon
+    nor another one reclaims them. A failed job is not acknowledged and is retried
+    until the transport moves it to its dead letter stream.
+
+    Newer systemvalues of the same hub supersede older ones: queued jobs are skipped and
+    a running solve is interrupted at its next solver callback.
+    The newest job then takes over the worker and is warm started from the interrupted incumbent.
+    With a progress_channel every incumbent of the final solve is published there as well.
+    deadline_seconds is the number of seconds after receiving the systemvalues by which
+    a schedule is due.
+    """
+
+    def __init__(
+        self,
+        timeframe,
+        step_length,
+        workers=1,
+        queue_size=4,
+        channel="Systemvalues",
+        cluster=False,
+        store_results=True,
+        transport=None,
+        progress_channel=None,
+        deadline_seconds=None,
+        anchor_mode="exact",
+        portfolio=None,
+        pool_size=None,
+        use_history=False,
+    ):
+        self.timeframe = timeframe
+        self.step_length = step_length
+        self.workers = workers
+        self.channel = channel
+        self.cluster = cluster
+        self.store_results = store_results
+        self.transport = transport
+        self.progress_channel = progress_channel
+        self.deadline_seconds = deadline_seconds
+        self.anchor_mode = anchor_mode
+        self.portfolio = portfolio
+        self.pool_size = pool_size
+        self.use_history = use_history
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.free_workers = threading.Semaphore(workers)
+        self.running = 0
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.stats = DaemonStats()
+        self.latest = {}
+        self.active = {}
+        self.waiting = {}
+        self.entries = set()
+        self.manager = None
+        self.executor = None
+        self.threads = []
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=warm_worker
+        )
+        self.manager = multiprocessing.Manager()
+        if self.transport is None:
+            self.redis, self.stream = engage_redis(cluster=self.cluster, channel=self.channel)
+        else:
+            self.redis, self.stream = self.transport.client, None
+        self.threads = [
+            threading.Thread(target=self.receive, daemon=True),
+            threading.Thread(target=self.dispatch, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.executor.shutdown(wait=True)
+        self.manager.shutdown()
+        artifact_writer.close()
+
+    def submit(self, values, entry_id=None):
+        self.stats.count("received")
+        job = Job(values, entry_id)
+        with self.lock:
+            if entry_id is not None:
+                self.entries.add(entry_id)
+            self.latest[job.hub] = job
+            running = self.active.get(job.hub)
+            if running is not None:
+                running.cancel.set()
+        while not self.stopped.is_set():
+            try:
+                self.jobs.put(job, timeout=0.1)
+                return
+            except queue.Full:
+                self.drop_superseded()
+
+    def drop_superseded(self):
+        """
+        Removes the queued jobs that newer systemvalues of their hub replaced,
+        the other jobs keep their order
+        """
+        kept = []
+        while True:
+            try:
+                queued = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                latest = self.latest.get(queued.hub) is queued
+            if latest:
+                kept.append(queued)
+            else:
+                self.stats.count("dropped")
+                self.release(queued)
+        # Only submit puts jobs into the queue, so there is room for all of them
+        for queued in kept:
+            self.jobs.put_nowait(queued)
+
+    def receive(self):
+        if self.transport is not None:
+            return self.receive_stream()
+        while not self.stopped.is_set():
+            try:
+                values = wait_for_stream(
+                    self.stream,
+                    cancel=self.stopped,
+                    spinner=False,
+                    validate=validate_systemvalues,
+                )
+            except PayloadError as e:
+                print("rejected systemvalues:", e)
+                self.stats.count("rejected")
+                continue
+            if values is not None:
+                self.submit(values)
+
+    def receive_stream(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                entries = set(self.entries)
+            self.transport.heartbeat(entries)
+            for entry_id, values in self.transport.read(
+                block=CANCEL_CHECK_INTERVAL, exclude=entries
+            ):
+                try:
+                    validate_systemvalues(values)
+                except PayloadError as e:
+                    print("rejected systemvalues:", e)
+                    self.stats.count("rejected")
+                    self.transport.ack(entry_id)
+                    continue
+                self.submit(values, entry_id)
+
+    def dispatch(self):
+        while not self.stopped.is_set():
+            try:
+                job = self.jobs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if self.latest.get(job.hub) is not job:
+                    self.skip(job)
+                    continue
+                if job.hub in self.active:
+                    # The running job of the hub is being interrupted and hands its worker over
+                    previous = self.waiting.get(job.hub)
+                    if previous is not None:
+                        self.skip(previous)
+                    self.waiting[job.hub] = job
+                    continue
+            self.free_workers.acquire()
+            self.run(job)
+
+    def skip(self, job):
+        self.stats.count("superseded")
+        self.release(job)
+
+    def release(self, job, acknowledge=True):
+        """
+        Stops the heartbeat of the stream entry of a job, acknowledging it unless it failed
+        """
+        if job.entry_id is None:
+            return
+        if acknowledge:
+            self.transport.ack(job.entry_id)
+        with self.lock:
+            self.entries.discard(job.entry_id)
+
+    def run(self, job):
+        job.tracer.add("queue", job.received_at, time.time())
+        job.cancel = self.manager.Event()
+        with self.lock:
+            self.active[job.hub] = job
+            self.running += 1
+        future = self.executor.submit(
+            dispatch_job,
+            self.timeframe,
+            job.values,
+            self.step_length,
+            cancel=job.cancel,
+            warm_start=job.warm_start,
+            progress_channel=self.progress_channel,
+            deadline=None
+            if self.deadline_seconds is None
+            else job.received_at + self.deadline_seconds,
+            anchor_mode=self.anchor_mode,
+            portfolio=self.portfolio,
+            correlation=job.tracer.correlation_id,
+            pool_size=self.pool_size,
+            use_history=self.use_history,
+        )
+        future.add_done_callback(lambda future, job=job: self.finish(job, future))
+
+    def finish(self, job, future):
+        incumbent = None
+        try:
+            result = future.result()
+            job.tracer.extend(result.pop("spans", []))
+            if result.get("superseded"):
+                incumbent = result["incumbent"]
+                self.skip(job)
+            else:
+                if result.get("cache"):
+                    self.stats.count("cache_hits")
+                self.publish(job, result)
+                self.release(job)
+                self.stats.record_latency(time.monotonic() - job.received)
+                finish_trace(job.tracer)
+        except Exception as e:
+            print("scheduling failed:", e)
+            self.stats.count("failed")
+            job.tracer.error = repr(e)
+            finish_trace(job.tracer)
+            # The entry stays pending and is retried once it is reclaimed
+            self.release(job, acknowledge=False)
+        with self.lock:
+            self.running -= 1
+            del self.active[job.hub]
+            successor = self.waiting.pop(job.hub, None)
+        if successor is None or self.stopped.is_set():
+            self.free_workers.release()
+            return
+        successor.warm_start = incumbent
+        self.run(successor)
+
+    def publish(self, job, result):
+        from schedule_generator import activity_matrix
+
+        with job.tracer.span("publish"):
+            send_redis(
+                activity_matrix(result),
+                self.redis,
+                correlation_id=job.tracer.correlation_id,
+            )
+        job.tracer.published = time.time()
+        if self.store_results:
+            from schedule_generator import INCOME_WEIGHT, FULFILLMENT_WEIGHT
+
+            # Runs in the done callback of the worker pool, which must not wait for the writer
+            artifact_writer.store_run(
+                block=False,
+                input_hash=input_hash(job.values),
+                income_weight=INCOME_WEIGHT,
+                fulfillment_weight=FULFILLMENT_WEIGHT,
+                solver_status=result["solver_status"],
+                income_sum=result["income_sum"],
+                mean_deviation=result["mean_deviation"],
+                milp_power=result["milp_power"],
+                milp_schedule=result["milp_schedule"],
+            )
+
+    def snapshot(self):
+        return self.stats.snapshot(queue_depth=self.jobs.qsize(), running=self.running)
+
+    def run_forever(self, stats_interval=60):
+        self.start()
+        try:
+            while not self.stopped.wait(stats_interval):
+                print(self.snapshot())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,122 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+SOLUTION_CACHE_DIR = "Daten/cache"
+
+
+def cache_key(
+    parameters, series, weights, timeframe, step_length, anchor_mode, pool_size=0, anchors=None
+):
+    """
+    Canonical hash of everything a schedule depends on
+
+    :param parameters: the parameters of the systemvalues
+    :param series: resampled price and target series of the horizon
+    :param weights: (income_weight, fulfillment_weight)
+    :param pool_size: number of near-optimal schedules requested besides the best one
+    :param anchors: normalization anchors, if they are not determined by the other inputs
+    """
+    payload = json.dumps(
+        {
+            "parameters": parameters,
+            "series": series,
+            "weights": list(weights),
+            "timeframe": timeframe,
+            "step_length": step_length,
+            "anchor_mode": anchor_mode,
+            "pool_size": pool_size,
+            "anchors": anchors,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("UTF-8")).hexdigest()
+
+
+class SolutionCache:
+    """
+    Results of run_dispatch by cache key.
+    A small in-memory LRU tier sits in front of a directory of json files,
+    which is bounded by max_disk_bytes and evicts the least recently used files.
+    Results are copied in and out, so callers can not change what the cache holds.
+    """
+
+    def __init__(self, directory=SOLUTION_CACHE_DIR, memory_size=32, max_disk_bytes=100_000_000):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return copy.deepcopy(self.memory[key]), "memory"
+        try:
+            with open(self.path(key)) as f:
+                result = json.load(f)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None, None
+        with self.lock:
+            self.disk_hits += 1
+            self.remember(key, result)
+        return result, "disk"
+
+    def put(self, key, result):
+        with self.lock:
+            self.remember(key, result)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self.path(key) + f".{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(result, f)
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def remember(self, key, result):
+        self.memory[key] = copy.deepcopy(result)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+                "memory_entries": len(self.memory),
+            }
@@ -0,0 +1,89 @@
+import time
+
+from pyomo.core.base import ConstraintList, Objective
+
+from solver_backends import SolverOptions, apply_values, is_maximization, objective_value
+from warm_start import extract_variable_values
+
+# Solutions kept in the pool, including the best one
+POOL_SIZE = 10
+
+# Relative objective gap to the best solution within which pool solutions are accepted
+POOL_GAP = 0.05
+
+# Setpoints up to this value count as off in the commitment pattern
+COMMITMENT_TOLERANCE = 1e-4
+
+
+def no_good_pool(model, backend, options, binaries, size=POOL_SIZE, gap=POOL_GAP, deadline=None):
+    """
+    Pool for backends without one: the model is solved again with the commitment binaries
+    of every solution found so far excluded and the objective at most gap from the best.
+    The model has to hold the best solution, it holds it again afterwards.
+
+    :param binaries: binary variable data that make up the commitment of a solution
+    :param deadline: time.time() after which no further solve is started
+    :return: [{"objective": objective, "values": {name: {t: value}}}], best first
+    """
+    best = extract_variable_values(model)
+    objective = objective_value(model)
+    pool = [{"objective": objective, "values": best}]
+    expression = next(model.component_data_objects(Objective, active=True)).expr
+    tolerance = gap * max(abs(objective), 1e-10)
+    model.pool_cuts = ConstraintList()
+    if is_maximization(model):
+        model.pool_cuts.add(expression >= objective - tolerance)
+    else:
+        model.pool_cuts.add(expression <= objective + tolerance)
+    try:
+        while len(pool) < size:
+            time_limit = options.time_limit
+            if deadline is not None:
+                time_limit = deadline - time.time()
+                if time_limit <= 0:
+                    break
+            ones = [var for var in binaries if round(var.value or 0) == 1]
+            zeros = [var for var in binaries if round(var.value or 0) == 0]
+            model.pool_cuts.add(sum(1 - var for var in ones) + sum(zeros) >= 1)
+            result = backend.solve(
+                model,
+                SolverOptions(
+                    threads=options.threads,
+                    time_limit=time_limit,
+                    mip_gap=options.mip_gap,
+                    extra=options.extra,
+                ),
+            )
+            if not result.has_solution:
+                break
+            pool.append({"objective": result.objective, "values": extract_variable_values(model)})
+    finally:
+        model.del_component(model.pool_cuts)
+        apply_values(model, best)
+    return pool
+
+
+def commitment_pattern(schedule, tolerance=COMMITMENT_TOLERANCE):
+    """
+    On/off state of every facility per step, charging, idle or discharging for storages
+    """
+    return tuple(
+        tuple(
+            (setpoint > tolerance) - (setpoint < -tolerance) for setpoint in schedule[facility]
+        )
+        for facility in sorted(schedule)
+    )
+
+
+def distinct_schedules(schedules, tolerance=COMMITMENT_TOLERANCE):
+    """
+    The first schedule of every commitment pattern, in the given order
+    """
+    seen = set()
+    result = []
+    for schedule in schedules:
+        pattern = commitment_pattern(schedule, tolerance)
+        if pattern not in seen:
+            seen.add(pattern)
+            result.append(schedule)
+    return result
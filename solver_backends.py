@@ -0,0 +1,468 @@
+import os
+import time
+
+from pyomo.core.base import Objective, Var, maximize
+from pyomo.environ import value
+from pyomo.opt import SolverFactory, TerminationCondition
+
+from redis_utils import CANCEL_CHECK_INTERVAL
+from solver_telemetry import INFINITE_BOUND
+
+# Backend used when none is given, e.g. SOLVER_BACKEND=highs on machines without gurobi
+SOLVER_BACKEND_VARIABLE = "SOLVER_BACKEND"
+
+# Order in which the backends are tried when none is configured
+BACKEND_PREFERENCE = ["gurobi", "highs", "cbc"]
+
+
+class SolverOptions:
+    """
+    Options every backend understands, extra holds solver specific options passed unchanged.
+    pool_size and pool_gap ask backends with a solution pool for up to pool_size solutions
+    within the relative pool_gap of the best one.
+    node_limit stops the branch and bound after that many nodes, HiGHS counts the root node,
+    Gurobi and CBC do not, see bound_estimation.ROOT_NODE_LIMITS.
+    """
+
+    def __init__(
+        self,
+        threads=None,
+        time_limit=None,
+        mip_gap=None,
+        warm_start=None,
+        extra=None,
+        pool_size=None,
+        pool_gap=None,
+        node_limit=None,
+    ):
+        self.threads = threads
+        self.time_limit = time_limit
+        self.mip_gap = mip_gap
+        self.warm_start = warm_start
+        self.extra = extra or {}
+        self.pool_size = pool_size
+        self.pool_gap = pool_gap
+        self.node_limit = node_limit
+
+    def solver_options(self, names):
+        """
+        The options with the solver specific names
+        """
+        options = dict(self.extra)
+        for key in ["threads", "time_limit", "mip_gap", "pool_size", "pool_gap", "node_limit"]:
+            if getattr(self, key) is not None and key in names:
+                options[names[key]] = getattr(self, key)
+        return options
+
+
+class SolveResult:
+    """
+    Outcome of a solve, the same for every backend.
+    bound is the dual bound, also without a solution, e.g. after a root node solve.
+    pool holds the solutions [{"objective": objective, "values": {name: {t: value}}}]
+    of backends with a solution pool, best first, if a pool was requested
+    """
+
+    def __init__(self, backend, status, has_solution, objective=None, bound=None, time=None):
+        self.backend = backend
+        self.status = status
+        self.has_solution = has_solution
+        self.objective = objective
+        self.bound = bound
+        self.time = time
+        self.pool = None
+
+    @property
+    def gap(self):
+        if self.objective is None or self.bound is None:
+            return None
+        return abs(self.bound - self.objective) / max(abs(self.objective), 1e-10)
+
+    def as_dict(self):
+        return {
+            "backend": self.backend,
+            "status": self.status,
+            "has_solution": self.has_solution,
+            "objective": self.objective,
+            "bound": self.bound,
+            "gap": self.gap,
+            "time": self.time,
+        }
+
+    def __repr__(self):
+        return (
+            f"SolveResult({self.backend}, {self.status}, objective={self.objective}, "
+            f"bound={self.bound}, gap={self.gap}, time={self.time})"
+        )
+
+
+def objective_value(model):
+    objective = next(model.component_data_objects(Objective, active=True))
+    return value(objective)
+
+
+def is_maximization(model):
+    return next(model.component_data_objects(Objective, active=True)).sense == maximize
+
+
+def apply_values(model, values):
+    """
+    Sets the variables of the model to the given values {name: {t: value}}
+    """
+    from warm_start import apply_warm_start
+
+    return apply_warm_start(model, values)
+
+
+def load_solution(solver):
+    """
+    Loads the best solution of a direct or persistent gurobi solver into the model
+    """
+    if solver._solver_model.SolCount == 0:
+        return False
+    solver.load_vars()
+    return True
+
+
+class GurobiBackend:
+    """
+    Gurobi through its python interface. Solves without callback or hints use the
+    direct interface, the others the persistent one, which supports both.
+    A trace that samples the bounds, the default, uses the callback as well.
+    """
+
+    name = "gurobi"
+    supports_bilinear = True
+    supports_callbacks = True
+    supports_pool = True
+    # Several solves may run in threads of one process
+    thread_safe = True
+    option_names = {
+        "mip_gap": "MIPGap",
+        "time_limit": "TimeLimit",
+        "threads": "Threads",
+        "pool_size": "PoolSolutions",
+        "pool_gap": "PoolGap",
+        "node_limit": "NodeLimit",
+    }
+
+    def available(self):
+        try:
+            return SolverFactory("gurobi", solver_io="python").available(exception_flag=False)
+        except Exception:
+            return False
+
+    def solve(self, model, options=None, cancel=None, on_incumbent=None, incumbent_variables=None,
+              hints=None, trace=None):
+        """
+        :param cancel: Event, the solver is terminated once it is set
+        :param on_incumbent: called with (model, mip_gap, elapsed) for every improved solution,
+            incumbent_variables hold the incumbent during the call
+        :param hints: variable values {name: {t: value}} passed to the solver as hints
+        :param trace: SolveTrace that records the final bounds, and the bound trajectory
+            if it samples bounds, see solver_telemetry.py
+        """
+        options = options or SolverOptions()
+        start = time.perf_counter()
+        solver_options = options.solver_options(self.option_names)
+        if options.pool_size:
+            # Search for the pool_size best solutions instead of keeping the ones found on the way
+            solver_options["PoolSearchMode"] = 2
+        if (
+            cancel is None
+            and on_incumbent is None
+            and hints is None
+            and (trace is None or not trace.sample_bounds)
+        ):
+            if options.warm_start is not None:
+                apply_values(model, options.warm_start)
+            gurobi = SolverFactory("gurobi", solver_io="python")
+            result = gurobi.solve(
+                model,
+                warmstart=options.warm_start is not None,
+                report_timing=True,
+                options=solver_options,
+                load_solutions=False,
+            )
+        else:
+            gurobi = self.persistent(
+                model, options, cancel, on_incumbent, incumbent_variables, hints, trace
+            )
+            result = gurobi.solve(
+                model,
+                warmstart=options.warm_start is not None,
+                report_timing=True,
+                options=solver_options,
+                load_solutions=False,
+            )
+        has_solution = load_solution(gurobi)
+        try:
+            bound = gurobi._solver_model.ObjBound
+        except Exception:
+            # Not available if the solve stopped before the relaxation
+            bound = None
+        solve_result = SolveResult(
+            self.name,
+            str(result.solver.termination_condition),
+            has_solution,
+            objective=objective_value(model) if has_solution else None,
+            bound=bound if bound is not None and abs(bound) < INFINITE_BOUND else None,
+            time=time.perf_counter() - start,
+        )
+        if has_solution and options.pool_size:
+            solve_result.pool = self.read_pool(gurobi)
+        if trace is not None:
+            trace.record(
+                gurobi._solver_model.Runtime,
+                solve_result.objective,
+                solve_result.bound,
+                int(gurobi._solver_model.NodeCount),
+            )
+        return solve_result
+
+    def read_pool(self, gurobi):
+        """
+        All solutions of the gurobi solution pool, best first
+        """
+        solver_model = gurobi._solver_model
+        variables = list(gurobi._pyomo_var_to_solver_var_map.items())
+        solver_variables = [solver_var for _, solver_var in variables]
+        pool = []
+        for number in range(solver_model.SolCount):
+            solver_model.setParam("SolutionNumber", number)
+            values = {}
+            for (var, _), x in zip(variables, solver_model.getAttr("Xn", solver_variables)):
+                values.setdefault(var.parent_component().name, {})[var.index()] = x
+            pool.append({"objective": solver_model.PoolObjVal, "values": values})
+        return pool
+
+    def persistent(self, model, options, cancel, on_incumbent, incumbent_variables, hints, trace):
+        from gurobipy import GRB
+
+        if options.warm_start is not None:
+            apply_values(model, options.warm_start)
+        gurobi = SolverFactory("gurobi_persistent")
+        gurobi.set_instance(model)
+        for name, series in (hints or {}).items():
+            var = getattr(model, name, None)
+            for t, hint in series.items():
+                if isinstance(var, Var) and hint is not None and t in var:
+                    gurobi.set_var_attr(var[t], "VarHintVal", hint)
+        last_check = [time.monotonic()]
+
+        def callback(cb_m, cb_opt, cb_where):
+            if trace is not None and trace.sample_bounds and cb_where == GRB.Callback.MIP:
+                trace.sample(
+                    cb_opt.cbGet(GRB.Callback.RUNTIME),
+                    cb_opt.cbGet(GRB.Callback.MIP_OBJBST),
+                    cb_opt.cbGet(GRB.Callback.MIP_OBJBND),
+                    int(cb_opt.cbGet(GRB.Callback.MIP_NODCNT)),
+                )
+            if trace is not None and trace.sample_bounds and cb_where == GRB.Callback.MIPSOL:
+                elapsed = cb_opt.cbGet(GRB.Callback.RUNTIME)
+                trace.incumbent(elapsed)
+                trace.record(
+                    elapsed,
+                    cb_opt.cbGet(GRB.Callback.MIPSOL_OBJBST),
+                    cb_opt.cbGet(GRB.Callback.MIPSOL_OBJBND),
+                )
+            if on_incumbent is not None and cb_where == GRB.Callback.MIPSOL:
+                cb_opt.cbGetSolution(incumbent_variables or [])
+                best = cb_opt.cbGet(GRB.Callback.MIPSOL_OBJBST)
+                bound = cb_opt.cbGet(GRB.Callback.MIPSOL_OBJBND)
+                on_incumbent(
+                    cb_m,
+                    abs(bound - best) / max(abs(best), 1e-10),
+                    cb_opt.cbGet(GRB.Callback.RUNTIME),
+                )
+            if cancel is None:
+                return
+            now = time.monotonic()
+            if now - last_check[0] < CANCEL_CHECK_INTERVAL:
+                return
+            last_check[0] = now
+            if cancel.is_set():
+                cb_opt._solver_model.terminate()
+
+        if (
+            cancel is not None
+            or on_incumbent is not None
+            or (trace is not None and trace.sample_bounds)
+        ):
+            gurobi.set_callback(callback)
+        return gurobi
+
+
+# primal_solution_status of HiGHS when it has a feasible solution
+HIGHS_FEASIBLE = 2
+
+
+def highs_info(solver):
+    """
+    Solve information of a HiGHS solver, None for other solvers
+    """
+    if hasattr(solver, "_solver_model") and hasattr(solver._solver_model, "getInfo"):
+        return solver._solver_model.getInfo()
+    return None
+
+
+class PyomoBackend:
+    """
+    Open source MILP solver through the generic pyomo interface.
+    These solvers can not handle the products of binaries and continuous variables,
+    so the model has to be built with the linear formulation.
+    Callbacks, cancellation during the solve, hints and solution pools are not supported.
+    The solver output is captured per process, so only one solve may run at a time.
+    """
+
+    supports_bilinear = False
+    supports_callbacks = False
+    supports_pool = False
+    thread_safe = False
+
+    def __init__(self, name, solver, option_names, factory=None, warm_start=False):
+        self.name = name
+        self.solver = solver
+        self.option_names = option_names
+        self.factory = factory or {}
+        self.warm_start = warm_start
+
+    def available(self):
+        try:
+            return bool(SolverFactory(self.solver, **self.factory).available(exception_flag=False))
+        except Exception:
+            return False
+
+    def solve(self, model, options=None, cancel=None, on_incumbent=None, incumbent_variables=None,
+              hints=None, trace=None):
+        options = options or SolverOptions()
+        start = time.perf_counter()
+        solver = SolverFactory(self.solver, **self.factory)
+        arguments = {}
+        if options.warm_start is not None:
+            apply_values(model, options.warm_start)
+            if self.warm_start:
+                arguments["warmstart"] = True
+        result = solver.solve(
+            model,
+            options=options.solver_options(self.option_names),
+            load_solutions=False,
+            **arguments,
+        )
+        info = highs_info(solver)
+        # The appsi interface drops the incumbent and bound of solves stopped at a limit
+        has_solution = len(result.solution) > 0 or (
+            info is not None and info.primal_solution_status == HIGHS_FEASIBLE
+        )
+        if has_solution:
+            if hasattr(solver, "load_vars"):
+                solver.load_vars()
+            else:
+                model.solutions.load_from(result)
+        bound = result.problem.upper_bound if is_maximization(model) else result.problem.lower_bound
+        if (bound is None or abs(bound) == float("inf")) and info is not None:
+            bound = info.mip_dual_bound
+        solve_result = SolveResult(
+            self.name,
+            str(result.solver.termination_condition),
+            has_solution,
+            objective=objective_value(model) if has_solution else None,
+            bound=bound if bound is not None and abs(bound) != float("inf") else None,
+            time=time.perf_counter() - start,
+        )
+        if trace is not None:
+            # Only the final bounds are known without callbacks, the time to the first
+            # incumbent is not observed
+            trace.record(solve_result.time, solve_result.objective, solve_result.bound)
+            if info is not None:
+                trace.nodes = int(info.mip_node_count)
+        return solve_result
+
+
+BACKENDS = {
+    "gurobi": GurobiBackend(),
+    "highs": PyomoBackend(
+        "highs",
+        "appsi_highs",
+        {
+            "mip_gap": "mip_rel_gap",
+            "time_limit": "time_limit",
+            "threads": "threads",
+            "node_limit": "mip_max_nodes",
+        },
+    ),
+    "cbc": PyomoBackend(
+        "cbc",
+        "cbc",
+        {"mip_gap": "ratio", "time_limit": "sec", "threads": "threads", "node_limit": "maxNodes"},
+        warm_start=True,
+    ),
+}
+
+# Terminations after which a backend has a feasible solution
+ACCEPTED_TERMINATIONS = [
+    str(TerminationCondition.optimal),
+    str(TerminationCondition.maxTimeLimit),
+    str(TerminationCondition.maxIterations),
+    str(TerminationCondition.feasible),
+]
+
+selected_backend = None
+
+# Availability of the backends requested by name, checked once per process
+available_backends = {}
+
+
+class SolverUnavailable(RuntimeError):
+    """
+    Raised when none of the solver backends or the requested one is installed
+    """
+
+
+def get_backend(name=None):
+    """
+    Returns the backend with the given name, the one of the SOLVER_BACKEND environment variable
+    or the first available of BACKEND_PREFERENCE.
+    Raises SolverUnavailable if the named backend is not installed.
+    """
+    global selected_backend
+    name = name or os.environ.get(SOLVER_BACKEND_VARIABLE)
+    if name is not None:
+        if name not in BACKENDS:
+            raise ValueError(f"unknown solver backend {name}, choose one of {list(BACKENDS)}")
+        if name not in available_backends:
+            available_backends[name] = BACKENDS[name].available()
+        if not available_backends[name]:
+            raise SolverUnavailable(f"solver backend {name} is not available")
+        return BACKENDS[name]
+    if selected_backend is None:
+        for candidate in BACKEND_PREFERENCE:
+            if BACKENDS[candidate].available():
+                selected_backend = BACKENDS[candidate]
+                break
+        else:
+            raise SolverUnavailable("no solver backend available, install gurobi, highspy or cbc")
+    return selected_backend
+
+
+def benchmark_backends(build_model, build_arguments, backends=None, options=None, repetitions=1):
+    """
+    Builds and solves the same model with every available backend.
+    Backends without support for bilinear terms get the linear formulation.
+    Returns the build time and the solve results per backend.
+    """
+    report = {}
+    for name in backends or list(BACKENDS):
+        backend = BACKENDS[name]
+        if not backend.available():
+            print("skipping unavailable backend", name)
+            continue
+        runs = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            model = build_model(linear=not backend.supports_bilinear, **build_arguments)
+            build_time = time.perf_counter() - start
+            result = backend.solve(model, options)
+            runs.append(dict(result.as_dict(), build_time=build_time))
+        report[name] = runs
+    return report
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+import time
+
+from pyomo.core.base import Constraint, Var
+
+TELEMETRY_PATH = "Daten/results/solver_telemetry.jsonl"
+
+# Upper bounds of the histogram buckets
+SOLVE_TIME_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300]
+GAP_BUCKETS = [1e-6, 1e-4, 1e-3, 1e-2, 5e-2, 0.1, 0.5]
+
+# Gurobi reports missing bounds as +-1e100
+INFINITE_BOUND = 1e100
+
+# Sampling the bounds during a solve needs a solver callback, set to 0 to only record
+# the final bounds
+SAMPLE_BOUNDS_VARIABLE = "SAMPLE_SOLVER_BOUNDS"
+
+# Seconds between two sampled points of the trajectory
+SAMPLE_INTERVAL = 1
+
+
+class SolveTrace:
+    """
+    Primal and dual bound trajectory, time to the first incumbent and node count of one solve,
+    filled in by the backend. With sample_bounds the bounds are sampled at most every interval
+    seconds and at every new incumbent, which needs a solver callback. Without it only the final
+    bounds are recorded and first_incumbent stays None, as it does for backends that can not
+    observe the solve. Sampling is on unless the SAMPLE_SOLVER_BOUNDS environment variable is 0.
+    """
+
+    def __init__(self, sample_bounds=None, interval=SAMPLE_INTERVAL):
+        if sample_bounds is None:
+            sample_bounds = os.environ.get(SAMPLE_BOUNDS_VARIABLE, "1") != "0"
+        self.sample_bounds = sample_bounds
+        self.interval = interval
+        self.last_sample = None
+        self.points = []
+        self.first_incumbent = None
+        self.nodes = None
+
+    def record(self, elapsed, primal, dual, nodes=None):
+        """
+        Adds a point to the trajectory if one of the bounds changed
+        """
+        primal = None if primal is None or abs(primal) >= INFINITE_BOUND else primal
+        dual = None if dual is None or abs(dual) >= INFINITE_BOUND else dual
+        if nodes is not None:
+            self.nodes = nodes
+        if self.points and self.points[-1][1:] == (primal, dual):
+            return
+        self.points.append((elapsed, primal, dual))
+
+    def sample(self, elapsed, primal, dual, nodes=None):
+        """
+        Records a point during the solve, at most one every interval seconds
+        """
+        if self.last_sample is not None and elapsed - self.last_sample < self.interval:
+            return
+        self.last_sample = elapsed
+        self.record(elapsed, primal, dual, nodes)
+
+    def incumbent(self, elapsed):
+        if self.first_incumbent is None:
+            self.first_incumbent = elapsed
+
+    def as_dict(self):
+        return {
+            "trajectory": self.points,
+            "first_incumbent": self.first_incumbent,
+            "nodes": self.nodes,
+        }
+
+
+def model_size(model):
+    """
+    Number of variables, binary variables and constraints of a model
+    """
+    variables = 0
+    binaries = 0
+    for var in model.component_data_objects(Var, active=True):
+        variables += 1
+        binaries += var.is_binary()
+    constraints = sum(1 for _ in model.component_data_objects(Constraint, active=True))
+    return {"variables": variables, "binaries": binaries, "constraints": constraints}
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class MetricsRegistry:
+    """
+    In-process counters, gauges and histograms with labels, exposed in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.buckets = {}
+
+    def inc(self, name, labels=None, value=1):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels or {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges.setdefault(name, {})[label_key(labels or {})] = value
+
+    def observe(self, name, value, labels=None, buckets=SOLVE_TIME_BUCKETS):
+        with self.lock:
+            self.buckets.setdefault(name, list(buckets))
+            series = self.histograms.setdefault(name, {})
+            key = label_key(labels or {})
+            histogram = series.setdefault(
+                key, {"counts": [0] * len(self.buckets[name]), "sum": 0, "count": 0}
+            )
+            for index, bound in enumerate(self.buckets[name]):
+                if value <= bound:
+                    histogram["counts"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def expose(self):
+        lines = []
+        with self.lock:
+            for kind, metrics in [("counter", self.counters), ("gauge", self.gauges)]:
+                for name, series in sorted(metrics.items()):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in series.items():
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in series.items():
+                    for bound, count in zip(self.buckets[name], histogram["counts"]):
+                        lines.append(
+                            f"{name}_bucket{format_labels(labels, ('le', bound))} {count}"
+                        )
+                    lines.append(
+                        f"{name}_bucket{format_labels(labels, ('le', '+Inf'))} {histogram['count']}"
+                    )
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Writes the metrics for the textfile collector of a node exporter
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.expose())
+        os.replace(temporary, path)
+
+
+registry = MetricsRegistry()
+
+
+def add_to_registry(target, labels, result, trace):
+    """
+    :param result: SolveResult.as_dict of the solve
+    :param trace: SolveTrace.as_dict of the solve
+    """
+    target.inc("solver_solves_total", dict(labels, status=result["status"]))
+    if result["time"] is not None:
+        target.observe("solver_solve_seconds", result["time"], labels)
+    if result["gap"] is not None:
+        target.observe("solver_final_gap", result["gap"], labels, buckets=GAP_BUCKETS)
+    if trace["first_incumbent"] is not None:
+        target.observe("solver_first_incumbent_seconds", trace["first_incumbent"], labels)
+    if trace["nodes"] is not None:
+        target.inc("solver_nodes_total", labels, trace["nodes"])
+    if not result["has_solution"]:
+        target.inc("solver_no_solution_total", labels)
+
+
+def record_solve(trace, result, size, labels, path=TELEMETRY_PATH):
+    """
+    Adds a solve to the registry and appends its full record to the telemetry file,
+    path None only updates the registry
+
+    :param result: SolveResult of the solve
+    :param size: model_size of the model
+    :param labels: e.g. backend and instance class, used for the registry and the record
+    """
+    add_to_registry(registry, labels, result.as_dict(), trace.as_dict())
+    if path is None:
+        return
+    record = dict(
+        timestamp=time.time(),
+        labels=labels,
+        result=result.as_dict(),
+        size=size,
+        **trace.as_dict(),
+    )
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print("writing the solver telemetry failed", e)
+
+
+def load_records(path=TELEMETRY_PATH):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def slow_classes(records, key="instance_class", quantile=0.95):
+    """
+    Solve time quantile and solve count per label value, slowest first
+    """
+    import numpy as np
+
+    times = {}
+    for record in records:
+        if record["result"]["time"] is not None:
+            times.setdefault(record["labels"].get(key), []).append(record["result"]["time"])
+    return sorted(
+        (
+            (name, float(np.quantile(values, quantile)), len(values))
+            for name, values in times.items()
+        ),
+        key=lambda entry: -entry[1],
+    )
+
+
+def registry_from_records(records):
+    """
+    Rebuilds the registry metrics from telemetry records, e.g. those the worker processes
+    of the daemon appended to the telemetry file
+    """
+    rebuilt = MetricsRegistry()
+    for record in records:
+        add_to_registry(rebuilt, record["labels"], record["result"], record)
+    return rebuilt
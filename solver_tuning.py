@@ -0,0 +1,180 @@
+import itertools
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instance_capture import INSTANCE_DIR, list_instances, load_instance, replay_instance
+
+TUNING_PROFILE_PATH = "Daten/results/solver_profile.json"
+
+# Values tried per solver parameter, the solver default is always a candidate as well
+PARAMETER_SPACE = {
+    "gurobi": {
+        "Threads": [1, 2, 4],
+        "Presolve": [-1, 1, 2],
+        "Heuristics": [0.05, 0.2, 0.5],
+        "Cuts": [-1, 0, 2],
+        "MIPFocus": [0, 1, 2, 3],
+    },
+    "highs": {
+        "threads": [1, 2, 4],
+        "presolve": ["on", "off"],
+        "mip_heuristic_effort": [0.05, 0.2, 0.5],
+        "mip_detect_symmetry": [True, False],
+    },
+}
+
+# A configuration is rejected if its objective is worse than the default by more than this
+OBJECTIVE_TOLERANCE = 1e-4
+
+profile_cache = {}
+
+
+def tuning_class(timeframe, step_length, values):
+    """
+    Instances of a class share horizon length and device mix, they get the same solver options
+    """
+    devices = sorted(values.get("parameters", {}))
+    return f"{timeframe}x{step_length}:{'+'.join(devices)}"
+
+
+def instance_tuning_class(instance):
+    arguments = instance["build_arguments"]
+    return tuning_class(arguments["timeframe"], arguments["step_length"], instance["values"])
+
+
+def candidate_configurations(backend, candidates=20, seed=0):
+    """
+    The solver default followed by candidates random combinations of PARAMETER_SPACE
+    """
+    space = PARAMETER_SPACE[backend]
+    names = sorted(space)
+    combinations = list(itertools.product(*(space[name] for name in names)))
+    random.Random(seed).shuffle(combinations)
+    return [{}] + [dict(zip(names, values)) for values in combinations[:candidates]]
+
+
+def evaluate(path, backend, configuration, time_limit):
+    """
+    Solves the captured model file of one instance with one configuration
+    """
+    mip_gap = load_instance(path)["options"]["mip_gap"]
+    return replay_instance(
+        path,
+        backend,
+        mode="file",
+        options={"time_limit": time_limit, "mip_gap": mip_gap, "extra": configuration},
+    )
+
+
+def timing_statistics(times):
+    return {"median": float(np.median(times)), "p95": float(np.percentile(times, 95))}
+
+
+def select_configuration(configurations, replays):
+    """
+    Chooses the configuration of a class with the largest median speed-up over the default,
+    among those that solve every instance, do not worsen the objective and are not slower at p95.
+    Returns the default if no configuration qualifies and None if the default failed itself.
+
+    :param replays: per configuration the replays in the order of the instances
+    """
+    default = replays[0]
+    if any("error" in replay or replay.get("time") is None for replay in default):
+        return None
+    baseline = timing_statistics([replay["time"] for replay in default])
+    best = {"options": {}, "median_speed_up": 1.0, "p95_speed_up": 1.0, **baseline}
+    for configuration, runs in zip(configurations[1:], replays[1:]):
+        if any("error" in run or run.get("objective") is None for run in runs):
+            continue
+        if any(
+            before.get("objective") is not None
+            and run["objective"] < before["objective"] - OBJECTIVE_TOLERANCE * abs(before["objective"])
+            for before, run in zip(default, runs)
+        ):
+            continue
+        statistics = timing_statistics([run["time"] for run in runs])
+        median_speed_up = baseline["median"] / max(statistics["median"], 1e-9)
+        p95_speed_up = baseline["p95"] / max(statistics["p95"], 1e-9)
+        if p95_speed_up < 1 or median_speed_up <= best["median_speed_up"]:
+            continue
+        best = {
+            "options": configuration,
+            "median_speed_up": median_speed_up,
+            "p95_speed_up": p95_speed_up,
+            **statistics,
+        }
+    return best
+
+
+def tune(directory=INSTANCE_DIR, backend="gurobi", candidates=20, time_limit=60, workers=None,
+         profile_path=TUNING_PROFILE_PATH, seed=0):
+    """
+    Searches solver parameters over the captured instances of a directory.
+    Every pair of configuration and instance is solved in its own process of the pool,
+    so workers times the threads of a configuration should not exceed the cores.
+    The best configuration per tuning class is written to the profile, which solve_model loads.
+    """
+    instances = {}
+    for path in list_instances(directory):
+        instances.setdefault(instance_tuning_class(load_instance(path)), []).append(path)
+    configurations = candidate_configurations(backend, candidates, seed)
+    if workers is None:
+        threads = max(
+            configuration.get("Threads", configuration.get("threads", 1))
+            for configuration in configurations
+        )
+        workers = max(1, (os.cpu_count() or 1) // threads)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for name, paths in instances.items():
+            for index, configuration in enumerate(configurations):
+                for path in paths:
+                    futures[name, index, path] = pool.submit(
+                        evaluate, path, backend, configuration, time_limit
+                    )
+        profile = load_profile(profile_path, cached=False)
+        classes = profile.setdefault(backend, {})
+        for name, paths in instances.items():
+            replays = [
+                [futures[name, index, path].result() for path in paths]
+                for index in range(len(configurations))
+            ]
+            best = select_configuration(configurations, replays)
+            if best is None:
+                print("default configuration failed, not tuning", name)
+                continue
+            best["instances"] = len(paths)
+            classes[name] = best
+            print(
+                "tuned", name, best["options"],
+                "median speed-up", best["median_speed_up"], "p95 speed-up", best["p95_speed_up"],
+            )
+    os.makedirs(os.path.dirname(profile_path) or ".", exist_ok=True)
+    with open(profile_path, "w") as f:
+        json.dump(profile, f, indent=2)
+    profile_cache.pop(profile_path, None)
+    return profile
+
+
+def load_profile(path=TUNING_PROFILE_PATH, cached=True):
+    if cached and path in profile_cache:
+        return profile_cache[path]
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        profile = {}
+    profile_cache[path] = profile
+    return profile
+
+
+def tuned_options(backend, timeframe, step_length, values, path=TUNING_PROFILE_PATH):
+    """
+    Solver options of the profile for the class of the instance, empty without a profile
+    """
+    entry = load_profile(path).get(backend, {}).get(tuning_class(timeframe, step_length, values))
+    return dict(entry["options"]) if entry else {}
@@ -0,0 +1,60 @@
+import time
+
+# Share of the available time for every solve of multi_step_optimization
+PHASE_SHARES = {"min_deviation": 0.2, "max_income": 0.2, "weighted": 0.6}
+
+# Seconds kept free after the last solve for extracting and publishing the schedule
+RESERVE = 2
+
+# Below this many seconds per anchor solve the anchors are not solved at all
+MIN_ANCHOR_TIME = 2
+
+# Solves with less time than this stop at RELAXED_GAP instead of the solver default
+TIGHT_TIME = 30
+RELAXED_GAP = 0.01
+# The anchors only normalize the objective, they never need to be exact
+ANCHOR_GAP = 0.001
+
+
+class TimeBudget:
+    """
+    Splits the time until a deadline between the solves of multi_step_optimization.
+    Every phase gets its share of the time that is left when it starts,
+    so time saved by an early phase goes to the later ones.
+    """
+
+    def __init__(self, deadline, shares=PHASE_SHARES, reserve=RESERVE):
+        """
+        :param deadline: time.time() by which the final schedule is needed
+        """
+        self.deadline = deadline
+        self.shares = dict(shares)
+        self.reserve = reserve
+
+    def remaining(self):
+        return max(self.deadline - self.reserve - time.time(), 0)
+
+    def phase_time(self, phase):
+        return self.remaining() * self.shares[phase] / sum(self.shares.values())
+
+    def phase_deadline(self, phase):
+        return time.time() + self.phase_time(phase)
+
+    def finish(self, phase):
+        self.shares.pop(phase, None)
+
+    skip = finish
+
+    def anchors_affordable(self):
+        return all(
+            self.phase_time(phase) >= MIN_ANCHOR_TIME
+            for phase in ["min_deviation", "max_income"]
+            if phase in self.shares
+        )
+
+    def mip_gap(self, phase):
+        if self.phase_time(phase) < TIGHT_TIME:
+            return RELAXED_GAP
+        if phase != "weighted":
+            return ANCHOR_GAP
+        return None
@@ -0,0 +1,207 @@
+import contextvars
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+# Key of the correlation id in the redis messages of one dispatch
+CORRELATION_KEY = "correlationId"
+
+# Messages that are not dicts, like the activity matrix, keep their wire format.
+# Their correlation id is published on the channel with this suffix right before them.
+CORRELATION_SUFFIX = ".correlation"
+
+TRACE_PATH = "Daten/results/dispatch_traces.jsonl"
+LATENCY_HISTOGRAM_PATH = "Daten/results/dispatch_latency.prom"
+
+# Seconds from receiving the systemvalues to publishing the schedule
+DISPATCH_SLO = 60
+
+# Upper bounds of the latency histogram buckets
+STAGE_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900]
+
+current_tracer = contextvars.ContextVar("current_tracer", default=None)
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+
+def correlation_id(values):
+    """
+    Correlation id sent along with the systemvalues, a new one if there is none
+    """
+    if isinstance(values, dict) and values.get(CORRELATION_KEY):
+        return str(values[CORRELATION_KEY])
+    return new_correlation_id()
+
+
+def tag_message(payload, correlation_id):
+    """
+    Adds the correlation id to a dict message, other messages are returned unchanged
+    """
+    if correlation_id is None or not isinstance(payload, dict):
+        return payload
+    return dict(payload, **{CORRELATION_KEY: correlation_id})
+
+
+class Tracer:
+    """
+    Spans (name, start, duration) of one dispatch.
+    received and published are the times the systemvalues arrived and the schedule was sent,
+    the latency between both is what the DISPATCH_SLO limits.
+    error is set if the dispatch failed.
+    """
+
+    def __init__(self, correlation_id=None):
+        self.correlation_id = correlation_id or new_correlation_id()
+        self.started = time.time()
+        self.received = None
+        self.published = None
+        self.error = None
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.time() - start))
+
+    def add(self, name, start, end):
+        self.spans.append((name, start, end - start))
+
+    def extend(self, spans):
+        self.spans.extend(tuple(span) for span in spans)
+
+    def stages(self):
+        """
+        Total duration per span name, repeated stages like the three solves are summed
+        """
+        totals = {}
+        for name, _, duration in self.spans:
+            totals[name] = totals.get(name, 0) + duration
+        return totals
+
+    def latency(self):
+        if self.received is None or self.published is None:
+            return None
+        return self.published - self.received
+
+    def as_dict(self):
+        return {
+            "correlation_id": self.correlation_id,
+            "started": self.started,
+            "latency": self.latency(),
+            "total": time.time() - self.started,
+            "stages": self.stages(),
+            "spans": self.spans,
+            "error": self.error,
+        }
+
+
+@contextmanager
+def activate(tracer):
+    """
+    Makes the tracer the target of span() in the current thread or task
+    """
+    token = current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        current_tracer.reset(token)
+
+
+@contextmanager
+def span(name):
+    """
+    Records a span on the active tracer, does nothing without one
+    """
+    tracer = current_tracer.get()
+    if tracer is None:
+        yield
+        return
+    with tracer.span(name):
+        yield
+
+
+def active_correlation_id():
+    tracer = current_tracer.get()
+    return None if tracer is None else tracer.correlation_id
+
+
+def finish_trace(tracer, path=TRACE_PATH, slo=DISPATCH_SLO):
+    """
+    Appends the trace to the trace file and reports a violation of the SLO
+    """
+    record = tracer.as_dict()
+    latency = record["latency"]
+    if slo is not None and latency is not None and latency > slo:
+        print(
+            "dispatch", tracer.correlation_id, "took", latency, "s, SLO is", slo, "s:",
+            record["stages"],
+        )
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print("writing the trace failed", e)
+    return record
+
+
+def load_traces(path=TRACE_PATH):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def latency_histograms(records, slo=DISPATCH_SLO):
+    """
+    Registry with the histograms of the dispatch latency and of every stage
+    """
+    from solver_telemetry import MetricsRegistry
+
+    registry = MetricsRegistry()
+    for record in records:
+        if record["latency"] is not None:
+            registry.observe("dispatch_latency_seconds", record["latency"], buckets=STAGE_BUCKETS)
+            if slo is not None and record["latency"] > slo:
+                registry.inc("dispatch_slo_violations_total")
+        for stage, duration in record["stages"].items():
+            registry.observe(
+                "dispatch_stage_seconds", duration, {"stage": stage}, buckets=STAGE_BUCKETS
+            )
+        registry.inc("dispatches_total")
+    return registry
+
+
+def export_histograms(path=TRACE_PATH, target=LATENCY_HISTOGRAM_PATH, slo=DISPATCH_SLO):
+    latency_histograms(load_traces(path), slo).write(target)
+
+
+def slo_report(records, slo=DISPATCH_SLO, quantile=0.95):
+    """
+    Share of dispatches over the SLO, latency quantiles and the quantile of every stage
+    """
+    import numpy as np
+
+    latencies = [record["latency"] for record in records if record["latency"] is not None]
+    stages = {}
+    for record in records:
+        for stage, duration in record["stages"].items():
+            stages.setdefault(stage, []).append(duration)
+    return {
+        "dispatches": len(latencies),
+        "violations": sum(latency > slo for latency in latencies),
+        "violation_rate": sum(latency > slo for latency in latencies) / len(latencies)
+        if latencies
+        else 0,
+        "median": float(np.median(latencies)) if latencies else None,
+        "quantile": float(np.quantile(latencies, quantile)) if latencies else None,
+        "stages": {
+            stage: float(np.quantile(durations, quantile))
+            for stage, durations in sorted(stages.items(), key=lambda item: -sum(item[1]))
+        },
+    }
@@ -0,0 +1,255 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+from pyomo.core.base import Var
+
+# Binary decisions of the hub model, suffix of the variable names
+COMMITMENT_VARIABLES = ["is_active", "is_charging", "Y"]
+
+
+def extract_variable_values(model, suffixes=None):
+    """
+    Returns the values of all variables as plain dictionaries {name: {t: value}}.
+    suffixes limits the result to variables whose name ends with one of them.
+    """
+    values = {}
+    for var in model.component_objects(Var, active=True):
+        if suffixes is not None and not any(
+            var.name.endswith("_" + suffix) for suffix in suffixes
+        ):
+            continue
+        values[var.name] = var.extract_values()
+    return values
+
+
+def apply_warm_start(model, values):
+    """
+    Sets the variables of the model to the given values, so the solver can use them as start.
+    Variables or time steps the model does not have are ignored.
+    """
+    applied = 0
+    for name, series in values.items():
+        var = getattr(model, name, None)
+        if not isinstance(var, Var):
+            continue
+        for t, value in series.items():
+            if value is None or t not in var:
+                continue
+            if var[t].is_binary():
+                value = round(value)
+            var[t].set_value(value, skip_validation=True)
+            applied += 1
+    return applied
+
+
+WARM_START_LIBRARY_PATH = "Daten/results/warm_start.sqlite"
+
+# Number of points every input series is resampled to for the features
+FEATURE_POINTS = 24
+
+# Solutions kept in the library, the oldest ones are removed beyond this
+MAX_SOLUTIONS = 2000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS solutions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    timeframe INTEGER NOT NULL,
+    features BLOB NOT NULL,
+    solution BLOB NOT NULL
+);
+"""
+
+
+def input_features(series, scalars):
+    """
+    Compact description of an input: every series resampled to FEATURE_POINTS values,
+    followed by the scalar inputs
+
+    :param series: dictionary of price and load series
+    :param scalars: numbers the model depends on, e.g. device parameters and initial charges
+    """
+    features = []
+    for name in sorted(series):
+        values = np.asarray(series[name], dtype=float)
+        features.append(
+            np.interp(
+                np.linspace(0, 1, FEATURE_POINTS),
+                np.linspace(0, 1, len(values)),
+                values,
+            )
+        )
+    features.append(np.asarray(scalars, dtype=float))
+    return np.concatenate(features)
+
+
+def align_solution(solution, timeframe):
+    """
+    Maps a solution of another horizon onto range(timeframe) by relative position
+    """
+    aligned = {}
+    for name, series in solution.items():
+        steps = sorted(series)
+        if not steps:
+            continue
+        aligned[name] = {
+            t: series[steps[min(len(steps) - 1, t * len(steps) // timeframe)]]
+            for t in range(timeframe)
+        }
+    return aligned
+
+
+class WarmStartLibrary:
+    """
+    Past solutions with the features of their inputs.
+    For a new input the k nearest solutions are retrieved, the nearest one is used as MIP start
+    and the majority vote of all k on the commitment variables as solver hints.
+    Features are standardized over the library before the euclidean distance is taken.
+    Beyond max_solutions the oldest solutions are removed.
+    """
+
+    def __init__(self, path=WARM_START_LIBRARY_PATH, variables=None, max_solutions=MAX_SOLUTIONS):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.variables = COMMITMENT_VARIABLES + ["setpoint"] if variables is None else variables
+        self.max_solutions = max_solutions
+        self.ids = None
+        self.features = None
+
+    def add(self, features, solution, timeframe):
+        features = np.asarray(features, dtype=float)
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO solutions (timestamp, timeframe, features, solution) VALUES (?, ?, ?, ?)",
+                (
+                    time.time(),
+                    timeframe,
+                    features.tobytes(),
+                    zlib.compress(json.dumps(solution).encode("UTF-8")),
+                ),
+            )
+            removed = self.connection.execute(
+                "DELETE FROM solutions WHERE id <= ?", (cursor.lastrowid - self.max_solutions,)
+            ).rowcount
+        if self.ids is None:
+            return
+        if removed or self.features.shape[1] != len(features):
+            # Other processes may have added solutions as well, they are read on the next lookup
+            self.ids = None
+            return
+        self.ids = np.append(self.ids, cursor.lastrowid)
+        self.features = np.vstack([self.features, features])
+
+    def add_model(self, model, features, timeframe):
+        self.add(features, extract_variable_values(model, self.variables), timeframe)
+
+    def load_features(self):
+        rows = self.connection.execute(
+            "SELECT id, features FROM solutions ORDER BY id"
+        ).fetchall()
+        # Only solutions with the feature layout of the newest one can be compared
+        size = len(rows[-1][1]) if rows else 0
+        rows = [row for row in rows if len(row[1]) == size]
+        self.ids = np.array([row[0] for row in rows], dtype=int)
+        self.features = np.array([np.frombuffer(row[1]) for row in rows]).reshape(
+            len(rows), size // 8
+        )
+
+    def nearest(self, features, k=3):
+        """
+        Returns the ids and distances of the k nearest past solutions
+        """
+        if self.ids is None:
+            self.load_features()
+        features = np.asarray(features, dtype=float)
+        if len(self.ids) == 0 or self.features.shape[1] != len(features):
+            return [], []
+        scale = self.features.std(axis=0)
+        scale[scale == 0] = 1
+        distances = np.linalg.norm((self.features - features) / scale, axis=1)
+        order = np.argsort(distances)[:k]
+        return self.ids[order].tolist(), distances[order].tolist()
+
+    def solution(self, solution_id, timeframe):
+        row = self.connection.execute(
+            "SELECT solution FROM solutions WHERE id = ?", (solution_id,)
+        ).fetchone()
+        if row is None:
+            # Removed since the features were read
+            return None
+        solution = {
+            name: {int(t): value for t, value in series.items()}
+            for name, series in json.loads(zlib.decompress(row[0])).items()
+        }
+        return align_solution(solution, timeframe)
+
+    def suggest(self, features, timeframe, k=3):
+        """
+        Returns (warm_start, hints) for a new input, both None without history
+        """
+        ids, _ = self.nearest(features, k)
+        if not ids:
+            return None, None
+        solutions = [self.solution(solution_id, timeframe) for solution_id in ids]
+        solutions = [solution for solution in solutions if solution is not None]
+        if not solutions:
+            self.ids = None
+            return None, None
+        hints = {}
+        for name in solutions[0]:
+            if not any(name.endswith("_" + suffix) for suffix in COMMITMENT_VARIABLES):
+                continue
+            votes = [solution[name] for solution in solutions if name in solution]
+            hints[name] = {
+                t: float(
+                    sum(vote[t] or 0 for vote in votes) * 2 >= len(votes)
+                )
+                for t in range(timeframe)
+            }
+        return solutions[0], hints
+
+
+def benchmark_warm_start(cases, timeframe, step_length, library, k=3):
+    """
+    Solves the final weighted model of every case cold and warm started from the library,
+    the cases should not be part of the library themselves.
+    Returns the time to the first incumbent and the total solve time of both runs per case.
+    """
+    from schedule_generator import DEFAULT_ANCHORS, FULFILLMENT_WEIGHT, INCOME_WEIGHT
+    from schedule_generator import dispatch_features, solve_model
+
+    report = []
+    for values in cases:
+        warm_start, hints = library.suggest(
+            dispatch_features(timeframe, values, step_length), timeframe, k
+        )
+        case = {}
+        for name, start, start_hints in [("cold", None, None), ("warm", warm_start, hints)]:
+            first_incumbent = []
+            begin = time.perf_counter()
+            solve_model(
+                timeframe,
+                values,
+                step_length,
+                income_weight=INCOME_WEIGHT,
+                fulfillment_weight=FULFILLMENT_WEIGHT,
+                max_mean_deviation=DEFAULT_ANCHORS["max_mean_deviation"],
+                min_mean_deviation=DEFAULT_ANCHORS["min_mean_deviation"],
+                max_income=DEFAULT_ANCHORS["max_income"],
+                min_income=DEFAULT_ANCHORS["min_income"],
+                warm_start=start,
+                hints=start_hints,
+                on_incumbent=lambda model, gap, elapsed: first_incumbent.append(elapsed),
+            )
+            case[name] = {
+                "first_incumbent": first_incumbent[0] if first_incumbent else None,
+                "total": time.perf_counter() - begin,
+            }
+        report.append(case)
+    return report